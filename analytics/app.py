@@ -1,14 +1,33 @@
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Query, Response
+from fastapi.responses import StreamingResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 import uvicorn
-from datetime import datetime
+from datetime import datetime, date, timedelta, timezone
+from typing import List, Optional
 import os
+import asyncio
 import logging
 
-from database import get_db, ClickEvent, create_tables
+from database import get_db
+from ingest import pipeline, to_row, QueueFullError
+from export import (
+    events_query, encode_cursor, decode_cursor, stream_events, InvalidCursorError
+)
+from rollups import rollup_job, get_rollup_summary, get_popular_urls, get_device_breakdown
+from partitions import partition_job
+from migrations import schema_is_current, run_migrations
+from sketches import (
+    count_unique_visitors, count_unique_visitors_between, backfill_sketches,
+    HLL_STANDARD_ERROR, HLL_MAX_RANGE_DAYS, redis_client
+)
+from metrics import MetricsMiddleware, register_stats
+from geoip import country_index, GEOIP_DATABASE
+from dimensions import referrers, user_agents
+import timeseries
 
 # Create logs directory if it doesn't exist
 os.makedirs("logs", exist_ok=True)
@@ -33,12 +52,50 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets browser clients page through /analytics/{short_url}
+    expose_headers=["X-Next-Cursor"],
+)
+
+# Per-route latency histograms for /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Queue depth and writer counters of the ingestion pipeline, read at scrape time
+register_stats("ingest", pipeline.stats, ["inserted", "batches", "rejected", "failed", "clamped"])
+register_stats(
+    "jobs",
+    lambda: {"rollup_runs": rollup_job.runs, "partition_runs": partition_job.runs},
+    ["rollup_runs", "partition_runs"]
 )
+register_stats("geoip", country_index.stats, ["resolved", "unresolved", "cache_hits", "cache_misses"])
+register_stats("referrer_dimension", referrers.stats, ["hits", "misses"])
+register_stats("user_agent_dimension", user_agents.stats, ["hits", "misses"])
+register_stats("timeseries", timeseries.stats, ["cache_hits", "cache_misses"])
 
-# Create database tables on startup
+# Schema changes are applied once per deploy by migrations.py; the startup check
+# is a single version query unless a process finds the schema behind
 @app.on_event("startup")
 def startup_event():
-    create_tables()
+    if not schema_is_current():
+        logger.warning("Database schema is behind, running migrations")
+        run_migrations()
+
+@app.on_event("startup")
+async def start_ingestion():
+    # Events ingested before the range database is loaded keep an empty country
+    app.state.geoip_task = asyncio.create_task(asyncio.to_thread(country_index.load, GEOIP_DATABASE))
+    pipeline.start()
+    rollup_job.start()
+    partition_job.start()
+    # Sketch events ingested before unique-visitor sketches existed
+    app.state.backfill_task = asyncio.create_task(backfill_sketches())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Write everything that is still queued before exiting
+    await pipeline.stop()
+    await rollup_job.stop()
+    await partition_job.stop()
+    await redis_client.close()
 
 class ClickEventCreate(BaseModel):
     short_url: str
@@ -48,14 +105,17 @@ class ClickEventCreate(BaseModel):
     ip_address: str = None
     country: str = None
 
+class ClickEventBatch(BaseModel):
+    events: List[ClickEventCreate]
+
 class ClickEventResponse(BaseModel):
     id: int
     short_url: str
     timestamp: datetime
-    referrer: str = None
-    user_agent: str = None
-    ip_address: str = None
-    country: str = None
+    referrer: Optional[str] = None
+    user_agent: Optional[str] = None
+    ip_address: Optional[str] = None
+    country: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -64,60 +124,157 @@ class ClickEventResponse(BaseModel):
 def read_root():
     return {"message": "Welcome to URL Shortener Analytics Service"}
 
-def record_click_event(event: ClickEventCreate, db: Session):
-    """Background task to record a click event."""
-    db_event = ClickEvent(
-        short_url=event.short_url,
-        timestamp=event.timestamp or datetime.utcnow(),
-        referrer=event.referrer,
-        user_agent=event.user_agent,
-        ip_address=event.ip_address,
-        country=event.country
-    )
-    db.add(db_event)
-    db.commit()
+def enqueue_events(events: List[ClickEventCreate]) -> None:
+    """Hand events to the ingestion pipeline, or push back if it is full."""
+    now = datetime.utcnow()
+    try:
+        pipeline.submit([to_row(event, now) for event in events])
+    except QueueFullError:
+        raise HTTPException(
+            status_code=503,
+            detail="Ingestion queue is full",
+            headers={"Retry-After": "1"}
+        )
 
 @app.post("/events/click", status_code=202)
-async def create_click_event(
-    event: ClickEventCreate, 
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
-):
+async def create_click_event(event: ClickEventCreate):
     """Record a click event asynchronously."""
-    background_tasks.add_task(record_click_event, event, db)
+    enqueue_events([event])
     return {"message": "Event received"}
 
+@app.post("/events/click/batch", status_code=202)
+async def create_click_events(batch: ClickEventBatch):
+    """Record a batch of click events asynchronously."""
+    enqueue_events(batch.events)
+    return {"message": "Events received", "count": len(batch.events)}
+
+@app.get("/metrics")
+def get_metrics():
+    """Expose request, Redis, database and ingestion metrics in Prometheus text format."""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+@app.get("/ingest/stats")
+def get_ingest_stats():
+    """Get the ingestion queue depth, writer counters and enrichment cache counters."""
+    return {
+        **pipeline.stats(),
+        "geoip": country_index.stats(),
+        "referrers": referrers.stats(),
+        "user_agents": user_agents.stats()
+    }
+
+@app.get("/popular")
+def get_popular(
+    hours: int = Query(24, ge=1, le=24 * 30),
+    limit: int = Query(1000, ge=1, le=100000),
+    db: Session = Depends(get_db)
+):
+    """Get the most clicked short URLs of the last few hours, from the hourly rollups."""
+    since = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    return get_popular_urls(db, since, limit)
+
 @app.get("/analytics/{short_url}", response_model=list[ClickEventResponse])
-def get_url_analytics(short_url: str, db: Session = Depends(get_db)):
-    """Get analytics for a specific short URL."""
-    events = db.query(ClickEvent).filter(ClickEvent.short_url == short_url).all()
+def get_url_analytics(
+    short_url: str,
+    response: Response,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db)
+):
+    """Get one page of click events for a specific short URL, oldest first.
+
+    The cursor for the next page is returned in the X-Next-Cursor header.
+    """
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    events = db.execute(events_query(short_url, start, end, after).limit(limit)).all()
+    
+    if len(events) == limit:
+        last = events[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.timestamp, last.id)
     return events
 
+@app.get("/analytics/{short_url}/export")
+def export_url_analytics(
+    short_url: str,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+):
+    """Stream every click event for a short URL as NDJSON or CSV."""
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_events(short_url, format, start, end),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{short_url}.{format}"'}
+    )
+
 @app.get("/analytics/{short_url}/summary")
-def get_url_analytics_summary(short_url: str, db: Session = Depends(get_db)):
+async def get_url_analytics_summary(short_url: str, db: Session = Depends(get_db)):
     """Get a summary of analytics for a specific short URL."""
-    total_clicks = db.query(ClickEvent).filter(ClickEvent.short_url == short_url).count()
+    # Counts come from the hourly rollups plus the raw events not yet rolled up
+    summary = await run_in_threadpool(get_rollup_summary, db, short_url)
     
-    # Get unique IP addresses (approximate unique visitors)
-    unique_ips = db.query(ClickEvent.ip_address).filter(
-        ClickEvent.short_url == short_url
-    ).distinct().count()
-    
-    # Get referrer breakdown
-    referrers = db.query(ClickEvent.referrer, func.count(ClickEvent.id)).filter(
-        ClickEvent.short_url == short_url
-    ).group_by(ClickEvent.referrer).all()
-    
-    # Get country breakdown
-    countries = db.query(ClickEvent.country, func.count(ClickEvent.id)).filter(
-        ClickEvent.short_url == short_url
-    ).group_by(ClickEvent.country).all()
+    # Approximate unique visitors (distinct IPs) from a HyperLogLog sketch
+    unique_visitors = await count_unique_visitors(short_url)
     
     return {
-        "total_clicks": total_clicks,
-        "unique_visitors": unique_ips,
-        "referrers": dict(referrers),
-        "countries": dict(countries)
+        "total_clicks": summary["total_clicks"],
+        "unique_visitors": unique_visitors,
+        "referrers": summary["referrers"],
+        "countries": summary["countries"]
+    }
+
+@app.get("/analytics/{short_url}/devices")
+async def get_url_device_breakdown(short_url: str, db: Session = Depends(get_db)):
+    """Get clicks by browser, operating system and device class for a specific short URL."""
+    return await run_in_threadpool(get_device_breakdown, db, short_url)
+
+@app.get("/analytics/{short_url}/timeseries")
+async def get_url_timeseries(
+    short_url: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    bucket: str = "hour",
+    tz: str = "UTC",
+    db: Session = Depends(get_db)
+):
+    """Get clicks per minute, hour, day or custom bucket (e.g. 15m) between two times.
+
+    Defaults to the last 24 hours. Times without an offset are read in tz.
+    """
+    if end is None:
+        # Minutes are whole and the end is exclusive, so round up to include the current one
+        now = datetime.utcnow().replace(second=0, microsecond=0, tzinfo=timezone.utc)
+        end = now + timedelta(minutes=1)
+    if start is None:
+        start = end - timedelta(days=1)
+    try:
+        return await timeseries.get_timeseries(db, short_url, start, end, bucket, tz)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/analytics/{short_url}/uniques")
+async def get_unique_visitors(short_url: str, start: date, end: date):
+    """Get approximate unique visitors between two days (inclusive)."""
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if (end - start).days + 1 > HLL_MAX_RANGE_DAYS:
+        raise HTTPException(
+            status_code=400, detail=f"Range is limited to {HLL_MAX_RANGE_DAYS} days"
+        )
+    unique_visitors = await count_unique_visitors_between(short_url, start, end)
+    return {
+        "short_url": short_url,
+        "start": start,
+        "end": end,
+        "unique_visitors": unique_visitors,
+        "standard_error": HLL_STANDARD_ERROR
     }
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, Callable
+from urllib.parse import urlsplit
+
+from sqlalchemy import select, insert
+
+from database import engine, Referrer, UserAgent
+
+# Interned values remembered per dimension; ids never change, so entries never go stale
+DIMENSION_CACHE_SIZE = int(os.getenv("DIMENSION_CACHE_SIZE", "50000"))
+# Parsed columns (referrer host and path) are cut to this length; the interned
+# values themselves are kept exactly as sent
+DIMENSION_MAX_LENGTH = 512
+
+_WHITESPACE = re.compile(r"\s+")
+
+_BOT = re.compile(r"bot|crawl|spider|slurp|preview|curl|wget|python-|httpx|go-http-client", re.I)
+
+# First match wins, so more specific tokens come first (Edge and Opera also send "Chrome/")
+_BROWSERS = [
+    ("Edge", re.compile(r"Edg(e|A|iOS)?/")),
+    ("Opera", re.compile(r"OPR/|Opera")),
+    ("Samsung Internet", re.compile(r"SamsungBrowser/")),
+    ("Chrome", re.compile(r"Chrome/|CriOS/")),
+    ("Firefox", re.compile(r"Firefox/|FxiOS/")),
+    ("Safari", re.compile(r"Version/[\d.]+.*Safari/")),
+    ("Internet Explorer", re.compile(r"MSIE |Trident/")),
+]
+
+_OPERATING_SYSTEMS = [
+    ("iOS", re.compile(r"iPhone|iPad|iPod")),
+    ("Android", re.compile(r"Android")),
+    ("ChromeOS", re.compile(r"CrOS")),
+    ("Windows", re.compile(r"Windows")),
+    ("macOS", re.compile(r"Mac OS X|Macintosh")),
+    ("Linux", re.compile(r"Linux|X11")),
+]
+
+
+def normalize(value: Optional[str]) -> Optional[str]:
+    """Trim, collapse whitespace and cap the length of a parsed column."""
+    if not value:
+        return None
+    value = _WHITESPACE.sub(" ", value).strip()
+    return value[:DIMENSION_MAX_LENGTH] or None
+
+
+def value_hash(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def parse_referrer(value: str) -> Dict[str, Any]:
+    parts = urlsplit(value.strip())
+    return {"host": normalize(parts.hostname), "path": normalize(parts.path)}
+
+
+def parse_user_agent(value: str) -> Dict[str, Any]:
+    """Browser, OS and device class from a user agent string, by token matching."""
+    browser = next((name for name, pattern in _BROWSERS if pattern.search(value)), "Other")
+    os_name = next((name for name, pattern in _OPERATING_SYSTEMS if pattern.search(value)), "Other")
+    if _BOT.search(value):
+        device = "bot"
+    elif "iPad" in value or "Tablet" in value or (os_name == "Android" and "Mobile" not in value):
+        device = "tablet"
+    elif "Mobi" in value or "iPhone" in value or "iPod" in value:
+        device = "mobile"
+    else:
+        device = "desktop"
+    return {"browser": browser, "os": os_name, "device": device}
+
+
+def _dialect_insert(table):
+    """INSERT ... ON CONFLICT DO NOTHING for the engine's dialect."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return insert(table)
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=["value_hash"])
+
+
+class Dimension:
+    """Interns the strings of one dimension table, handing out integer ids.
+
+    Known values are answered from a bounded in-process LRU; the misses of a
+    whole chunk are inserted and read back in two statements.
+    """
+
+    def __init__(self, model, parse: Callable[[str], Dict[str, Any]], cache_size: int):
+        self.model = model
+        self.parse = parse
+        self.cache_size = cache_size
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, values: List[str]) -> Tuple[Dict[str, int], List[str]]:
+        found = {}
+        missing = []
+        with self._lock:
+            for value in values:
+                value_id = self._ids.get(value)
+                if value_id is None:
+                    missing.append(value)
+                else:
+                    self._ids.move_to_end(value)
+                    found[value] = value_id
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def _remember(self, ids: Dict[str, int]) -> None:
+        with self._lock:
+            self._ids.update(ids)
+            while len(self._ids) > self.cache_size:
+                self._ids.popitem(last=False)
+
+    def resolve(self, values: List[str]) -> Dict[str, int]:
+        """Map each distinct value to its id, creating rows for new values."""
+        found, missing = self._cached(list(set(values)))
+        if missing:
+            hashes = {value_hash(value): value for value in missing}
+            # Committed on its own, so a cached id always refers to a committed row
+            with engine.begin() as conn:
+                conn.execute(
+                    _dialect_insert(self.model),
+                    [{"value": value, "value_hash": digest, **self.parse(value)}
+                     for digest, value in hashes.items()]
+                )
+                ids = {
+                    hashes[digest]: value_id
+                    for digest, value_id in conn.execute(
+                        select(self.model.value_hash, self.model.id)
+                        .where(self.model.value_hash.in_(list(hashes)))
+                    )
+                }
+            self._remember(ids)
+            found.update(ids)
+        return found
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"cached": len(self._ids), "hits": self.hits, "misses": self.misses}
+
+
+referrers = Dimension(Referrer, parse_referrer, DIMENSION_CACHE_SIZE)
+user_agents = Dimension(UserAgent, parse_user_agent, DIMENSION_CACHE_SIZE)
+
+
+def encode_dimensions(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Copies of click_events rows with non-empty referrers and user agents replaced by dimension ids."""
+    referrer_values = [row.get("referrer") or None for row in rows]
+    user_agent_values = [row.get("user_agent") or None for row in rows]
+    referrer_ids = referrers.resolve([value for value in referrer_values if value])
+    user_agent_ids = user_agents.resolve([value for value in user_agent_values if value])
+    encoded = []
+    for row, referrer, user_agent in zip(rows, referrer_values, user_agent_values):
+        row = dict(row)
+        # Empty values are kept inline as sent, so they read back unchanged
+        row["referrer_id"] = referrer_ids[referrer] if referrer else None
+        if referrer:
+            row["referrer"] = None
+        row["user_agent_id"] = user_agent_ids[user_agent] if user_agent else None
+        if user_agent:
+            row["user_agent"] = None
+        encoded.append(row)
+    return encoded
@@ -0,0 +1,106 @@
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Optional, Tuple, Iterator
+
+from sqlalchemy import select, and_, or_, func
+from sqlalchemy.sql import Select
+
+from database import SessionLocal, ClickEvent, Referrer, UserAgent
+
+EXPORT_CHUNK_SIZE = 5000
+
+EXPORT_COLUMNS = ["id", "short_url", "timestamp", "referrer", "user_agent", "ip_address", "country"]
+
+# Event columns with the referrer and user agent strings read back from their
+# dimension tables; rows from before the dimensions existed carry them inline
+EVENT_COLUMNS = [
+    ClickEvent.id,
+    ClickEvent.short_url,
+    ClickEvent.timestamp,
+    func.coalesce(Referrer.value, ClickEvent.referrer).label("referrer"),
+    func.coalesce(UserAgent.value, ClickEvent.user_agent).label("user_agent"),
+    ClickEvent.ip_address,
+    ClickEvent.country,
+]
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+def encode_cursor(timestamp: datetime, event_id: int) -> str:
+    """Opaque cursor pointing just past the given (timestamp, id)."""
+    raw = json.dumps([timestamp.isoformat(), event_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, event_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(event_id)
+    except Exception:
+        raise InvalidCursorError(cursor)
+
+
+def events_query(
+    short_url: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[Tuple[datetime, int]] = None
+) -> Select:
+    """Events of a short URL in (timestamp, id) order, optionally after a cursor position."""
+    query = (
+        select(*EVENT_COLUMNS)
+        .outerjoin(Referrer, Referrer.id == ClickEvent.referrer_id)
+        .outerjoin(UserAgent, UserAgent.id == ClickEvent.user_agent_id)
+        .where(ClickEvent.short_url == short_url)
+    )
+    if start is not None:
+        query = query.where(ClickEvent.timestamp >= start)
+    if end is not None:
+        query = query.where(ClickEvent.timestamp < end)
+    if after is not None:
+        timestamp, event_id = after
+        query = query.where(or_(
+            ClickEvent.timestamp > timestamp,
+            and_(ClickEvent.timestamp == timestamp, ClickEvent.id > event_id)
+        ))
+    return query.order_by(ClickEvent.timestamp, ClickEvent.id)
+
+
+def stream_events(
+    short_url: str,
+    export_format: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+) -> Iterator[str]:
+    """Yield events as NDJSON or CSV text chunks, read through a server-side cursor."""
+    # Plain row tuples keep memory flat however large the link is
+    query = events_query(short_url, start, end).execution_options(
+        stream_results=True, yield_per=EXPORT_CHUNK_SIZE
+    )
+    with SessionLocal() as db:
+        result = db.execute(query)
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+            for rows in result.partitions():
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue()
+        else:
+            for rows in result.partitions():
+                lines = []
+                for row in rows:
+                    record = dict(zip(EXPORT_COLUMNS, row))
+                    record["timestamp"] = record["timestamp"].isoformat()
+                    lines.append(json.dumps(record))
+                yield "\n".join(lines) + "\n"
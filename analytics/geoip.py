@@ -0,0 +1,173 @@
+import csv
+import gzip
+import os
+import time
+import bisect
+import logging
+import ipaddress
+from array import array
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
+
+logger = logging.getLogger("url-shortener-analytics")
+
+# Local IP range database: CSV rows of start,end,country_code[,...] with the
+# bounds as IP strings (DB-IP style) or integers (IP2Location style); may be gzipped
+GEOIP_DATABASE = os.getenv("GEOIP_DATABASE", "data/ip-country.csv")
+# Recently seen IPs whose country is remembered
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "100000"))
+
+IPV4_MAX = 2 ** 32 - 1
+# IPv4-mapped IPv6 addresses (::ffff:a.b.c.d), as found in integer IPv6 databases
+IPV4_MAPPED_START = 0xFFFF00000000
+IPV4_MAPPED_END = 0xFFFFFFFFFFFF
+
+
+def _parse_bound(value: str) -> Tuple[int, int]:
+    """Return (version, integer) for an IP string or a plain integer."""
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        if IPV4_MAPPED_START <= number <= IPV4_MAPPED_END:
+            return 4, number - IPV4_MAPPED_START
+        return (4 if number <= IPV4_MAX else 6), number
+    address = ipaddress.ip_address(value)
+    return address.version, int(address)
+
+
+class CountryIndex:
+    """IP-to-country lookup over sorted, non-overlapping address ranges.
+
+    IPv4 bounds live in unsigned 32-bit arrays searched with bisect. IPv6
+    bounds are packed as 16-byte big-endian keys into one bytes object, where
+    byte order matches numeric order. Country codes are stored once and
+    referenced by a small index per range.
+    """
+
+    def __init__(self, cache_size: int):
+        # (countries, v4 starts, v4 ends, v4 countries, v6 starts, v6 ends, v6 countries),
+        # replaced as a whole so a reload never mixes old and new ranges
+        self._tables = None
+        self.ranges = 0
+        self.resolved = 0
+        self.unresolved = 0
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def load(self, path: str) -> bool:
+        """Load a range database file. Returns False if the file does not exist."""
+        if not os.path.exists(path):
+            logger.warning(f"IP country database {path} not found, countries will not be resolved")
+            return False
+        started = time.monotonic()
+        codes: Dict[str, int] = {}
+        v4: List[Tuple[int, int, int]] = []
+        v6: List[Tuple[int, int, int]] = []
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", newline="") as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or not row[2].strip():
+                    continue
+                try:
+                    version, start = _parse_bound(row[0])
+                    _, end = _parse_bound(row[1])
+                except ValueError:
+                    # Header line or malformed row
+                    continue
+                code = row[2].strip().upper()
+                if code == "-":
+                    continue
+                country = codes.setdefault(code, len(codes))
+                (v4 if version == 4 else v6).append((start, end, country))
+        v4.sort()
+        v6.sort()
+
+        self._tables = (
+            list(codes),
+            array("I", (start for start, _, _ in v4)),
+            array("I", (end for _, end, _ in v4)),
+            array("H", (country for _, _, country in v4)),
+            b"".join(start.to_bytes(16, "big") for start, _, _ in v6),
+            b"".join(end.to_bytes(16, "big") for _, end, _ in v6),
+            array("H", (country for _, _, country in v6)),
+        )
+        self.ranges = len(v4) + len(v6)
+        self.lookup.cache_clear()
+        logger.info(
+            f"Loaded {len(v4)} IPv4 and {len(v6)} IPv6 country ranges "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+        return True
+
+    @property
+    def loaded(self) -> bool:
+        return self._tables is not None
+
+    @staticmethod
+    def _find_v4(tables, number: int) -> Optional[str]:
+        countries, starts, ends, indexes = tables[:4]
+        i = bisect.bisect_right(starts, number) - 1
+        if i >= 0 and number <= ends[i]:
+            return countries[indexes[i]]
+        return None
+
+    @staticmethod
+    def _find_v6(tables, number: int) -> Optional[str]:
+        countries = tables[0]
+        starts, ends, indexes = tables[4:]
+        key = number.to_bytes(16, "big")
+        lo, hi = 0, len(starts) // 16
+        # Rightmost range starting at or before the address
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if starts[mid * 16:mid * 16 + 16] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        i = lo - 1
+        if i >= 0 and key <= ends[i * 16:i * 16 + 16]:
+            return countries[indexes[i]]
+        return None
+
+    def _lookup(self, ip: str) -> Optional[str]:
+        tables = self._tables
+        if tables is None:
+            return None
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if address.version == 4:
+            return self._find_v4(tables, int(address))
+        return self._find_v6(tables, int(address))
+
+    def fill_countries(self, rows: List[Dict[str, Any]]) -> None:
+        """Set the country of every row that has an IP but no country, in place."""
+        if not self.loaded:
+            return
+        for row in rows:
+            ip = row.get("ip_address")
+            if not ip or row.get("country"):
+                continue
+            country = self.lookup(ip)
+            if country:
+                row["country"] = country
+                self.resolved += 1
+            else:
+                self.unresolved += 1
+
+    def stats(self) -> Dict[str, Any]:
+        cache = self.lookup.cache_info()
+        return {
+            "loaded": self.loaded,
+            "ranges": self.ranges,
+            "resolved": self.resolved,
+            "unresolved": self.unresolved,
+            "cache_hits": cache.hits,
+            "cache_misses": cache.misses,
+            "cache_size": cache.currsize,
+        }
+
+
+country_index = CountryIndex(GEOIP_CACHE_SIZE)
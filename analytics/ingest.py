@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import insert
+
+from database import engine, ClickEvent
+from sketches import add_visitors
+from geoip import country_index
+from dimensions import encode_dimensions
+
+logger = logging.getLogger("url-shortener-analytics")
+
+# Ingestion settings
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "50000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.5"))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "3"))
+# Client timestamps further ahead or older than this are replaced with the receive
+# time; far-future rows would land in click_events_default and block its partition
+EVENT_MAX_FUTURE_SECONDS = int(os.getenv("EVENT_MAX_FUTURE_SECONDS", "300"))
+EVENT_MAX_AGE_DAYS = int(os.getenv("EVENT_MAX_AGE_DAYS", "7"))
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue cannot take more events."""
+
+
+class IngestionPipeline:
+    """Bounded queue of click events drained by a single bulk-inserting writer."""
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float, max_retries: int):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.inserted = 0
+        self.batches = 0
+        self.rejected = 0
+        self.failed = 0
+        self.clamped = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def submit(self, rows: List[Dict[str, Any]]) -> None:
+        """Queue rows for insertion, all or nothing. Raises QueueFullError when there is no room."""
+        if self._queue is None or self._closing or self.max_size - self._queue.qsize() < len(rows):
+            self.rejected += len(rows)
+            raise QueueFullError()
+        for row in rows:
+            self._queue.put_nowait(row)
+
+    async def _next_batch(self) -> List[Dict[str, Any]]:
+        # Wait for the first row, then collect until the batch is full or the interval passes
+        try:
+            batch = [await asyncio.wait_for(self._queue.get(), self.flush_interval)]
+        except asyncio.TimeoutError:
+            return []
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _insert(self, batch: List[Dict[str, Any]]) -> None:
+        # Resolve countries for the whole chunk here, off the event loop
+        country_index.fill_countries(batch)
+        # Referrers and user agents are stored as dimension ids; batch keeps the
+        # strings for the sketches
+        rows = encode_dimensions(batch)
+        # executemany of a single INSERT is sent as multi-row VALUES statements
+        with engine.begin() as conn:
+            conn.execute(insert(ClickEvent), rows)
+
+    async def _write(self, batch: List[Dict[str, Any]]) -> None:
+        for attempt in range(self.max_retries):
+            try:
+                await asyncio.to_thread(self._insert, batch)
+                self.inserted += len(batch)
+                self.batches += 1
+                break
+            except Exception as e:
+                logger.error(
+                    f"Error inserting {len(batch)} click events "
+                    f"(attempt {attempt+1}/{self.max_retries}): {e}"
+                )
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(min(2 ** attempt, 10))
+        else:
+            self.failed += len(batch)
+            return
+        try:
+            await add_visitors(batch)
+        except Exception as e:
+            logger.error(f"Error updating unique-visitor sketches: {e}")
+
+    async def _run(self) -> None:
+        while not (self._closing and self._queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._write(batch)
+
+    def start(self) -> None:
+        """Create the queue and start the writer task."""
+        if self._task and not self._task.done():
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Stop accepting events and wait for the writer to drain the queue."""
+        self._closing = True
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Ingestion queue not drained on shutdown, {self.depth} events lost")
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth and writer counters."""
+        return {
+            "queue_depth": self.depth,
+            "max_size": self.max_size,
+            "inserted": self.inserted,
+            "batches": self.batches,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "clamped": self.clamped,
+        }
+
+
+def to_row(event: Any, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Convert an incoming click event to a click_events row."""
+    now = now or datetime.utcnow()
+    timestamp = event.timestamp
+    if timestamp is not None and timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    if timestamp is not None and not (
+        now - timedelta(days=EVENT_MAX_AGE_DAYS)
+        <= timestamp
+        <= now + timedelta(seconds=EVENT_MAX_FUTURE_SECONDS)
+    ):
+        pipeline.clamped += 1
+        timestamp = None
+    return {
+        "short_url": event.short_url,
+        "timestamp": timestamp or now,
+        "referrer": event.referrer,
+        "user_agent": event.user_agent,
+        "ip_address": event.ip_address,
+        "country": event.country,
+    }
+
+
+pipeline = IngestionPipeline(
+    max_size=INGEST_QUEUE_SIZE,
+    batch_size=INGEST_BATCH_SIZE,
+    flush_interval=INGEST_FLUSH_INTERVAL,
+    max_retries=INGEST_MAX_RETRIES
+)
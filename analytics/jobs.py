@@ -0,0 +1,40 @@
+import asyncio
+import logging
+from typing import Callable, Any, Optional
+
+logger = logging.getLogger("url-shortener-analytics")
+
+
+class PeriodicJob:
+    """Runs a blocking maintenance function in a worker thread at a fixed interval."""
+
+    def __init__(self, name: str, fn: Callable[[], Any], interval: float):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.last_result: Any = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self.last_result = await asyncio.to_thread(self.fn)
+                self.runs += 1
+            except Exception as e:
+                logger.error(f"Error running {self.name}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
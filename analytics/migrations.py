@@ -0,0 +1,233 @@
+"""Versioned schema migrations for the analytics database.
+
+Run once per deploy, before the analytics service starts:
+
+    python migrations.py
+
+Applied versions are recorded in schema_version, and a Postgres advisory lock
+keeps concurrent runs from applying the same migration twice. Analytics
+processes only compare the recorded version with the latest one on startup.
+"""
+import time
+import logging
+from typing import Callable, List
+
+from sqlalchemy import text, inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from database import Base, ReferrerRollup, engine
+from dimensions import referrers, value_hash
+from partitions import ensure_partitioned_table
+from rollups import rolled_up_event_id
+
+logger = logging.getLogger("url-shortener-analytics")
+
+# Arbitrary key for the advisory lock held while migrating
+MIGRATION_LOCK_ID = 712004
+
+DIMENSION_TABLES = ("referrers", "user_agents")
+HASH_BATCH_SIZE = 5000
+
+
+class Migration:
+    """One schema change. Non-transactional ones run in autocommit mode, or manage
+    their own transactions, and must be safe to repeat."""
+
+    def __init__(self, version: int, description: str, upgrade: Callable[[Connection], None],
+                 transactional: bool = True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.transactional = transactional
+
+
+def partition_click_events(conn: Connection) -> None:
+    # Must come before create_all, which would create click_events as a plain
+    # table; runs its own transactions under the partition lock
+    ensure_partitioned_table()
+
+
+def create_base_tables(conn: Connection) -> None:
+    Base.metadata.create_all(bind=conn)
+
+
+def add_dimension_columns(conn: Connection) -> None:
+    # click_events tables created before the dimension tables existed
+    columns = {column["name"] for column in inspect(conn).get_columns("click_events")}
+    for column in ("referrer_id", "user_agent_id"):
+        if column not in columns:
+            # On Postgres this also adds the column to every partition
+            conn.execute(text(f"ALTER TABLE click_events ADD COLUMN {column} INTEGER"))
+
+
+def add_dimension_hashes(conn: Connection) -> None:
+    # Dimension tables created when value itself was unique
+    for table in DIMENSION_TABLES:
+        columns = {column["name"] for column in inspect(conn).get_columns(table)}
+        if "value_hash" in columns:
+            continue
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN value_hash VARCHAR"))
+        rows = conn.execute(text(f"SELECT id, value FROM {table}")).all()
+        for i in range(0, len(rows), HASH_BATCH_SIZE):
+            conn.execute(
+                text(f"UPDATE {table} SET value_hash = :hash WHERE id = :id"),
+                [{"id": row_id, "hash": value_hash(value)} for row_id, value in rows[i:i + HASH_BATCH_SIZE]]
+            )
+        conn.execute(text(f"CREATE UNIQUE INDEX {table}_value_hash_key ON {table} (value_hash)"))
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN value_hash SET NOT NULL"))
+            # Values longer than a btree entry can now be interned. SQLite has no
+            # such limit and cannot drop the constraint without rebuilding the table
+            conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_value_key"))
+
+
+def key_referrer_rollups_by_id(conn: Connection) -> None:
+    # referrer_rollups used the referrer text as part of its primary key, and an
+    # over-long referrer failed the whole rollup transaction
+    columns = {column["name"] for column in inspect(conn).get_columns("referrer_rollups")}
+    if "referrer_id" in columns:
+        return
+    last_id = rolled_up_event_id(conn)
+    # Intern every referrer still stored as text: the old rollup keys and the
+    # events not rolled up yet, so the rollup only ever sees ids
+    values = [value for (value,) in conn.execute(text(
+        "SELECT DISTINCT referrer FROM referrer_rollups WHERE referrer <> ''"
+    ))]
+    values += [value for (value,) in conn.execute(
+        text("""
+            SELECT DISTINCT referrer FROM click_events
+            WHERE id > :last_id AND referrer_id IS NULL AND referrer <> ''
+        """),
+        {"last_id": last_id}
+    )]
+    ids = referrers.resolve(values)
+    with engine.begin() as tx:
+        tx.execute(text("CREATE TABLE referrer_rollup_ids (value VARCHAR NOT NULL, id INTEGER NOT NULL)"))
+        if ids:
+            tx.execute(
+                text("INSERT INTO referrer_rollup_ids (value, id) VALUES (:value, :id)"),
+                [{"value": value, "id": value_id} for value, value_id in ids.items()]
+            )
+        tx.execute(text("ALTER TABLE referrer_rollups RENAME TO referrer_rollups_old"))
+        if tx.dialect.name == "postgresql":
+            tx.execute(text(
+                "ALTER TABLE referrer_rollups_old RENAME CONSTRAINT referrer_rollups_pkey TO referrer_rollups_old_pkey"
+            ))
+        ReferrerRollup.__table__.create(bind=tx)
+        tx.execute(text("""
+            INSERT INTO referrer_rollups (short_url, hour, referrer_id, clicks)
+            SELECT o.short_url, o.hour, coalesce(m.id, 0), sum(o.clicks)
+            FROM referrer_rollups_old o LEFT JOIN referrer_rollup_ids m ON m.value = o.referrer
+            GROUP BY o.short_url, o.hour, coalesce(m.id, 0)
+        """))
+        tx.execute(
+            text("""
+                UPDATE click_events SET referrer_id = m.id, referrer = NULL
+                FROM referrer_rollup_ids m
+                WHERE click_events.id > :last_id AND click_events.referrer_id IS NULL
+                AND m.value = click_events.referrer
+            """),
+            {"last_id": last_id}
+        )
+        tx.execute(text("DROP TABLE referrer_rollups_old"))
+        tx.execute(text("DROP TABLE referrer_rollup_ids"))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "partition click_events", partition_click_events, transactional=False),
+    Migration(2, "create base tables", create_base_tables),
+    Migration(3, "add click_events dimension id columns", add_dimension_columns),
+    Migration(4, "make dimension values unique by hash", add_dimension_hashes),
+    Migration(5, "key referrer rollups by referrer id", key_referrer_rollups_by_id, transactional=False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def ensure_version_table(conn: Connection) -> None:
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def current_version() -> int:
+    """Highest applied migration; 0 if none, or if schema_version does not exist yet."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+    except DBAPIError:
+        return 0
+
+
+def schema_is_current() -> bool:
+    """Cheap startup check: a single query when migrations have already run."""
+    return current_version() >= LATEST_VERSION
+
+
+def record_version(conn: Connection, migration: Migration) -> None:
+    conn.execute(
+        text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+        {"version": migration.version, "description": migration.description}
+    )
+
+
+def run_migrations() -> int:
+    """Apply pending migrations in order. Returns the number applied."""
+    applied = 0
+    with engine.connect() as lock_conn:
+        if engine.dialect.name == "postgresql":
+            # Session-level lock: a concurrent run waits, then finds nothing left to do
+            lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            lock_conn.commit()
+        try:
+            with engine.begin() as conn:
+                ensure_version_table(conn)
+            version = current_version()
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.description}")
+                if migration.transactional:
+                    with engine.begin() as conn:
+                        migration.upgrade(conn)
+                        record_version(conn, migration)
+                else:
+                    with engine.connect() as conn:
+                        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                        migration.upgrade(conn)
+                    with engine.begin() as conn:
+                        record_version(conn, migration)
+                applied += 1
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                lock_conn.commit()
+    return applied
+
+
+def wait_for_database(timeout: float = 120) -> None:
+    """Block until the database accepts connections; it may still be starting."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return
+        except OperationalError as e:
+            if time.monotonic() > deadline:
+                raise
+            logger.error(f"Error connecting to database: {e}")
+            time.sleep(2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    print("Running database migrations...")
+    wait_for_database()
+    applied = run_migrations()
+    print(f"Migrations completed successfully! Applied {applied}, schema at version {LATEST_VERSION}.")
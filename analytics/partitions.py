@@ -0,0 +1,224 @@
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+
+from database import engine
+from jobs import PeriodicJob
+
+logger = logging.getLogger("url-shortener-analytics")
+
+# Partition size ("day" or "month") and how many future partitions to keep ready
+CLICK_PARTITION_INTERVAL = os.getenv("CLICK_PARTITION_INTERVAL", "month")
+CLICK_PARTITIONS_AHEAD = int(os.getenv("CLICK_PARTITIONS_AHEAD", "3"))
+# Partitions entirely older than this are detached and dropped; 0 keeps everything
+CLICK_RETENTION_DAYS = int(os.getenv("CLICK_RETENTION_DAYS", "0"))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+
+PARTITION_LOCK_ID = 712002
+
+CREATE_PARTITIONED_TABLE = """
+    CREATE TABLE click_events (
+        id INTEGER NOT NULL DEFAULT nextval('click_events_id_seq'),
+        short_url VARCHAR,
+        timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+        referrer VARCHAR,
+        user_agent VARCHAR,
+        ip_address VARCHAR,
+        country VARCHAR,
+        referrer_id INTEGER,
+        user_agent_id INTEGER,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)
+"""
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def interval_start(moment: datetime) -> datetime:
+    """Start of the partition interval containing a timestamp."""
+    if CLICK_PARTITION_INTERVAL == "day":
+        return datetime(moment.year, moment.month, moment.day)
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_interval(start: datetime) -> datetime:
+    if CLICK_PARTITION_INTERVAL == "day":
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return datetime(start.year + 1, 1, 1)
+    return datetime(start.year, start.month + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    if CLICK_PARTITION_INTERVAL == "day":
+        return f"click_events_p{start:%Y%m%d}"
+    return f"click_events_p{start:%Y%m}"
+
+
+def _table_kind(conn) -> Optional[str]:
+    return conn.execute(
+        text("SELECT relkind FROM pg_class WHERE relname = 'click_events' AND relkind IN ('r', 'p')")
+    ).scalar()
+
+
+def _create_parent(conn) -> None:
+    conn.execute(text(CREATE_PARTITIONED_TABLE))
+    conn.execute(text("ALTER SEQUENCE click_events_id_seq OWNED BY click_events.id"))
+    conn.execute(text(
+        "CREATE INDEX ix_click_events_short_url_timestamp ON click_events (short_url, timestamp)"
+    ))
+    conn.execute(text("CREATE TABLE click_events_default PARTITION OF click_events DEFAULT"))
+
+
+def _convert_legacy_table(conn) -> datetime:
+    """Turn the old heap table into the first partition of a new partitioned table.
+
+    Returns the boundary where the regular partitions start.
+    """
+    newest = conn.execute(text("SELECT max(timestamp) FROM click_events")).scalar()
+    boundary = next_interval(interval_start(max(newest or datetime.utcnow(), datetime.utcnow())))
+    conn.execute(text("ALTER TABLE click_events RENAME TO click_events_legacy"))
+    # The partitioned parent's (id, timestamp) key replaces the old id-only key on attach
+    conn.execute(text("ALTER TABLE click_events_legacy DROP CONSTRAINT click_events_pkey"))
+    conn.execute(text(
+        "UPDATE click_events_legacy SET timestamp = 'epoch' WHERE timestamp IS NULL"
+    ))
+    conn.execute(text("ALTER TABLE click_events_legacy ALTER COLUMN timestamp SET NOT NULL"))
+    # ATTACH requires every parent column; tables older than the dimension ids lack them
+    for column in ("referrer_id", "user_agent_id"):
+        conn.execute(text(f"ALTER TABLE click_events_legacy ADD COLUMN IF NOT EXISTS {column} INTEGER"))
+    _create_parent(conn)
+    conn.execute(
+        text(f"""
+            ALTER TABLE click_events ATTACH PARTITION click_events_legacy
+            FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')
+        """)
+    )
+    logger.info(f"Converted click_events to a partitioned table; legacy rows end at {boundary}")
+    return boundary
+
+
+def ensure_partitioned_table() -> None:
+    """Create click_events as a partitioned table, converting an existing plain table."""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+        kind = _table_kind(conn)
+        if kind == "p":
+            return
+        if kind == "r":
+            _convert_legacy_table(conn)
+        else:
+            conn.execute(text("CREATE SEQUENCE IF NOT EXISTS click_events_id_seq"))
+            _create_parent(conn)
+    create_partitions()
+
+
+def _partitions(conn) -> List[Tuple[str, Optional[datetime]]]:
+    """(name, upper bound) of every partition; the default partition has no bound."""
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'click_events'::regclass
+    """))
+    partitions = []
+    for name, bound in rows:
+        match = _UPPER_BOUND.search(bound or "")
+        partitions.append((name, datetime.fromisoformat(match.group(1)) if match else None))
+    return partitions
+
+
+def _create_partition(conn, start: datetime, stop: datetime) -> None:
+    name = partition_name(start)
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{stop.isoformat()}')"
+    params = {"start": start, "stop": stop}
+    conflicting = conn.execute(
+        text("""
+            SELECT 1 FROM click_events_default
+            WHERE timestamp >= :start AND timestamp < :stop LIMIT 1
+        """),
+        params
+    ).first()
+    if not conflicting:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF click_events {bounds}"))
+        return
+    # Postgres refuses a partition whose range already has rows in the default
+    # partition, so build the table, move those rows in, then attach it
+    conn.execute(text(f"CREATE TABLE {name} (LIKE click_events INCLUDING DEFAULTS)"))
+    moved = conn.execute(
+        text(f"""
+            WITH moved AS (
+                DELETE FROM click_events_default
+                WHERE timestamp >= :start AND timestamp < :stop
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """),
+        params
+    ).rowcount
+    conn.execute(text(f"ALTER TABLE click_events ATTACH PARTITION {name} {bounds}"))
+    logger.warning(f"Moved {moved} rows from click_events_default into {name}")
+
+
+def create_partitions() -> int:
+    """Create any missing partitions from now up to CLICK_PARTITIONS_AHEAD intervals ahead.
+
+    Each partition is created in its own transaction, so one that fails does
+    not undo the others.
+    """
+    if engine.dialect.name != "postgresql":
+        return 0
+    end = interval_start(datetime.utcnow())
+    for _ in range(CLICK_PARTITIONS_AHEAD + 1):
+        end = next_interval(end)
+    created = 0
+    while True:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+            # Never overlap a partition that already covers part of the range
+            covered_until = max(
+                (upper for _, upper in _partitions(conn) if upper is not None), default=None
+            )
+            start = interval_start(datetime.utcnow())
+            if covered_until and covered_until > start:
+                start = covered_until
+            if start >= end:
+                break
+            _create_partition(conn, start, next_interval(start))
+        created += 1
+    if created:
+        logger.info(f"Created {created} click_events partitions")
+    return created
+
+
+def drop_expired_partitions() -> List[str]:
+    """Detach and drop partitions whose whole range is older than the retention period."""
+    if engine.dialect.name != "postgresql" or CLICK_RETENTION_DAYS <= 0:
+        return []
+    cutoff = datetime.utcnow() - timedelta(days=CLICK_RETENTION_DAYS)
+    dropped = []
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+        for name, upper in _partitions(conn):
+            if upper is not None and upper <= cutoff:
+                conn.execute(text(f"ALTER TABLE click_events DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+    if dropped:
+        logger.info(f"Dropped expired click_events partitions: {', '.join(dropped)}")
+    return dropped
+
+
+def maintain_partitions() -> None:
+    create_partitions()
+    drop_expired_partitions()
+
+
+partition_job = PeriodicJob(
+    "click_events partition maintenance", maintain_partitions, PARTITION_MAINTENANCE_INTERVAL
+)
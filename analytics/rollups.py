@@ -0,0 +1,253 @@
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Any, List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import engine
+from jobs import PeriodicJob
+
+logger = logging.getLogger("url-shortener-analytics")
+
+# How often the rollup job runs, and how many event ids it folds in per transaction
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "100000"))
+
+ROLLUP_NAME = "click_rollups"
+DEVICE_ROLLUP_NAME = "user_agent_rollups"
+MINUTE_ROLLUP_NAME = "click_minute_rollups"
+# Arbitrary key for the advisory lock that keeps replicas from rolling up twice
+ROLLUP_LOCK_ID = 712001
+
+
+def hour_bucket(column: str) -> str:
+    """SQL expression truncating a timestamp column to the hour."""
+    if engine.dialect.name == "sqlite":
+        return f"strftime('%Y-%m-%d %H:00:00', {column})"
+    return f"date_trunc('hour', {column})"
+
+
+def minute_bucket(column: str) -> str:
+    """SQL expression truncating a timestamp column to the minute."""
+    if engine.dialect.name == "sqlite":
+        return f"strftime('%Y-%m-%d %H:%M:00', {column})"
+    return f"date_trunc('minute', {column})"
+
+
+def _rollup_statements():
+    hour = hour_bucket("timestamp")
+    window = "id > :lo AND id <= :hi"
+    return [
+        f"""
+        INSERT INTO click_rollups (short_url, hour, clicks)
+        SELECT short_url, {hour}, count(*) FROM click_events
+        WHERE {window}
+        GROUP BY short_url, {hour}
+        ON CONFLICT (short_url, hour)
+        DO UPDATE SET clicks = click_rollups.clicks + excluded.clicks
+        """,
+        f"""
+        INSERT INTO referrer_rollups (short_url, hour, referrer_id, clicks)
+        SELECT short_url, {hour}, coalesce(referrer_id, 0), count(*) FROM click_events
+        WHERE {window}
+        GROUP BY short_url, {hour}, coalesce(referrer_id, 0)
+        ON CONFLICT (short_url, hour, referrer_id)
+        DO UPDATE SET clicks = referrer_rollups.clicks + excluded.clicks
+        """,
+        f"""
+        INSERT INTO country_rollups (short_url, hour, country, clicks)
+        SELECT short_url, {hour}, coalesce(country, ''), count(*) FROM click_events
+        WHERE {window}
+        GROUP BY short_url, {hour}, coalesce(country, '')
+        ON CONFLICT (short_url, hour, country)
+        DO UPDATE SET clicks = country_rollups.clicks + excluded.clicks
+        """,
+    ]
+
+
+def _device_rollup_statements():
+    hour = hour_bucket("timestamp")
+    return [
+        f"""
+        INSERT INTO user_agent_rollups (short_url, hour, user_agent_id, clicks)
+        SELECT short_url, {hour}, coalesce(user_agent_id, 0), count(*) FROM click_events
+        WHERE id > :lo AND id <= :hi
+        GROUP BY short_url, {hour}, coalesce(user_agent_id, 0)
+        ON CONFLICT (short_url, hour, user_agent_id)
+        DO UPDATE SET clicks = user_agent_rollups.clicks + excluded.clicks
+        """,
+    ]
+
+
+def _minute_rollup_statements():
+    minute = minute_bucket("timestamp")
+    return [
+        f"""
+        INSERT INTO click_minute_rollups (short_url, minute, clicks)
+        SELECT short_url, {minute}, count(*) FROM click_events
+        WHERE id > :lo AND id <= :hi
+        GROUP BY short_url, {minute}
+        ON CONFLICT (short_url, minute)
+        DO UPDATE SET clicks = click_minute_rollups.clicks + excluded.clicks
+        """,
+    ]
+
+
+def _advance(conn, name: str, statements: List[str]) -> int:
+    conn.execute(
+        text("""
+            INSERT INTO rollup_state (name, last_event_id, pending_event_id)
+            VALUES (:name, 0, 0) ON CONFLICT (name) DO NOTHING
+        """),
+        {"name": name}
+    )
+    last_id, pending_id = conn.execute(
+        text("SELECT last_event_id, pending_event_id FROM rollup_state WHERE name = :name"),
+        {"name": name}
+    ).one()
+    covered = 0
+    while last_id < pending_id:
+        hi = min(pending_id, last_id + ROLLUP_BATCH_SIZE)
+        for statement in statements:
+            conn.execute(text(statement), {"lo": last_id, "hi": hi})
+        covered += hi - last_id
+        last_id = hi
+    max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM click_events")).scalar()
+    conn.execute(
+        text("""
+            UPDATE rollup_state SET last_event_id = :last_id, pending_event_id = :pending_id
+            WHERE name = :name
+        """),
+        {"name": name, "last_id": last_id, "pending_id": max(max_id, last_id)}
+    )
+    return covered
+
+
+def run_rollup() -> int:
+    """Fold newly ingested click events into the rollup tables.
+
+    Event ids are handed out before their transaction commits, so a run only
+    rolls up to the highest id seen by the previous run; by then every lower
+    id has long been committed. Each group of rollup tables keeps its own
+    high-water mark, so a group added later catches up from the first event.
+    Returns the number of event ids covered.
+    """
+    covered = 0
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            locked = conn.execute(
+                text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": ROLLUP_LOCK_ID}
+            ).scalar()
+            if not locked:
+                return 0
+        covered += _advance(conn, ROLLUP_NAME, _rollup_statements())
+        _advance(conn, DEVICE_ROLLUP_NAME, _device_rollup_statements())
+        _advance(conn, MINUTE_ROLLUP_NAME, _minute_rollup_statements())
+    return covered
+
+
+def rolled_up_event_id(db: Session, name: str = ROLLUP_NAME) -> int:
+    """Highest event id already included in a group of rollups."""
+    last_id = db.execute(
+        text("SELECT last_event_id FROM rollup_state WHERE name = :name"), {"name": name}
+    ).scalar()
+    return last_id or 0
+
+
+def get_rollup_summary(db: Session, short_url: str) -> Dict[str, Any]:
+    """Click, referrer and country totals from the rollups plus the not yet rolled up tail."""
+    last_id = rolled_up_event_id(db)
+    params = {"short_url": short_url, "last_id": last_id}
+
+    total_clicks = db.execute(
+        text("""
+            SELECT
+                (SELECT coalesce(sum(clicks), 0) FROM click_rollups WHERE short_url = :short_url)
+                + (SELECT count(*) FROM click_events WHERE short_url = :short_url AND id > :last_id)
+        """),
+        params
+    ).scalar()
+
+    referrers: Dict[str, int] = {}
+    for referrer, clicks in db.execute(
+        text("""
+            SELECT coalesce(r.value, m.referrer, ''), sum(m.clicks) FROM (
+                SELECT referrer_id, CAST(NULL AS VARCHAR) AS referrer, clicks FROM referrer_rollups
+                WHERE short_url = :short_url
+                UNION ALL
+                SELECT referrer_id, referrer, 1 FROM click_events
+                WHERE short_url = :short_url AND id > :last_id
+            ) AS m
+            LEFT JOIN referrers r ON r.id = m.referrer_id
+            GROUP BY coalesce(r.value, m.referrer, '')
+        """),
+        params
+    ):
+        referrers[referrer] = int(clicks)
+
+    countries: Dict[str, int] = {}
+    for country, clicks in db.execute(
+        text("""
+            SELECT country, sum(clicks) FROM (
+                SELECT country, clicks FROM country_rollups WHERE short_url = :short_url
+                UNION ALL
+                SELECT coalesce(country, ''), 1 FROM click_events
+                WHERE short_url = :short_url AND id > :last_id
+            ) AS merged
+            GROUP BY country
+        """),
+        params
+    ):
+        countries[country] = int(clicks)
+
+    return {
+        "total_clicks": int(total_clicks),
+        "referrers": referrers,
+        "countries": countries,
+    }
+
+
+def get_device_breakdown(db: Session, short_url: str) -> Dict[str, Any]:
+    """Clicks by browser, OS and device class, from the user agent rollups plus the tail."""
+    last_id = rolled_up_event_id(db, DEVICE_ROLLUP_NAME)
+    rows = db.execute(
+        text("""
+            SELECT u.browser, u.os, u.device, sum(m.clicks) FROM (
+                SELECT user_agent_id, clicks FROM user_agent_rollups WHERE short_url = :short_url
+                UNION ALL
+                SELECT coalesce(user_agent_id, 0), 1 FROM click_events
+                WHERE short_url = :short_url AND id > :last_id
+            ) AS m
+            LEFT JOIN user_agents u ON u.id = m.user_agent_id
+            GROUP BY u.browser, u.os, u.device
+        """),
+        {"short_url": short_url, "last_id": last_id}
+    )
+    breakdown = {"total_clicks": 0, "browsers": {}, "operating_systems": {}, "devices": {}}
+    for browser, os_name, device, clicks in rows:
+        clicks = int(clicks)
+        breakdown["total_clicks"] += clicks
+        for key, value in (("browsers", browser), ("operating_systems", os_name), ("devices", device)):
+            value = value or "unknown"
+            breakdown[key][value] = breakdown[key].get(value, 0) + clicks
+    return breakdown
+
+
+def get_popular_urls(db: Session, since: datetime, limit: int) -> List[Dict[str, Any]]:
+    """Short URLs with the most rolled-up clicks since a given hour, busiest first."""
+    rows = db.execute(
+        text("""
+            SELECT short_url, sum(clicks) AS clicks FROM click_rollups
+            WHERE hour >= :since
+            GROUP BY short_url
+            ORDER BY clicks DESC
+            LIMIT :limit
+        """),
+        {"since": since, "limit": limit}
+    )
+    return [{"short_url": short_url, "clicks": int(clicks)} for short_url, clicks in rows]
+
+
+rollup_job = PeriodicJob("click rollup", run_rollup, ROLLUP_INTERVAL)
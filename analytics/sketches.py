@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Any, List, Set, Tuple
+
+import redis.asyncio
+from sqlalchemy import select
+
+from database import SessionLocal, ClickEvent
+from metrics import timed_redis
+
+logger = logging.getLogger("url-shortener-analytics")
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Daily sketches older than this are dropped by Redis; the all-time sketch is kept
+HLL_DAY_RETENTION_DAYS = int(os.getenv("HLL_DAY_RETENTION_DAYS", "400"))
+# Longest date range a single unique-visitor query may merge
+HLL_MAX_RANGE_DAYS = int(os.getenv("HLL_MAX_RANGE_DAYS", "366"))
+
+# Redis HyperLogLogs use 16384 registers: standard error 1.04 / sqrt(16384)
+HLL_STANDARD_ERROR = 0.0081
+
+BACKFILL_MARKER_KEY = "hll:backfilled"
+BACKFILL_BATCH_SIZE = 10000
+
+redis_client = redis.asyncio.from_url(REDIS_URL)
+
+
+def day_key(short_url: str, day: date) -> str:
+    return f"hll:{short_url}:{day.isoformat()}"
+
+
+def all_time_key(short_url: str) -> str:
+    return f"hll:{short_url}:all"
+
+
+def _group_visitors(rows: List[Dict[str, Any]]) -> Dict[Tuple[str, date], Set[str]]:
+    groups: Dict[Tuple[str, date], Set[str]] = defaultdict(set)
+    for row in rows:
+        if row.get("ip_address"):
+            groups[(row["short_url"], row["timestamp"].date())].add(row["ip_address"])
+    return groups
+
+
+@timed_redis("add_visitors")
+async def add_visitors(rows: List[Dict[str, Any]]) -> None:
+    """Add the visitor IPs of a batch of click_events rows to the daily and all-time sketches."""
+    groups = _group_visitors(rows)
+    if not groups:
+        return
+    retention = HLL_DAY_RETENTION_DAYS * 86400
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for (short_url, day), ips in groups.items():
+            key = day_key(short_url, day)
+            pipe.pfadd(key, *ips)
+            pipe.expire(key, retention)
+            pipe.pfadd(all_time_key(short_url), *ips)
+        await pipe.execute()
+
+
+@timed_redis("count_unique_visitors")
+async def count_unique_visitors(short_url: str) -> int:
+    """Approximate unique visitors over the whole history of a short URL."""
+    return await redis_client.pfcount(all_time_key(short_url))
+
+
+@timed_redis("count_unique_visitors")
+async def count_unique_visitors_between(short_url: str, start: date, end: date) -> int:
+    """Approximate unique visitors between two days, inclusive."""
+    days = (end - start).days + 1
+    keys = [day_key(short_url, start + timedelta(days=i)) for i in range(days)]
+    # PFCOUNT over several keys returns the cardinality of their union
+    return await redis_client.pfcount(*keys)
+
+
+def _load_visitor_batch(after_id: int, up_to_id: int) -> List[Dict[str, Any]]:
+    with SessionLocal() as db:
+        result = db.execute(
+            select(ClickEvent.id, ClickEvent.short_url, ClickEvent.timestamp, ClickEvent.ip_address)
+            .where(ClickEvent.id > after_id, ClickEvent.id <= up_to_id)
+            .order_by(ClickEvent.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        )
+        return [row._asdict() for row in result]
+
+
+def _max_event_id() -> int:
+    with SessionLocal() as db:
+        return db.query(ClickEvent.id).order_by(ClickEvent.id.desc()).limit(1).scalar() or 0
+
+
+async def backfill_sketches() -> None:
+    """Add events ingested before the sketches existed. Safe to repeat: HLL adds are idempotent."""
+    if await redis_client.exists(BACKFILL_MARKER_KEY):
+        return
+    try:
+        # Everything above this id is added by the ingestion writer
+        up_to_id = await asyncio.to_thread(_max_event_id)
+        after_id = 0
+        while after_id < up_to_id:
+            rows = await asyncio.to_thread(_load_visitor_batch, after_id, up_to_id)
+            if not rows:
+                break
+            await add_visitors(rows)
+            after_id = rows[-1]["id"]
+        await redis_client.set(BACKFILL_MARKER_KEY, up_to_id)
+        logger.info(f"Backfilled unique-visitor sketches up to event {up_to_id}")
+    except Exception as e:
+        logger.error(f"Error backfilling unique-visitor sketches: {e}")
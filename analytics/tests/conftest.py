@@ -0,0 +1,32 @@
+"""Tests for the analytics service, run from the repository root with
+
+    python -m pytest analytics/tests
+
+Services are flat modules imported by bare name, as in the container, so each
+service's tests run in their own pytest invocation.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def pg_engine():
+    """Engine for a scratch Postgres database, emptied before each test.
+
+    Set ANALYTICS_TEST_DATABASE_URL to enable the tests that use it; they are
+    skipped otherwise. Everything in the database's public schema is dropped.
+    """
+    url = os.getenv("ANALYTICS_TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("ANALYTICS_TEST_DATABASE_URL is not set")
+    from sqlalchemy import create_engine, text
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA public CASCADE"))
+        conn.execute(text("CREATE SCHEMA public"))
+    yield engine
+    engine.dispose()
@@ -0,0 +1,94 @@
+import pytest
+
+from geoip import CountryIndex
+
+MAPPED = 0xFFFF00000000
+
+RANGES = [
+    "start,end,country",
+    "1.0.0.0,1.0.0.255,AU",
+    "1.0.1.0,1.0.3.255,CN",
+    # Integer IPv4 bounds (2.0.0.0 - 2.0.0.255)
+    "33554432,33554687,FR",
+    # IPv4-mapped IPv6 bounds from an integer IPv6 database (3.0.0.0 - 3.0.0.255)
+    f"{MAPPED + 50331648},{MAPPED + 50331903},US",
+    "2001:db8::,2001:db8::ffff,DE",
+    "2001:db8:1::,2001:db8:1::,NL",
+    "4.0.0.0,4.0.0.255,-",
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / "ranges.csv"
+    path.write_text("\n".join(RANGES) + "\n")
+    index = CountryIndex(cache_size=100)
+    assert index.load(str(path))
+    return index
+
+
+@pytest.mark.parametrize("ip, country", [
+    ("1.0.0.0", "AU"),
+    ("1.0.0.255", "AU"),
+    ("1.0.1.0", "CN"),
+    ("1.0.3.255", "CN"),
+    ("0.255.255.255", None),
+    ("1.0.4.0", None),
+    ("2.0.0.0", "FR"),
+    ("2.0.0.255", "FR"),
+    ("2.0.1.0", None),
+    ("3.0.0.0", "US"),
+    ("3.0.0.255", "US"),
+    ("3.0.1.0", None),
+    ("4.0.0.1", None),
+    ("255.255.255.255", None),
+])
+def test_ipv4_boundaries(index, ip, country):
+    assert index.lookup(ip) == country
+
+
+@pytest.mark.parametrize("ip, country", [
+    ("2001:db8::", "DE"),
+    ("2001:db8::ffff", "DE"),
+    ("2001:db8::1:0", None),
+    ("2001:db7:ffff:ffff:ffff:ffff:ffff:ffff", None),
+    ("2001:db8:1::", "NL"),
+    ("2001:db8:1::1", None),
+    ("::", None),
+    ("ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff", None),
+])
+def test_ipv6_boundaries(index, ip, country):
+    assert index.lookup(ip) == country
+
+
+@pytest.mark.parametrize("ip, country", [
+    ("::ffff:1.0.0.0", "AU"),
+    ("::ffff:1.0.3.255", "CN"),
+    ("::ffff:3.0.0.255", "US"),
+    ("::ffff:3.0.1.0", None),
+])
+def test_ipv4_mapped_addresses_use_the_ipv4_ranges(index, ip, country):
+    assert index.lookup(ip) == country
+
+
+def test_invalid_addresses_are_unresolved(index):
+    assert index.lookup("not-an-ip") is None
+    assert index.lookup("") is None
+
+
+def test_fill_countries_keeps_existing_countries(index):
+    rows = [
+        {"ip_address": "1.0.0.1"},
+        {"ip_address": "1.0.0.1", "country": "NZ"},
+        {"ip_address": "9.9.9.9"},
+        {"ip_address": None},
+    ]
+    index.fill_countries(rows)
+    assert [row.get("country") for row in rows] == ["AU", "NZ", None, None]
+    assert (index.resolved, index.unresolved) == (1, 1)
+
+
+def test_missing_file_leaves_the_index_unloaded(tmp_path):
+    index = CountryIndex(cache_size=10)
+    assert not index.load(str(tmp_path / "missing.csv"))
+    assert index.lookup("1.0.0.1") is None
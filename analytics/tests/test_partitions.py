@@ -0,0 +1,56 @@
+from sqlalchemy import text
+
+import migrations
+import partitions
+
+# click_events as created by create_all before partitioning and dimension ids
+LEGACY_TABLE = """
+    CREATE TABLE click_events (
+        id SERIAL PRIMARY KEY,
+        short_url VARCHAR,
+        timestamp TIMESTAMP WITHOUT TIME ZONE,
+        referrer VARCHAR,
+        user_agent VARCHAR,
+        ip_address VARCHAR,
+        country VARCHAR
+    );
+    CREATE INDEX ix_click_events_id ON click_events (id);
+    CREATE INDEX ix_click_events_short_url ON click_events (short_url);
+    CREATE INDEX ix_click_events_timestamp ON click_events (timestamp);
+    INSERT INTO click_events (short_url, timestamp, referrer) VALUES
+        ('abc', '2023-05-01 10:00', 'https://example.com/'),
+        ('abc', now() - interval '1 day', NULL),
+        ('xyz', NULL, NULL);
+"""
+
+
+def test_migrations_convert_a_legacy_click_events_table(pg_engine, monkeypatch):
+    monkeypatch.setattr(partitions, "engine", pg_engine)
+    monkeypatch.setattr(migrations, "engine", pg_engine)
+    with pg_engine.begin() as conn:
+        conn.exec_driver_sql(LEGACY_TABLE)
+
+    migrations.run_migrations()
+    assert migrations.current_version() == migrations.LATEST_VERSION
+
+    with pg_engine.begin() as conn:
+        assert partitions._table_kind(conn) == "p"
+        names = [name for name, _ in partitions._partitions(conn)]
+        assert "click_events_legacy" in names and "click_events_default" in names
+        assert conn.execute(text("SELECT count(*) FROM click_events")).scalar() == 3
+        # New rows carry dimension ids and get fresh ids from the old sequence
+        new_id = conn.execute(text(
+            "INSERT INTO click_events (short_url, referrer_id) VALUES ('abc', 1) RETURNING id"
+        )).scalar()
+        assert new_id == 4
+
+
+def test_ensure_partitioned_table_is_idempotent(pg_engine, monkeypatch):
+    monkeypatch.setattr(partitions, "engine", pg_engine)
+    partitions.ensure_partitioned_table()
+    with pg_engine.begin() as conn:
+        created = len(partitions._partitions(conn))
+    partitions.ensure_partitioned_table()
+    with pg_engine.begin() as conn:
+        assert partitions._table_kind(conn) == "p"
+        assert len(partitions._partitions(conn)) == created
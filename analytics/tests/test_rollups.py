@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import dimensions
+import migrations
+import partitions
+import rollups
+from database import ClickEvent
+from dimensions import encode_dimensions
+
+# Far beyond the ~2.7 KB a Postgres btree entry can hold
+LONG_REFERRER = "https://example.com/search?q=" + "x" * 10000
+
+
+@pytest.fixture
+def pg_analytics(pg_engine, monkeypatch):
+    for module in (dimensions, migrations, partitions, rollups):
+        monkeypatch.setattr(module, "engine", pg_engine)
+    # Cached ids belong to whichever database the previous test used
+    monkeypatch.setattr(dimensions.referrers, "_ids", OrderedDict())
+    migrations.run_migrations()
+    return pg_engine
+
+
+def ingest(engine, rows):
+    with engine.begin() as conn:
+        conn.execute(ClickEvent.__table__.insert(), encode_dimensions(rows))
+
+
+def summary(engine):
+    with Session(engine) as db:
+        return rollups.get_rollup_summary(db, "abc")
+
+
+def test_rollup_accepts_referrers_longer_than_a_btree_entry(pg_analytics):
+    now = datetime.utcnow()
+    ingest(pg_analytics, [
+        {"short_url": "abc", "timestamp": now, "referrer": LONG_REFERRER},
+        {"short_url": "abc", "timestamp": now, "referrer": LONG_REFERRER},
+        {"short_url": "abc", "timestamp": now, "referrer": ""},
+    ])
+    rollups.run_rollup()
+    rollups.run_rollup()
+    assert rollups.rolled_up_event_id(Session(pg_analytics)) == 3
+    assert summary(pg_analytics)["referrers"] == {LONG_REFERRER: 2, "": 1}
+
+
+def test_migration_rekeys_text_referrer_rollups(pg_analytics):
+    with pg_analytics.begin() as conn:
+        conn.execute(text("DROP TABLE referrer_rollups"))
+        conn.execute(text("""
+            CREATE TABLE referrer_rollups (
+                short_url VARCHAR, hour TIMESTAMP, referrer VARCHAR, clicks INTEGER NOT NULL,
+                PRIMARY KEY (short_url, hour, referrer)
+            )
+        """))
+        conn.execute(text("""
+            INSERT INTO referrer_rollups VALUES
+                ('abc', '2024-01-01 10:00', 'https://a.example/', 3),
+                ('abc', '2024-01-01 10:00', '', 2)
+        """))
+        conn.execute(text("""
+            INSERT INTO rollup_state (name, last_event_id, pending_event_id)
+            VALUES ('click_rollups', 0, 0)
+        """))
+        # An event ingested before the dimension ids, not rolled up yet
+        conn.execute(text("""
+            INSERT INTO click_events (short_url, timestamp, referrer)
+            VALUES ('abc', now(), 'https://b.example/')
+        """))
+        conn.execute(text("DELETE FROM schema_version WHERE version = 5"))
+
+    migrations.run_migrations()
+    assert summary(pg_analytics)["referrers"] == {"https://a.example/": 3, "": 2, "https://b.example/": 1}
+    rollups.run_rollup()
+    rollups.run_rollup()
+    assert summary(pg_analytics)["referrers"] == {"https://a.example/": 3, "": 2, "https://b.example/": 1}
@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from timeseries import bucket_counts, parse_bucket, parse_timezone, to_epoch_minute, utc_offsets
+
+NEW_YORK = parse_timezone("America/New_York")
+
+
+def utc_minute(*args) -> int:
+    return to_epoch_minute(datetime(*args, tzinfo=timezone.utc), NEW_YORK)
+
+
+def series(*minutes):
+    return np.array(minutes, dtype=np.int64), np.ones(len(minutes), dtype=np.int64)
+
+
+def as_dict(starts, totals):
+    return dict(zip(np.datetime_as_string(starts, unit="m").tolist(), totals.tolist()))
+
+
+def test_spring_forward_leaves_the_skipped_hour_empty():
+    # 2024-03-10: clocks jump from 02:00 EST to 03:00 EDT at 07:00 UTC
+    start = to_epoch_minute(datetime(2024, 3, 10, 0, 0), NEW_YORK)
+    end = to_epoch_minute(datetime(2024, 3, 10, 6, 0), NEW_YORK)
+    minutes, counts = series(*(utc_minute(2024, 3, 10, hour) for hour in range(5, 10)))
+    starts, totals = bucket_counts(minutes, counts, start, end, 60, NEW_YORK)
+    assert as_dict(starts, totals) == {
+        "2024-03-10T00:00": 1,
+        "2024-03-10T01:00": 1,
+        "2024-03-10T02:00": 0,
+        "2024-03-10T03:00": 1,
+        "2024-03-10T04:00": 1,
+        "2024-03-10T05:00": 1,
+    }
+
+
+def test_fall_back_merges_the_repeated_hour():
+    # 2024-11-03: clocks go back from 02:00 EDT to 01:00 EST at 06:00 UTC
+    start = to_epoch_minute(datetime(2024, 11, 3, 0, 0), NEW_YORK)
+    end = to_epoch_minute(datetime(2024, 11, 3, 4, 0), NEW_YORK)
+    assert end - start == 5 * 60
+    minutes, counts = series(*(utc_minute(2024, 11, 3, hour, 30) for hour in range(4, 9)))
+    starts, totals = bucket_counts(minutes, counts, start, end, 60, NEW_YORK)
+    assert as_dict(starts, totals) == {
+        "2024-11-03T00:00": 1,
+        "2024-11-03T01:00": 2,
+        "2024-11-03T02:00": 1,
+        "2024-11-03T03:00": 1,
+    }
+
+
+def test_day_buckets_align_to_local_midnight_across_a_change():
+    start = to_epoch_minute(datetime(2024, 11, 2, 0, 0), NEW_YORK)
+    end = to_epoch_minute(datetime(2024, 11, 5, 0, 0), NEW_YORK)
+    minutes, counts = series(
+        utc_minute(2024, 11, 3, 3, 59),   # 23:59 EDT on the 2nd
+        utc_minute(2024, 11, 3, 4, 0),    # 00:00 EDT on the 3rd
+        utc_minute(2024, 11, 4, 4, 59),   # 23:59 EST on the 3rd
+        utc_minute(2024, 11, 4, 5, 0),    # 00:00 EST on the 4th
+    )
+    starts, totals = bucket_counts(minutes, counts, start, end, 1440, NEW_YORK)
+    assert as_dict(starts, totals) == {
+        "2024-11-02T00:00": 1,
+        "2024-11-03T00:00": 2,
+        "2024-11-04T00:00": 1,
+    }
+
+
+def test_empty_range_is_all_zero_buckets():
+    start = to_epoch_minute(datetime(2024, 3, 10, 0, 0), NEW_YORK)
+    end = to_epoch_minute(datetime(2024, 3, 10, 12, 0), NEW_YORK)
+    minutes, counts = series()
+    starts, totals = bucket_counts(minutes, counts, start, end, 360, NEW_YORK)
+    assert as_dict(starts, totals) == {
+        "2024-03-10T00:00": 0,
+        "2024-03-10T06:00": 0,
+    }
+
+
+def test_utc_offsets_find_the_change_to_the_minute():
+    start = utc_minute(2024, 3, 1, 0, 0)
+    end = utc_minute(2024, 4, 1, 0, 0)
+    points, offsets = utc_offsets(NEW_YORK, start, end)
+    assert points.tolist() == [start, utc_minute(2024, 3, 10, 7, 0)]
+    assert offsets.tolist() == [-300, -240]
+
+
+@pytest.mark.parametrize("bucket, minutes", [
+    ("minute", 1), ("hour", 60), ("day", 1440), ("15m", 15), ("6h", 360), ("7d", 10080),
+])
+def test_parse_bucket(bucket, minutes):
+    assert parse_bucket(bucket) == minutes
+
+
+@pytest.mark.parametrize("bucket", ["0m", "week", "5s", "-1h", ""])
+def test_parse_bucket_rejects_invalid_widths(bucket):
+    with pytest.raises(ValueError):
+        parse_bucket(bucket)
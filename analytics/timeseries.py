@@ -0,0 +1,206 @@
+import os
+import re
+import json
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from rollups import minute_bucket, rolled_up_event_id, MINUTE_ROLLUP_NAME
+from sketches import redis_client
+
+logger = logging.getLogger("url-shortener-analytics")
+
+# Largest number of buckets and the longest range a single request may ask for
+TIMESERIES_MAX_BUCKETS = int(os.getenv("TIMESERIES_MAX_BUCKETS", "10000"))
+TIMESERIES_MAX_DAYS = int(os.getenv("TIMESERIES_MAX_DAYS", "366"))
+# Ranges that ended at least this many seconds ago no longer change (late events
+# have been flushed by then) and are cached in Redis for TIMESERIES_CACHE_TTL seconds
+TIMESERIES_CLOSED_AFTER = int(os.getenv("TIMESERIES_CLOSED_AFTER", "3600"))
+TIMESERIES_CACHE_TTL = int(os.getenv("TIMESERIES_CACHE_TTL", "86400"))
+
+NAMED_BUCKETS = {"minute": 1, "hour": 60, "day": 1440}
+_CUSTOM_BUCKET = re.compile(r"^(\d+)([mhd])$")
+_UNIT_MINUTES = {"m": 1, "h": 60, "d": 1440}
+
+_EPOCH = datetime(1970, 1, 1)
+
+cache_hits = 0
+cache_misses = 0
+
+
+def parse_bucket(bucket: str) -> int:
+    """Bucket width in minutes: minute, hour, day, or a count and unit such as 15m, 6h or 7d."""
+    if bucket in NAMED_BUCKETS:
+        return NAMED_BUCKETS[bucket]
+    match = _CUSTOM_BUCKET.match(bucket)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid bucket {bucket!r}, use minute, hour, day or e.g. 15m, 6h, 7d")
+    return int(match.group(1)) * _UNIT_MINUTES[match.group(2)]
+
+
+def parse_timezone(name: str) -> ZoneInfo:
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone {name!r}")
+
+
+def to_epoch_minute(value: datetime, tz: ZoneInfo) -> int:
+    """Minutes since the epoch in UTC; naive values are wall-clock times in tz."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz)
+    value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(minutes=1)
+
+
+def utc_offsets(tz: ZoneInfo, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The UTC offsets of tz in effect over [start, end), in epoch minutes.
+
+    Returns (change points, offsets in minutes), starting at start. The zone is
+    sampled once a day and bisected to the minute where two samples differ, so
+    per-minute data can then be shifted with a single searchsorted.
+    """
+    def offset(minute: int) -> int:
+        return int(datetime.fromtimestamp(minute * 60, tz).utcoffset() // timedelta(minutes=1))
+
+    points = [start]
+    offsets = [offset(start)]
+    day = start
+    while day < end:
+        next_day = min(day + 1440, end)
+        next_offset = offset(next_day)
+        if next_offset != offsets[-1]:
+            lo, hi = day, next_day
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if offset(mid) == offsets[-1]:
+                    lo = mid
+                else:
+                    hi = mid
+            points.append(hi)
+            offsets.append(next_offset)
+        day = next_day
+    return np.array(points, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+
+def bucket_counts(
+    minutes: np.ndarray, counts: np.ndarray, start: int, end: int, size: int, tz: ZoneInfo
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Re-bucket per-minute counts over [start, end) into size-minute buckets of local time.
+
+    Buckets are aligned to local midnight when size divides a day. Returns the
+    local start of every bucket (datetime64[m]) and its count, with empty
+    buckets filled with zeros. Across a DST change the repeated hour falls into
+    the same buckets and the skipped hour's buckets stay empty.
+    """
+    points, offsets = utc_offsets(tz, start, end)
+    local = minutes + offsets[np.searchsorted(points, minutes, side="right") - 1]
+    # Local time is not monotonic when clocks go back, so every offset change
+    # can widen the range at either end
+    lows = np.append(points + offsets, start + offsets[0])
+    highs = np.append(points[1:] - 1 + offsets[:-1], end - 1 + offsets[-1])
+    first = int(lows.min()) // size
+    last = int(highs.max()) // size
+    index = local // size - first
+    totals = np.bincount(index, weights=counts, minlength=last - first + 1).astype(np.int64)
+    starts = ((first + np.arange(last - first + 1)) * size).astype("datetime64[m]")
+    return starts, totals
+
+
+def get_minute_counts(db: Session, short_url: str, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Clicks per minute in [start, end), from the minute rollups plus the not yet rolled up tail."""
+    minute = minute_bucket("timestamp")
+    rows = db.execute(
+        text(f"""
+            SELECT minute, sum(clicks) FROM (
+                SELECT minute, clicks FROM click_minute_rollups
+                WHERE short_url = :short_url AND minute >= :start AND minute < :end
+                UNION ALL
+                SELECT {minute} AS minute, 1 FROM click_events
+                WHERE short_url = :short_url AND id > :last_id
+                    AND timestamp >= :start AND timestamp < :end
+            ) AS merged
+            GROUP BY minute
+        """),
+        {
+            "short_url": short_url,
+            "last_id": rolled_up_event_id(db, MINUTE_ROLLUP_NAME),
+            "start": _EPOCH + timedelta(minutes=start),
+            "end": _EPOCH + timedelta(minutes=end),
+        }
+    ).all()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    buckets, clicks = zip(*rows)
+    # SQLite returns the truncated timestamps as text, Postgres as datetimes
+    minutes = np.array(buckets, dtype="datetime64[m]").astype(np.int64)
+    return minutes, np.array(clicks, dtype=np.int64)
+
+
+def _cache_key(short_url: str, start: int, end: int, size: int, tz: ZoneInfo) -> str:
+    return f"timeseries:{short_url}:{start}:{end}:{size}:{tz.key}"
+
+
+async def get_timeseries(
+    db: Session, short_url: str, start: datetime, end: datetime, bucket: str, tz_name: str
+) -> Dict[str, Any]:
+    """Clicks per bucket between two times. Raises ValueError for invalid parameters."""
+    global cache_hits, cache_misses
+    size = parse_bucket(bucket)
+    tz = parse_timezone(tz_name)
+    start_minute = to_epoch_minute(start, tz)
+    end_minute = to_epoch_minute(end, tz)
+    if end_minute <= start_minute:
+        raise ValueError("to must be after from")
+    if end_minute - start_minute > TIMESERIES_MAX_DAYS * 1440:
+        raise ValueError(f"Range is limited to {TIMESERIES_MAX_DAYS} days")
+    if (end_minute - start_minute) // size > TIMESERIES_MAX_BUCKETS:
+        raise ValueError(f"Range is limited to {TIMESERIES_MAX_BUCKETS} buckets")
+
+    closed = end_minute * 60 <= time.time() - TIMESERIES_CLOSED_AFTER
+    key = _cache_key(short_url, start_minute, end_minute, size, tz)
+    if closed:
+        try:
+            cached = await redis_client.get(key)
+        except Exception as e:
+            logger.error(f"Error reading cached time series: {e}")
+            cached = None
+        if cached:
+            cache_hits += 1
+            return json.loads(cached)
+        cache_misses += 1
+
+    minutes, counts = await run_in_threadpool(get_minute_counts, db, short_url, start_minute, end_minute)
+    starts, totals = bucket_counts(minutes, counts, start_minute, end_minute, size, tz)
+    labels = np.datetime_as_string(starts, unit="m")
+    result = {
+        "short_url": short_url,
+        "from": datetime.fromtimestamp(start_minute * 60, tz).isoformat(),
+        "to": datetime.fromtimestamp(end_minute * 60, tz).isoformat(),
+        "bucket": bucket,
+        "bucket_minutes": size,
+        "timezone": tz.key,
+        "total_clicks": int(totals.sum()),
+        "buckets": [
+            {"start": label, "clicks": clicks}
+            for label, clicks in zip(labels.tolist(), totals.tolist())
+        ],
+    }
+
+    if closed:
+        try:
+            await redis_client.set(key, json.dumps(result), ex=TIMESERIES_CACHE_TTL)
+        except Exception as e:
+            logger.error(f"Error caching time series: {e}")
+    return result
+
+
+def stats() -> Dict[str, Any]:
+    return {"cache_hits": cache_hits, "cache_misses": cache_misses}
@@ -0,0 +1,233 @@
+import os
+import asyncio
+import logging
+import hashlib
+import string
+from collections import deque
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from cache import async_redis_client
+from database import engine, async_engine, DATABASE_URL
+
+logger = logging.getLogger("url-shortener-api")
+
+# Where ID blocks are leased from: "postgres" (sequence, the default on Postgres)
+# or "redis" (INCRBY). Redis only keeps the counter as durable as its fsync
+# policy; a lost counter is reseeded from the urls table, a rewound one is not.
+CODE_ALLOCATOR = os.getenv(
+    "CODE_ALLOCATOR", "postgres" if DATABASE_URL.startswith("postgresql") else "redis"
+)
+CODE_BLOCK_SIZE = int(os.getenv("CODE_BLOCK_SIZE", "1000"))
+# Shortest code handed out. Legacy random codes are 6 characters, so new
+# codes start at 7 to stay clear of them; fresh installs can go lower.
+CODE_MIN_LENGTH = int(os.getenv("CODE_MIN_LENGTH", "7"))
+# Must never change once codes have been issued, or new codes may collide
+CODE_PERMUTATION_KEY = os.getenv("CODE_PERMUTATION_KEY", "url-shortener")
+# IDs skipped when reseeding a lost Redis counter, past blocks that other
+# processes leased before the loss and have not used yet
+CODE_RESEED_MARGIN = int(os.getenv("CODE_RESEED_MARGIN", "1000000"))
+
+REDIS_ID_KEY = "codes:next_id"
+ID_SEQUENCE = "url_code_seq"
+
+ALPHABET = string.digits + string.ascii_letters
+BASE = len(ALPHABET)
+FEISTEL_ROUNDS = 8
+
+
+class CodePermutation:
+    """Reversible mapping between integer IDs and fixed-length base62 codes.
+
+    IDs fill code lengths in order: the first 62**min_length IDs get codes of
+    min_length characters, the next 62**(min_length+1) get one character more,
+    and so on. Within a length, a keyed Feistel network over the two halves
+    of the digits scrambles the order so that consecutive IDs do not produce
+    similar-looking codes.
+    """
+
+    def __init__(self, key: str, min_length: int):
+        self.key = key.encode()
+        self.min_length = min_length
+
+    def _round(self, i: int, value: int, modulus: int) -> int:
+        digest = hashlib.blake2b(
+            value.to_bytes(16, "big"), digest_size=8, key=self.key, person=bytes([i]) * 16
+        ).digest()
+        return int.from_bytes(digest, "big") % modulus
+
+    def _split(self, length: int) -> Tuple[int, int]:
+        left = BASE ** ((length + 1) // 2)
+        right = BASE ** (length // 2)
+        return left, right
+
+    def _permute(self, index: int, length: int) -> int:
+        left_size, right_size = self._split(length)
+        a, b = divmod(index, right_size)
+        for i in range(FEISTEL_ROUNDS):
+            if i % 2 == 0:
+                a = (a + self._round(i, b, left_size)) % left_size
+            else:
+                b = (b + self._round(i, a, right_size)) % right_size
+        return a * right_size + b
+
+    def _unpermute(self, index: int, length: int) -> int:
+        left_size, right_size = self._split(length)
+        a, b = divmod(index, right_size)
+        for i in reversed(range(FEISTEL_ROUNDS)):
+            if i % 2 == 0:
+                a = (a - self._round(i, b, left_size)) % left_size
+            else:
+                b = (b - self._round(i, a, right_size)) % right_size
+        return a * right_size + b
+
+    def encode(self, id_: int) -> str:
+        """Map a non-negative ID to its short code."""
+        length = self.min_length
+        while id_ >= BASE ** length:
+            id_ -= BASE ** length
+            length += 1
+        value = self._permute(id_, length)
+        chars = []
+        for _ in range(length):
+            value, digit = divmod(value, BASE)
+            chars.append(ALPHABET[digit])
+        return "".join(reversed(chars))
+
+    def decode(self, code: str) -> int:
+        """Map a short code back to its ID."""
+        length = len(code)
+        if length < self.min_length:
+            raise ValueError(f"Code shorter than {self.min_length} characters: {code}")
+        value = 0
+        for char in code:
+            value = value * BASE + ALPHABET.index(char)
+        id_ = self._unpermute(value, length)
+        for shorter in range(self.min_length, length):
+            id_ += BASE ** shorter
+        return id_
+
+
+def next_free_id(conn: Connection, permutation: CodePermutation) -> int:
+    """One past the highest allocator ID among the codes in the urls table.
+
+    Longer codes always hold higher IDs, so only the longest length with a
+    decodable code is read. Codes that do not decode, such as legacy random
+    ones, are skipped.
+    """
+    lengths = conn.execute(
+        text("""
+            SELECT DISTINCT length(short_url) FROM urls
+            WHERE length(short_url) >= :min_length ORDER BY 1 DESC
+        """),
+        {"min_length": permutation.min_length}
+    ).scalars().all()
+    for length in lengths:
+        highest = -1
+        codes = conn.execute(
+            text("SELECT short_url FROM urls WHERE length(short_url) = :length"),
+            {"length": length}
+        ).scalars()
+        for code in codes:
+            try:
+                highest = max(highest, permutation.decode(code))
+            except ValueError:
+                continue
+        if highest >= 0:
+            return highest + 1
+    return 0
+
+
+# INCRBY that refuses to recreate a missing counter from zero
+INCRBY_EXISTING_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return false
+"""
+
+
+class RedisIdSource:
+    """Leases contiguous ID blocks with INCRBY on a shared counter.
+
+    If Redis lost the counter, it is reseeded past the highest code in the
+    urls table instead of starting over and handing out existing codes.
+    """
+
+    def __init__(self, permutation: CodePermutation):
+        self.permutation = permutation
+        self._incrby = async_redis_client.register_script(INCRBY_EXISTING_SCRIPT)
+
+    def _find_start(self) -> int:
+        with engine.connect() as conn:
+            return next_free_id(conn, self.permutation)
+
+    async def _reseed(self) -> None:
+        start = await asyncio.to_thread(self._find_start)
+        if start:
+            start += CODE_RESEED_MARGIN
+        # Concurrent reseeds agree on the first one; a fresh install starts at 0
+        if await async_redis_client.set(REDIS_ID_KEY, start, nx=True) and start:
+            logger.warning(f"Code counter missing from Redis, reseeded at {start}")
+
+    async def lease(self, count: int) -> List[int]:
+        end = await self._incrby(keys=[REDIS_ID_KEY], args=[count])
+        if end is None:
+            await self._reseed()
+            end = await self._incrby(keys=[REDIS_ID_KEY], args=[count])
+        return list(range(end - count, end))
+
+
+class SequenceIdSource:
+    """Leases IDs from a Postgres sequence in a single round trip.
+
+    The sequence is created and seeded by migrations.py.
+    """
+
+    async def lease(self, count: int) -> List[int]:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(
+                text(f"SELECT nextval('{ID_SEQUENCE}') FROM generate_series(1, :count)"),
+                {"count": count}
+            )
+            return [row[0] for row in result]
+
+
+class CodeAllocator:
+    """Hands out unique short codes from locally leased blocks of IDs."""
+
+    def __init__(self, source, permutation: CodePermutation, block_size: int):
+        self.source = source
+        self.permutation = permutation
+        self.block_size = block_size
+        self._ids: deque = deque()
+        self._lock = asyncio.Lock()
+
+    async def allocate_many(self, count: int) -> List[str]:
+        """Allocate `count` unique codes."""
+        async with self._lock:
+            if len(self._ids) < count:
+                needed = count - len(self._ids)
+                lease = max(self.block_size, needed)
+                self._ids.extend(await self.source.lease(lease))
+            return [self.permutation.encode(self._ids.popleft()) for _ in range(count)]
+
+    async def allocate(self) -> str:
+        """Allocate a single unique code."""
+        return (await self.allocate_many(1))[0]
+
+
+def create_allocator() -> CodeAllocator:
+    permutation = CodePermutation(CODE_PERMUTATION_KEY, CODE_MIN_LENGTH)
+    if CODE_ALLOCATOR == "postgres":
+        source = SequenceIdSource()
+    elif CODE_ALLOCATOR == "redis":
+        source = RedisIdSource(permutation)
+    else:
+        raise ValueError(f"Unknown CODE_ALLOCATOR: {CODE_ALLOCATOR}")
+    return CodeAllocator(source, permutation, CODE_BLOCK_SIZE)
+
+
+code_allocator = create_allocator()
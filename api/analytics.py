@@ -1,22 +1,208 @@
 import httpx
 import asyncio
+import logging
+import os
+import random
+from collections import deque
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
-# Analytics service URL
-ANALYTICS_URL = "http://analytics:8001/events/click"
+logger = logging.getLogger("url-shortener-api")
 
-async def send_click_event(
+# Analytics service bulk ingestion URL
+ANALYTICS_BATCH_URL = os.getenv("ANALYTICS_BATCH_URL", "http://analytics:8001/events/click/batch")
+
+# Buffer settings
+ANALYTICS_BUFFER_SIZE = int(os.getenv("ANALYTICS_BUFFER_SIZE", "10000"))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "500"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "1.0"))
+# What to do when the buffer is full: "drop_new" or "drop_old"
+ANALYTICS_OVERFLOW_POLICY = os.getenv("ANALYTICS_OVERFLOW_POLICY", "drop_new")
+# Once the buffer is past the high-water mark, keep only this fraction of events
+ANALYTICS_SAMPLE_RATE = float(os.getenv("ANALYTICS_SAMPLE_RATE", "1.0"))
+ANALYTICS_HIGH_WATER = float(os.getenv("ANALYTICS_HIGH_WATER", "0.75"))
+# Longest pause (seconds) after analytics pushes back without a Retry-After
+ANALYTICS_MAX_BACKOFF = float(os.getenv("ANALYTICS_MAX_BACKOFF", "30"))
+
+
+class ClickEventBuffer:
+    """Bounded in-process buffer that ships click events to analytics in batches."""
+
+    def __init__(
+        self,
+        url: str,
+        max_size: int,
+        batch_size: int,
+        flush_interval: float,
+        overflow_policy: str = "drop_new",
+        sample_rate: float = 1.0,
+        high_water: float = 0.75,
+        max_backoff: float = 30.0
+    ):
+        self.url = url
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self.high_water_mark = int(max_size * high_water)
+        self.max_backoff = max_backoff
+        self._events: deque = deque()
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+        self.backoffs = 0
+        self._backoff_attempts = 0
+        self._resume_at = 0.0
+
+    def add(self, event: Dict[str, Any]) -> bool:
+        """Queue an event. Returns False if it was dropped or sampled out."""
+        if len(self._events) >= self.high_water_mark and self.sample_rate < 1.0:
+            if random.random() >= self.sample_rate:
+                self.sampled_out += 1
+                return False
+        if len(self._events) >= self.max_size:
+            if self.overflow_policy == "drop_old":
+                self._events.popleft()
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return False
+        self._events.append(event)
+        if len(self._events) >= self.batch_size and self._batch_ready:
+            self._batch_ready.set()
+        return True
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        batch = []
+        while self._events and len(batch) < self.batch_size:
+            batch.append(self._events.popleft())
+        return batch
+
+    def _requeue(self, batch: List[Dict[str, Any]]) -> None:
+        # Put a rejected batch back at the front, as far as the buffer has room
+        room = max(self.max_size - len(self._events), 0)
+        if room < len(batch):
+            self.dropped += len(batch) - room
+            batch = batch[:room]
+        self._events.extendleft(reversed(batch))
+
+    def _back_off(self, response: httpx.Response) -> None:
+        """Pause flushing for the Retry-After delay, or exponentially longer each time."""
+        self._backoff_attempts += 1
+        self.backoffs += 1
+        try:
+            delay = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            delay = self.flush_interval * 2 ** (self._backoff_attempts - 1)
+        self._resume_at = asyncio.get_running_loop().time() + min(max(delay, 0.0), self.max_backoff)
+
+    async def _send(self, batch: List[Dict[str, Any]]) -> bool:
+        """Post a batch. Returns False if analytics asked us to back off."""
+        try:
+            response = await self._client.post(self.url, json={"events": batch})
+            if response.status_code in (429, 503):
+                # Analytics is applying backpressure; retry once the pause is over
+                self._requeue(batch)
+                self._back_off(response)
+                return False
+            self._backoff_attempts = 0
+            if response.status_code >= 400:
+                self.failed += len(batch)
+                logger.error(
+                    f"Error sending analytics batch: {response.status_code} - {response.text}"
+                )
+            else:
+                self.sent += len(batch)
+        except Exception as e:
+            # Log the error but never fail a redirect because of analytics
+            self.failed += len(batch)
+            logger.error(f"Error sending analytics batch of {len(batch)} events: {e}")
+        return True
+
+    async def flush(self) -> None:
+        """Send everything currently buffered."""
+        while self._events:
+            if not await self._send(self._take_batch()):
+                break
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            pause = self._resume_at - asyncio.get_running_loop().time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.flush()
+
+    def start(self) -> None:
+        """Open the pooled client and start the background flusher."""
+        if self._task and not self._task.done():
+            return
+        self._batch_ready = asyncio.Event()
+        self._client = httpx.AsyncClient(
+            timeout=2.0,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flusher, ship what is left and close the client."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client:
+            await self.flush()
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the buffer counters."""
+        return {
+            "queued": len(self._events),
+            "max_size": self.max_size,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "failed": self.failed,
+            "backoffs": self.backoffs,
+        }
+
+
+click_buffer = ClickEventBuffer(
+    ANALYTICS_BATCH_URL,
+    max_size=ANALYTICS_BUFFER_SIZE,
+    batch_size=ANALYTICS_BATCH_SIZE,
+    flush_interval=ANALYTICS_FLUSH_INTERVAL,
+    overflow_policy=ANALYTICS_OVERFLOW_POLICY,
+    sample_rate=ANALYTICS_SAMPLE_RATE,
+    high_water=ANALYTICS_HIGH_WATER,
+    max_backoff=ANALYTICS_MAX_BACKOFF
+)
+
+
+def send_click_event(
     short_url: str,
     referrer: Optional[str] = None,
     user_agent: Optional[str] = None,
     ip_address: Optional[str] = None,
     country: Optional[str] = None
 ) -> None:
-    """Send a click event to the analytics service."""
+    """Queue a click event for the analytics service."""
     # Format the timestamp as a string to avoid serialization issues
     current_time = datetime.utcnow().isoformat()
-    
+
     event_data = {
         "short_url": short_url,
         "timestamp": current_time,
@@ -25,12 +211,5 @@ async def send_click_event(
         "ip_address": ip_address or "",
         "country": country or ""
     }
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(ANALYTICS_URL, json=event_data, timeout=2.0)
-            if response.status_code >= 400:
-                print(f"Error sending analytics event: {response.status_code} - {response.text}")
-    except Exception as e:
-        # Log the error but don't fail the request
-        print(f"Error sending analytics event: {e}") 
\ No newline at end of file
+
+    click_buffer.add(event_data)
@@ -1,19 +1,40 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, HttpUrl
+from fastapi.responses import StreamingResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from pydantic import BaseModel, HttpUrl, Field
 from sqlalchemy.orm import Session
-import random
-import string
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, text, insert
 import uvicorn
-from typing import Optional, Dict, Any
-import asyncio
+from typing import Optional, Dict, Any, List, Literal
+import json
 import logging
 import os
-import psycopg2
+import math
 
-from database import get_db, URL, create_tables, DATABASE_URL
-from cache import get_cache, set_cache, delete_cache, increment_counter
-from analytics import send_click_event
+from database import get_db, get_async_db, URL, async_engine
+from cache import (
+    increment_click_counter_async, async_redis_client,
+    count_dirty_clicks, mark_all_clicks_dirty, pop_dirty_clicks, restore_clicks,
+    get_pending_clicks_async, hot_keys
+)
+from local_cache import (
+    url_cache, publish_invalidation, publish_invalidations, start_invalidation_listener,
+    stop_invalidation_listener
+)
+from analytics import send_click_event, click_buffer
+from allocator import code_allocator
+from bloom import url_filter
+from lookup import lookup_url, make_entry, loads, URL_CACHE_HARD_TTL
+from url_store import set_url_entry, set_url_entries, migrate_to_compact, URL_CACHE_LAYOUT
+from metrics import MetricsMiddleware, register_stats
+from warmup import cache_warmer
+from migrations import schema_is_current, run_migrations
+from redirects import (
+    wants_json, redirect_response, json_response, estimate_clicks, make_etag, etag_matches,
+    EDGE_MAX_HITS, EDGE_MIN_SAMPLE_RATE
+)
 
 # Create logs directory if it doesn't exist
 os.makedirs("logs", exist_ok=True)
@@ -29,6 +50,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger("url-shortener-api")
 
+# Number of short URLs written per UPDATE when syncing click counts
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", "1000"))
+
+# Limits for bulk URL creation
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "50000"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+
+# Largest value of the INTEGER urls.clicks column; click totals saturate there
+MAX_CLICKS = 2 ** 31 - 1
+
 app = FastAPI(title="URL Shortener API")
 
 # Configure CORS
@@ -40,197 +71,352 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create database tables on startup
+# Per-route latency histograms for /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Counters the cache, click buffer and single-flight loader already keep, read at scrape time
+register_stats("url_cache", url_cache.stats, ["hits", "misses", "evictions", "expirations", "invalidations"])
+register_stats("click_buffer", click_buffer.stats, ["sent", "dropped", "sampled_out", "failed", "backoffs"])
+register_stats("single_flight", lambda: {"shared": loads.shared}, ["shared"])
+register_stats("warmup", cache_warmer.stats, ["runs", "local_fills", "failures"])
+
+# Schema changes are applied once per deploy by migrations.py; on startup this
+# is a single version query unless a process finds the schema behind
 @app.on_event("startup")
 def startup_event():
-    create_tables()
-    # Run migration to add expired column
-    try:
-        # Connect to the database
-        conn = psycopg2.connect(DATABASE_URL)
-        conn.autocommit = True
-        cursor = conn.cursor()
-        
-        # Check if column already exists
-        cursor.execute("""
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name='urls' AND column_name='expired';
-        """)
-        
-        if cursor.fetchone() is None:
-            # Add the expired column
-            cursor.execute("""
-                ALTER TABLE urls 
-                ADD COLUMN expired BOOLEAN DEFAULT FALSE;
-            """)
-            logger.info("Added 'expired' column to urls table")
-        else:
-            logger.info("Column 'expired' already exists")
-            
-        # Close connection
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error running migration: {e}")
+    if not schema_is_current():
+        logger.warning("Database schema is behind, running migrations")
+        run_migrations()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # Keep the in-process cache coherent with the other replicas
+    start_invalidation_listener()
+    click_buffer.start()
+    # Build the shared Bloom filter in the background if no replica has yet,
+    # and again whenever Redis loses it
+    url_filter.start()
+    # Preload the most clicked links while already serving
+    cache_warmer.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await cache_warmer.stop()
+    await url_filter.stop()
+    await stop_invalidation_listener()
+    # Ship buffered click events before exiting
+    await click_buffer.stop()
+    await async_redis_client.close()
+    await async_engine.dispose()
 
 class URLBase(BaseModel):
     target_url: HttpUrl
+    # Redirect status and Cache-Control max-age for this link; None uses the defaults
+    redirect_status: Optional[Literal[301, 302, 307, 308]] = None
+    cache_max_age: Optional[int] = Field(None, ge=0)
 
 class URLInfo(BaseModel):
     target_url: str
     short_url: str
     clicks: int
+    redirect_status: Optional[int] = None
+    cache_max_age: Optional[int] = None
 
     class Config:
         orm_mode = True
 
-def generate_short_url(length: int = 6) -> str:
-    """Generate a random short URL of specified length."""
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
-
 @app.get("/")
 def read_root():
+    """Health check; not ready until the cache warm-up has loaded enough popular links."""
+    if not cache_warmer.ready:
+        raise HTTPException(
+            status_code=503, detail={"message": "Warming up cache", **cache_warmer.stats()}
+        )
     return {"message": "Welcome to URL Shortener API"}
 
 @app.post("/url", response_model=URLInfo)
-def create_url(url: URLBase, db: Session = Depends(get_db)):
+async def create_url(url: URLBase, db: AsyncSession = Depends(get_async_db)):
     """Create a short URL from a target URL."""
-    short_url = generate_short_url()
-    
-    # Ensure the short URL is unique
-    while db.query(URL).filter(URL.short_url == short_url).first():
-        short_url = generate_short_url()
+    # Codes come from leased ID blocks, so they are unique without a lookup
+    short_url = await code_allocator.allocate()
     
     # Create new URL record
     db_url = URL(
         target_url=str(url.target_url),
         short_url=short_url,
-        clicks=0
+        clicks=0,
+        redirect_status=url.redirect_status,
+        cache_max_age=url.cache_max_age
     )
     
     # Save to database
     db.add(db_url)
-    db.commit()
-    db.refresh(db_url)
+    await db.commit()
+    await db.refresh(db_url)
     
     # Cache the URL data
-    cache_data = {
-        "target_url": db_url.target_url,
-        "short_url": db_url.short_url,
-        "clicks": db_url.clicks
-    }
-    set_cache(f"url:{short_url}", cache_data)
+    await set_url_entry(
+        make_entry(
+            db_url.target_url, db_url.short_url,
+            redirect_status=db_url.redirect_status, cache_max_age=db_url.cache_max_age
+        ),
+        URL_CACHE_HARD_TTL
+    )
+    await url_filter.add_many([short_url])
+    await publish_invalidation(short_url)
     
     return db_url
 
-@app.get("/{short_url}")
-async def redirect_to_url(
-    short_url: str, 
-    request: Request, 
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+async def insert_urls(db: AsyncSession, urls: List[URLBase]) -> List[Dict[str, Any]]:
+    """Allocate codes for a list of URLs and insert them in multi-row INSERTs (not committed)."""
+    codes = await code_allocator.allocate_many(len(urls))
+    rows = [
+        {
+            "target_url": str(url.target_url), "short_url": code, "clicks": 0,
+            "redirect_status": url.redirect_status, "cache_max_age": url.cache_max_age
+        }
+        for url, code in zip(urls, codes)
+    ]
+    for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+        await db.execute(insert(URL), rows[start:start + BATCH_CHUNK_SIZE])
+    return rows
+
+async def cache_urls(rows: List[Dict[str, Any]]) -> None:
+    """Warm the cache for newly created URLs in one pipeline."""
+    codes = [row["short_url"] for row in rows]
+    await set_url_entries(
+        [
+            make_entry(
+                row["target_url"], row["short_url"],
+                redirect_status=row["redirect_status"], cache_max_age=row["cache_max_age"]
+            )
+            for row in rows
+        ],
+        URL_CACHE_HARD_TTL
+    )
+    await url_filter.add_many(codes)
+    await publish_invalidations(codes)
+
+@app.post("/urls/batch", response_model=List[URLInfo])
+async def create_urls_batch(
+    urls: List[URLBase],
+    stream: bool = False,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Redirect to the target URL for a given short URL."""
-    # Try to get URL from cache first
-    cached_url = get_cache(f"url:{short_url}")
-    
-    if cached_url:
-        # Increment click count in cache
-        increment_counter(f"clicks:{short_url}")
-        
-        # Send analytics event in the background
-        background_tasks.add_task(
-            send_click_event,
-            short_url=short_url,
-            referrer=request.headers.get("referer"),
-            user_agent=request.headers.get("user-agent"),
-            ip_address=request.client.host
+    """Create many short URLs at once. Results are returned in input order."""
+    if len(urls) > BATCH_MAX_URLS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BATCH_MAX_URLS} URLs per batch"
         )
-        
-        return {"target_url": cached_url["target_url"]}
     
-    # If not in cache, get from database
-    db_url = db.query(URL).filter(URL.short_url == short_url).first()
+    if stream:
+        # Commit and emit one chunk at a time as NDJSON
+        async def generate_results():
+            for start in range(0, len(urls), BATCH_CHUNK_SIZE):
+                rows = await insert_urls(db, urls[start:start + BATCH_CHUNK_SIZE])
+                await db.commit()
+                await cache_urls(rows)
+                for row in rows:
+                    yield json.dumps(row) + "\n"
+        return StreamingResponse(generate_results(), media_type="application/x-ndjson")
     
-    if not db_url:
+    rows = await insert_urls(db, urls)
+    await db.commit()
+    await cache_urls(rows)
+    return rows
+
+@app.get("/metrics")
+def get_metrics():
+    """Expose request, cache, Redis and database metrics in Prometheus text format."""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """Get hit, miss and eviction counters for the in-process cache."""
+    return {
+        **url_cache.stats(),
+        "single_flight_shared": loads.shared,
+        "sharded_click_counters": hot_keys.hot_codes(),
+        "warmup": cache_warmer.stats()
+    }
+
+@app.post("/cache/migrate")
+async def migrate_cache_layout():
+    """Move cached URLs from per-link JSON keys into compact hash buckets."""
+    # In the json layout nothing reads the buckets, so migrating would empty the cache
+    if URL_CACHE_LAYOUT != "compact":
+        raise HTTPException(
+            status_code=409, detail="URL_CACHE_LAYOUT must be compact to migrate"
+        )
+    return await migrate_to_compact(URL_CACHE_HARD_TTL)
+
+@app.get("/analytics/stats")
+def get_analytics_buffer_stats():
+    """Get queue depth and sent/dropped counters for the click-event buffer."""
+    return click_buffer.stats()
+
+@app.get("/bloom/stats")
+async def get_bloom_stats():
+    """Get negative cache and Bloom filter counters, including the false-positive rate."""
+    return await url_filter.stats()
+
+@app.post("/bloom/rebuild")
+async def rebuild_bloom_filter():
+    """Rebuild the Bloom filter from the database, e.g. after resizing it."""
+    rebuilt = await url_filter.rebuild()
+    if not rebuilt:
+        raise HTTPException(status_code=409, detail="Bloom filter rebuild already running or failed")
+    return {"message": "Bloom filter rebuilt"}
+
+@app.get("/{short_url}")
+async def redirect_to_url(short_url: str, request: Request, format: Optional[str] = None):
+    """Redirect to the target URL for a given short URL.
+
+    Answers with a 3xx and the link's Cache-Control. Clients that send
+    Accept: application/json or ?format=json get {"target_url": ...} instead.
+    """
+    # In-process cache, then Redis, then a single-flight database load
+    cached_url = await lookup_url(short_url)
+    
+    if not cached_url:
         raise HTTPException(status_code=404, detail="URL not found")
     
-    if db_url.expired:
+    if cached_url.get("expired"):
         raise HTTPException(status_code=410, detail="URL has expired")
     
-    # Increment click count
-    db_url.clicks += 1
-    db.commit()
-    
-    # Cache the URL data
-    cache_data = {
-        "target_url": db_url.target_url,
-        "short_url": db_url.short_url,
-        "clicks": db_url.clicks
-    }
-    set_cache(f"url:{short_url}", cache_data)
+    # Count the click in Redis only; the periodic sync writes it to the database
+    await increment_click_counter_async(short_url)
     
-    # Send analytics event in the background
-    background_tasks.add_task(
-        send_click_event,
+    # Queue analytics event for the batched sender
+    send_click_event(
         short_url=short_url,
         referrer=request.headers.get("referer"),
         user_agent=request.headers.get("user-agent"),
         ip_address=request.client.host
     )
     
-    return {"target_url": db_url.target_url}
+    if wants_json(request, format):
+        return json_response(cached_url)
+    return redirect_response(cached_url)
+
+class EdgeHits(BaseModel):
+    short_url: str
+    hits: int = Field(ge=0, le=EDGE_MAX_HITS)
+    # Fraction of the edge's requests its logs were sampled at
+    sample_rate: float = Field(1.0, ge=EDGE_MIN_SAMPLE_RATE, le=1)
+
+@app.post("/clicks/edge")
+async def record_edge_hits(reports: List[EdgeHits]):
+    """Count redirects an edge or CDN cache answered without reaching the API.
+
+    Hits counted from sampled logs are scaled up by their sample rate. They
+    reach the click counters only; analytics events need the original requests.
+    """
+    if len(reports) > BATCH_MAX_URLS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BATCH_MAX_URLS} reports per batch"
+        )
+    counted = 0
+    unknown = 0
+    for report in reports:
+        if not await lookup_url(report.short_url):
+            unknown += 1
+            continue
+        clicks = estimate_clicks(report.hits, report.sample_rate)
+        if clicks:
+            await increment_click_counter_async(report.short_url, clicks)
+            counted += clicks
+    return {"counted": counted, "unknown": unknown}
 
 @app.get("/stats/{short_url}", response_model=URLInfo)
-def get_url_stats(short_url: str, db: Session = Depends(get_db)):
-    """Get statistics for a short URL."""
-    # Try to get URL from cache first
-    cached_url = get_cache(f"url:{short_url}")
-    cached_clicks = get_cache(f"clicks:{short_url}")
-    
-    if cached_url:
-        # If we have cached clicks, update the cached URL data
-        if cached_clicks:
-            cached_url["clicks"] += int(cached_clicks)
-        return URLInfo(**cached_url)
-    
-    # If not in cache, get from database
-    db_url = db.query(URL).filter(URL.short_url == short_url).first()
+async def get_url_stats(
+    short_url: str, request: Request, db: AsyncSession = Depends(get_async_db)
+):
+    """Get statistics for a short URL. Supports conditional requests with If-None-Match."""
+    # Cache entries only hold the target, so synced clicks come from the database
+    result = await db.execute(
+        select(URL.target_url, URL.clicks, URL.redirect_status, URL.cache_max_age)
+        .where(URL.short_url == short_url)
+    )
+    db_url = result.one_or_none()
     
     if not db_url:
         raise HTTPException(status_code=404, detail="URL not found")
     
-    # Cache the URL data
-    cache_data = {
-        "target_url": db_url.target_url,
-        "short_url": db_url.short_url,
-        "clicks": db_url.clicks
-    }
-    set_cache(f"url:{short_url}", cache_data)
+    # Add clicks that have not been synced to the database yet
+    pending_clicks = await get_pending_clicks_async(short_url)
+    body = URLInfo(
+        target_url=db_url.target_url,
+        short_url=short_url,
+        clicks=db_url.clicks + pending_clicks,
+        redirect_status=db_url.redirect_status,
+        cache_max_age=db_url.cache_max_age
+    ).model_dump_json().encode()
     
-    return db_url
+    # The tag changes with every click; pollers get a bodiless 304 until then
+    etag = make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+def apply_click_counts(db: Session, counts: Dict[str, int]) -> None:
+    """Add click deltas to the database with one set-based UPDATE.
+
+    Totals are clamped to the column's range, so one oversized delta cannot
+    fail the whole chunk.
+    """
+    values = ", ".join(f"(:code{i}, :delta{i})" for i in range(len(counts)))
+    params = {}
+    for i, (short_url, clicks) in enumerate(counts.items()):
+        params[f"code{i}"] = short_url
+        params[f"delta{i}"] = min(clicks, MAX_CLICKS)
+    db.execute(
+        text(f"""
+            WITH deltas(short_url, delta) AS (VALUES {values})
+            UPDATE urls SET clicks = CASE
+                WHEN urls.clicks > {MAX_CLICKS} - deltas.delta THEN {MAX_CLICKS}
+                ELSE urls.clicks + deltas.delta
+            END
+            FROM deltas
+            WHERE urls.short_url = deltas.short_url
+        """),
+        params
+    )
 
 @app.post("/sync-cache")
-def sync_cache_with_db(db: Session = Depends(get_db)):
+def sync_cache_with_db(full: bool = False, db: Session = Depends(get_db)):
     """Synchronize cache click counts with the database."""
-    # This would be called periodically by a background task
-    # For each URL in the database
-    urls = db.query(URL).all()
-    for url in urls:
-        # Get cached click count
-        cached_clicks = get_cache(f"clicks:{url.short_url}")
-        if cached_clicks:
-            # Update database click count
-            url.clicks += int(cached_clicks)
-            # Reset cached click count
-            delete_cache(f"clicks:{url.short_url}")
-    
-    # Commit all updates
-    db.commit()
-    
-    return {"message": "Cache synchronized with database"}
+    # Counters written before the dirty set existed are only found by a full scan
+    if full:
+        mark_all_clicks_dirty()
+    
+    # Only drain what is dirty now; clicks arriving meanwhile wait for the next sync
+    chunks = math.ceil(count_dirty_clicks() / SYNC_CHUNK_SIZE)
+    synced_urls = 0
+    synced_clicks = 0
+    for _ in range(chunks):
+        counts = pop_dirty_clicks(SYNC_CHUNK_SIZE)
+        if counts is None:
+            break
+        if not counts:
+            continue
+        try:
+            apply_click_counts(db, counts)
+            db.commit()
+        except Exception:
+            db.rollback()
+            restore_clicks(counts)
+            raise
+        synced_urls += len(counts)
+        synced_clicks += sum(counts.values())
+    
+    logger.info(f"Synced {synced_clicks} clicks for {synced_urls} URLs")
+    return {
+        "message": "Cache synchronized with database",
+        "urls": synced_urls,
+        "clicks": synced_clicks
+    }
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
@@ -0,0 +1,190 @@
+import os
+import math
+import asyncio
+import hashlib
+import logging
+from typing import List, Dict, Any, Iterable, Optional
+
+from sqlalchemy import select
+
+from cache import async_redis_client
+from metrics import timed_redis
+from database import AsyncSessionLocal, URL
+
+logger = logging.getLogger("url-shortener-api")
+
+# Bloom filter sizing: the false-positive rate holds up to the expected item count
+BLOOM_EXPECTED_ITEMS = int(os.getenv("BLOOM_EXPECTED_ITEMS", "10000000"))
+BLOOM_FP_RATE = float(os.getenv("BLOOM_FP_RATE", "0.01"))
+# How long a confirmed 404 is remembered
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "60"))
+# How often (seconds) each replica checks the filter still exists in Redis and
+# rebuilds it if Redis lost it (restart, failover, eviction)
+BLOOM_CHECK_INTERVAL = float(os.getenv("BLOOM_CHECK_INTERVAL", "30"))
+
+BLOOM_KEY = "bloom:urls"
+BLOOM_READY_KEY = "bloom:urls:ready"
+BLOOM_REBUILD_LOCK = "bloom:urls:rebuilding"
+REBUILD_BATCH_SIZE = 5000
+
+
+def negative_cache_key(short_url: str) -> str:
+    return f"miss:{short_url}"
+
+
+class UrlFilter:
+    """Answers definite misses for unknown short codes without touching the database.
+
+    Combines a Bloom filter of every existing code, kept as a Redis bitmap so
+    all replicas share it, with short-lived negative cache entries for codes
+    the database has already reported missing.
+    """
+
+    def __init__(self, key: str, expected_items: int, fp_rate: float):
+        self.key = key
+        self.size = max(int(-expected_items * math.log(fp_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / expected_items * math.log(2)), 1)
+        self.checks = 0
+        self.negative_hits = 0
+        self.definite_misses = 0
+        self.false_positives = 0
+        self._ready = False
+        self.rebuilds = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _offsets(self, item: str) -> List[int]:
+        # Double hashing: k positions derived from two 64-bit hashes
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def _set_args(self, item: str) -> List[Any]:
+        args = []
+        for offset in self._offsets(item):
+            args.extend(["SET", "u1", offset, 1])
+        return args
+
+    def _get_args(self, item: str) -> List[Any]:
+        args = []
+        for offset in self._offsets(item):
+            args.extend(["GET", "u1", offset])
+        return args
+
+    def add_to_pipeline(self, pipe, items: Iterable[str]) -> None:
+        """Queue filter updates and negative cache removals for new codes."""
+        for item in items:
+            pipe.execute_command("BITFIELD", self.key, *self._set_args(item))
+            pipe.delete(negative_cache_key(item))
+
+    async def add_many(self, items: List[str]) -> None:
+        """Add codes to the filter in one pipelined round trip."""
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            self.add_to_pipeline(pipe, items)
+            await pipe.execute()
+
+    @timed_redis("bloom_check")
+    async def is_missing(self, short_url: str) -> bool:
+        """Return True only if the code is known not to exist."""
+        self.checks += 1
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            pipe.exists(negative_cache_key(short_url))
+            # Ready only while both keys exist: a lost bitmap reads as all zeros
+            pipe.exists(BLOOM_READY_KEY, self.key)
+            pipe.execute_command("BITFIELD", self.key, *self._get_args(short_url))
+            negative, ready, bits = await pipe.execute()
+        ready = ready == 2
+        self._ready = ready
+        if negative:
+            self.negative_hits += 1
+            return True
+        if ready and not all(bits):
+            self.definite_misses += 1
+            return True
+        return False
+
+    async def record_miss(self, short_url: str) -> None:
+        """Remember a code the database did not have."""
+        if self._ready:
+            self.false_positives += 1
+        await async_redis_client.setex(negative_cache_key(short_url), NEGATIVE_CACHE_TTL, 1)
+
+    async def rebuild(self) -> bool:
+        """Rebuild the filter from the urls table. Only one replica rebuilds at a time."""
+        if not await async_redis_client.set(BLOOM_REBUILD_LOCK, 1, nx=True, ex=600):
+            return False
+        try:
+            # Lookups fall back to the database until the filter is complete again
+            await async_redis_client.delete(BLOOM_READY_KEY, self.key)
+            count = 0
+            async with AsyncSessionLocal() as db:
+                result = await db.stream_scalars(
+                    select(URL.short_url).execution_options(yield_per=REBUILD_BATCH_SIZE)
+                )
+                async for codes in result.partitions(REBUILD_BATCH_SIZE):
+                    async with async_redis_client.pipeline(transaction=False) as pipe:
+                        for code in codes:
+                            pipe.execute_command("BITFIELD", self.key, *self._set_args(code))
+                        await pipe.execute()
+                    count += len(codes)
+            # Allocate the whole bitmap, so it exists even when no code was added
+            await async_redis_client.setbit(self.key, self.size - 1, 0)
+            await async_redis_client.set(BLOOM_READY_KEY, count)
+            self.rebuilds += 1
+            logger.info(f"Rebuilt Bloom filter with {count} short URLs")
+            return True
+        except Exception as e:
+            logger.error(f"Error rebuilding Bloom filter: {e}")
+            return False
+        finally:
+            await async_redis_client.delete(BLOOM_REBUILD_LOCK)
+
+    async def ensure_ready(self) -> None:
+        """Build the filter if no replica has built it yet, or Redis lost either key."""
+        if await async_redis_client.exists(BLOOM_READY_KEY, self.key) < 2:
+            await self.rebuild()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.ensure_ready()
+            except Exception as e:
+                logger.error(f"Error checking Bloom filter: {e}")
+            await asyncio.sleep(BLOOM_CHECK_INTERVAL)
+
+    def start(self) -> None:
+        """Build the filter in the background if needed, and rebuild it whenever Redis loses it."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def stats(self) -> Dict[str, Any]:
+        """Return lookup counters plus observed and estimated false-positive rates."""
+        ready = await async_redis_client.exists(BLOOM_READY_KEY, self.key) == 2
+        bits_set = await async_redis_client.bitcount(self.key)
+        fill_ratio = bits_set / self.size
+        unknown = self.definite_misses + self.false_positives
+        return {
+            "ready": bool(ready),
+            "size_bits": self.size,
+            "hashes": self.hashes,
+            "fill_ratio": fill_ratio,
+            "estimated_fp_rate": fill_ratio ** self.hashes,
+            "observed_fp_rate": self.false_positives / unknown if unknown else 0.0,
+            "checks": self.checks,
+            "negative_cache_hits": self.negative_hits,
+            "definite_misses": self.definite_misses,
+            "false_positives": self.false_positives,
+            "rebuilds": self.rebuilds,
+        }
+
+
+url_filter = UrlFilter(BLOOM_KEY, BLOOM_EXPECTED_ITEMS, BLOOM_FP_RATE)
@@ -1,21 +1,49 @@
 import os
 import json
+import random
+import time
 import redis
-from typing import Optional, Any
+import redis.asyncio
+from typing import Optional, Any, Dict, List
+
+from metrics import timed_redis, record_lookup
 
 # Get Redis URL from environment variable or use a default
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-# Create Redis client
+# Create Redis clients: the async one is used on the request path so that
+# cache round trips do not block the event loop
 redis_client = redis.from_url(REDIS_URL)
+async_redis_client = redis.asyncio.from_url(REDIS_URL)
+
+# Set of short codes whose click counter changed since the last sync
+DIRTY_CLICKS_KEY = "clicks:dirty"
+# Set of short codes that may have shard counters; only these are drained
+# shard by shard, the rest with a single GETDEL. Must match the worker
+SHARDED_CLICKS_KEY = "clicks:sharded"
+
+# Reads and drains always cover this many shard keys, whatever CLICK_COUNTER_SHARDS
+# each replica runs with, so changing that setting never strands clicks in a
+# shard nobody drains. Must match the worker
+CLICK_COUNTER_MAX_SHARDS = 32
+# A code clicked more than HOT_CLICK_THRESHOLD times within HOT_CLICK_WINDOW
+# seconds on one replica spreads its counter over CLICK_COUNTER_SHARDS keys
+# for at least HOT_CLICK_HOLD seconds, so no single Redis key takes every hit
+CLICK_COUNTER_SHARDS = min(int(os.getenv("CLICK_COUNTER_SHARDS", "8")), CLICK_COUNTER_MAX_SHARDS)
+HOT_CLICK_THRESHOLD = int(os.getenv("HOT_CLICK_THRESHOLD", "200"))
+HOT_CLICK_WINDOW = float(os.getenv("HOT_CLICK_WINDOW", "1"))
+HOT_CLICK_HOLD = float(os.getenv("HOT_CLICK_HOLD", "60"))
 
+@timed_redis("get")
 def get_cache(key: str) -> Optional[Any]:
     """Get a value from the cache."""
     data = redis_client.get(key)
+    record_lookup("redis", bool(data))
     if data:
         return json.loads(data)
     return None
 
+@timed_redis("set")
 def set_cache(key: str, value: Any, expiration: int = 3600) -> None:
     """Set a value in the cache with expiration in seconds."""
     redis_client.setex(key, expiration, json.dumps(value))
@@ -26,4 +54,163 @@ def delete_cache(key: str) -> None:
 
 def increment_counter(key: str) -> int:
     """Increment a counter in Redis."""
-    return redis_client.incr(key) 
\ No newline at end of file
+    return redis_client.incr(key)
+
+@timed_redis("get")
+async def get_cache_async(key: str) -> Optional[Any]:
+    """Get a value from the cache without blocking the event loop."""
+    data = await async_redis_client.get(key)
+    record_lookup("redis", bool(data))
+    if data:
+        return json.loads(data)
+    return None
+
+@timed_redis("set")
+async def set_cache_async(key: str, value: Any, expiration: int = 3600) -> None:
+    """Set a value in the cache with expiration in seconds without blocking the event loop."""
+    await async_redis_client.setex(key, expiration, json.dumps(value))
+
+async def set_many_cache_async(items: Dict[str, Any], expiration: int = 3600) -> None:
+    """Set several values in one pipelined round trip."""
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for key, value in items.items():
+            pipe.setex(key, expiration, json.dumps(value))
+        await pipe.execute()
+
+async def delete_cache_async(key: str) -> None:
+    """Delete a value from the cache without blocking the event loop."""
+    await async_redis_client.delete(key)
+
+async def increment_counter_async(key: str) -> int:
+    """Increment a counter in Redis without blocking the event loop."""
+    return await async_redis_client.incr(key)
+
+class HotKeyTracker:
+    """Counts clicks per short code in fixed windows to spot codes hot enough to shard."""
+
+    def __init__(self, threshold: int, window: float, hold: float):
+        self.threshold = threshold
+        self.window = window
+        self.hold = hold
+        self._window_start = time.monotonic()
+        self._counts: Dict[str, int] = {}
+        self._hot_until: Dict[str, float] = {}
+
+    def record(self, short_url: str) -> bool:
+        """Count one click and return whether the code's counter should be sharded."""
+        now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self._counts.clear()
+            self._window_start = now
+            # Forget codes that cooled down
+            self._hot_until = {code: until for code, until in self._hot_until.items() if until > now}
+        count = self._counts.get(short_url, 0) + 1
+        self._counts[short_url] = count
+        if count > self.threshold:
+            self._hot_until[short_url] = now + self.hold
+        return self._hot_until.get(short_url, 0) > now
+
+    def hot_codes(self) -> int:
+        now = time.monotonic()
+        return sum(1 for until in self._hot_until.values() if until > now)
+
+hot_keys = HotKeyTracker(HOT_CLICK_THRESHOLD, HOT_CLICK_WINDOW, HOT_CLICK_HOLD)
+
+def click_counter_keys(short_url: str) -> List[str]:
+    """The base click counter key of a short URL followed by its shard keys."""
+    return [f"clicks:{short_url}"] + [
+        f"clicks:{short_url}:{shard}" for shard in range(CLICK_COUNTER_MAX_SHARDS)
+    ]
+
+@timed_redis("increment_clicks")
+async def increment_click_counter_async(short_url: str, amount: int = 1) -> None:
+    """Add clicks to the counter of a short URL and mark it for the next sync."""
+    key = f"clicks:{short_url}"
+    sharded = CLICK_COUNTER_SHARDS > 0 and hot_keys.record(short_url)
+    if sharded:
+        key = f"{key}:{random.randrange(CLICK_COUNTER_SHARDS)}"
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        pipe.incrby(key, amount)
+        if sharded:
+            # Before the dirty mark, so whoever pops the code also sees it is sharded
+            pipe.sadd(SHARDED_CLICKS_KEY, short_url)
+        pipe.sadd(DIRTY_CLICKS_KEY, short_url)
+        await pipe.execute()
+
+@timed_redis("pending_clicks")
+async def get_pending_clicks_async(short_url: str) -> int:
+    """Clicks of a short URL not yet synced to the database, summed over its shards."""
+    values = await async_redis_client.mget(click_counter_keys(short_url))
+    return sum(int(value) for value in values if value)
+
+def count_dirty_clicks() -> int:
+    """Number of short URLs with unsynced clicks."""
+    return redis_client.scard(DIRTY_CLICKS_KEY)
+
+def mark_all_clicks_dirty(batch_size: int = 1000) -> int:
+    """Add every existing click counter to the dirty set (for counters written before it existed)."""
+    marked = 0
+    codes = []
+    sharded = []
+    for key in redis_client.scan_iter(match="clicks:*", count=batch_size):
+        key = key.decode()
+        if key in (DIRTY_CLICKS_KEY, SHARDED_CLICKS_KEY):
+            continue
+        # Shard keys look like clicks:{code}:{shard}
+        parts = key.split(":")
+        codes.append(parts[1])
+        if len(parts) > 2:
+            sharded.append(parts[1])
+        if len(codes) >= batch_size:
+            if sharded:
+                redis_client.sadd(SHARDED_CLICKS_KEY, *sharded)
+                sharded = []
+            marked += redis_client.sadd(DIRTY_CLICKS_KEY, *codes)
+            codes = []
+    if sharded:
+        redis_client.sadd(SHARDED_CLICKS_KEY, *sharded)
+    if codes:
+        marked += redis_client.sadd(DIRTY_CLICKS_KEY, *codes)
+    return marked
+
+@timed_redis("pop_dirty_clicks")
+def pop_dirty_clicks(count: int) -> Optional[Dict[str, int]]:
+    """Atomically take up to `count` dirty short URLs and their pending clicks.
+
+    Returns None once the dirty set is empty. Clicks that arrive after a code
+    was taken re-add it to the set, so nothing is lost between read and reset.
+    The base counter is drained for every code, the shards only for codes
+    marked as sharded, and the counts are summed per code.
+    """
+    codes = [code.decode() for code in redis_client.spop(DIRTY_CLICKS_KEY, count) or []]
+    if not codes:
+        return None
+    pipe = redis_client.pipeline(transaction=False)
+    for code in codes:
+        pipe.srem(SHARDED_CLICKS_KEY, code)
+        pipe.getdel(f"clicks:{code}")
+    values = pipe.execute()
+    counts = {code: int(value or 0) for code, value in zip(codes, values[1::2])}
+    # Shards written after the mark was removed re-mark the code for the next drain
+    sharded = [code for code, removed in zip(codes, values[0::2]) if removed]
+    if sharded:
+        pipe = redis_client.pipeline(transaction=False)
+        for code in sharded:
+            for key in click_counter_keys(code)[1:]:
+                pipe.getdel(key)
+        values = pipe.execute()
+        for i, code in enumerate(sharded):
+            counts[code] += sum(
+                int(value) for value in values[i * CLICK_COUNTER_MAX_SHARDS:(i + 1) * CLICK_COUNTER_MAX_SHARDS]
+                if value
+            )
+    return {code: clicks for code, clicks in counts.items() if clicks}
+
+@timed_redis("restore_clicks")
+def restore_clicks(counts: Dict[str, int]) -> None:
+    """Put drained clicks back, e.g. when writing them to the database failed."""
+    pipe = redis_client.pipeline(transaction=False)
+    for short_url, clicks in counts.items():
+        pipe.incrby(f"clicks:{short_url}", clicks)
+        pipe.sadd(DIRTY_CLICKS_KEY, short_url)
+    pipe.execute()
@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Any, Dict, List
+
+from cache import async_redis_client
+
+logger = logging.getLogger("url-shortener-api")
+
+# In-process (L1) cache settings
+L1_CACHE_SIZE = int(os.getenv("L1_CACHE_SIZE", "10000"))
+L1_CACHE_TTL = float(os.getenv("L1_CACHE_TTL", "30"))
+
+# Pub/sub channel used to keep the L1 caches of all API replicas coherent
+INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "cache:invalidate")
+
+# Message that clears every entry instead of a single short code
+INVALIDATE_ALL = "*"
+
+
+class LocalCache:
+    """Bounded LRU cache with a per-entry TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a value, or None if it is missing or has expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a value, evicting the least recently used entry if full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        """Remove a single entry."""
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        """Remove every entry."""
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+# URL mappings keyed by short code
+url_cache = LocalCache(L1_CACHE_SIZE, L1_CACHE_TTL)
+
+
+async def publish_invalidation(short_url: str) -> None:
+    """Tell every API replica to drop a short code from its L1 cache."""
+    url_cache.delete(short_url)
+    try:
+        await async_redis_client.publish(INVALIDATION_CHANNEL, short_url)
+    except Exception as e:
+        logger.error(f"Error publishing cache invalidation for {short_url}: {e}")
+
+
+async def publish_invalidations(short_urls: List[str]) -> None:
+    """Invalidate many short codes with one pipelined round trip."""
+    for short_url in short_urls:
+        url_cache.delete(short_url)
+    try:
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            for short_url in short_urls:
+                pipe.publish(INVALIDATION_CHANNEL, short_url)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error publishing cache invalidation for {len(short_urls)} URLs: {e}")
+
+
+def _handle_invalidation(message: Dict[str, Any]) -> None:
+    if message.get("type") != "message":
+        return
+    data = message["data"]
+    if isinstance(data, bytes):
+        data = data.decode()
+    if data == INVALIDATE_ALL:
+        url_cache.clear()
+    else:
+        url_cache.delete(data)
+
+
+async def _listen_for_invalidations() -> None:
+    retry_delay = 1
+    while True:
+        pubsub = async_redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Messages may have been missed while we were disconnected
+            url_cache.clear()
+            retry_delay = 1
+            while True:
+                message = await pubsub.get_message(timeout=1.0)
+                if message:
+                    _handle_invalidation(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cache invalidation listener error: {e}")
+            url_cache.clear()
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+        finally:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+
+_listener_task: Optional[asyncio.Task] = None
+
+
+def start_invalidation_listener() -> None:
+    """Start the background task that applies invalidations from other replicas."""
+    global _listener_task
+    if _listener_task and not _listener_task.done():
+        return
+    _listener_task = asyncio.create_task(_listen_for_invalidations())
+
+
+async def stop_invalidation_listener() -> None:
+    """Stop the invalidation listener task."""
+    global _listener_task
+    if _listener_task:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
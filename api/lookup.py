@@ -0,0 +1,153 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from sqlalchemy import select
+
+from cache import async_redis_client
+from database import AsyncSessionLocal, URL
+from local_cache import url_cache
+from bloom import url_filter
+from url_store import get_url_entry, set_url_entry
+
+logger = logging.getLogger("url-shortener-api")
+
+# After the soft TTL an entry is still served, but one request refreshes it;
+# after the hard TTL Redis drops it and the next request loads it again
+URL_CACHE_SOFT_TTL = int(os.getenv("URL_CACHE_SOFT_TTL", "3600"))
+URL_CACHE_HARD_TTL = int(os.getenv("URL_CACHE_HARD_TTL", "7200"))
+
+# Cross-replica load lock, and how long other replicas wait for its holder
+LOAD_LOCK_TTL_MS = int(os.getenv("LOAD_LOCK_TTL_MS", "2000"))
+LOAD_WAIT_TIMEOUT = float(os.getenv("LOAD_WAIT_TIMEOUT", "0.5"))
+LOAD_POLL_INTERVAL = 0.02
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one in-flight call."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.shared = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        # A cancelled caller must not cancel the load for everyone else
+        return await asyncio.shield(task)
+
+
+loads = SingleFlight()
+_refreshing: set = set()
+
+
+def lock_key(short_url: str) -> str:
+    return f"lock:url:{short_url}"
+
+
+def make_entry(
+    target_url: str,
+    short_url: str,
+    expired: bool = False,
+    redirect_status: Optional[int] = None,
+    cache_max_age: Optional[int] = None
+) -> Dict[str, Any]:
+    """Build a cache entry that becomes stale after the soft TTL."""
+    entry = {
+        "target_url": target_url,
+        "short_url": short_url,
+        "expired": bool(expired),
+        "soft_expires": time.time() + URL_CACHE_SOFT_TTL,
+    }
+    # Only links with their own redirect settings carry them
+    if redirect_status is not None:
+        entry["redirect_status"] = redirect_status
+    if cache_max_age is not None:
+        entry["cache_max_age"] = cache_max_age
+    return entry
+
+
+async def _load_from_db(short_url: str) -> Optional[Dict[str, Any]]:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(URL).where(URL.short_url == short_url))
+        db_url = result.scalar_one_or_none()
+    if db_url is None:
+        await url_filter.record_miss(short_url)
+        return None
+    entry = make_entry(
+        db_url.target_url, db_url.short_url, db_url.expired,
+        db_url.redirect_status, db_url.cache_max_age
+    )
+    await set_url_entry(entry, URL_CACHE_HARD_TTL)
+    url_cache.set(short_url, entry)
+    return entry
+
+
+async def _load(short_url: str) -> Optional[Dict[str, Any]]:
+    locked = await async_redis_client.set(lock_key(short_url), 1, nx=True, px=LOAD_LOCK_TTL_MS)
+    if not locked:
+        # Another replica is loading this code; give it a moment to fill the cache
+        deadline = time.monotonic() + LOAD_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOAD_POLL_INTERVAL)
+            entry = await get_url_entry(short_url)
+            if entry:
+                url_cache.set(short_url, entry)
+                return entry
+    try:
+        return await _load_from_db(short_url)
+    finally:
+        if locked:
+            await async_redis_client.delete(lock_key(short_url))
+
+
+async def _refresh(short_url: str) -> None:
+    try:
+        # Only one replica refreshes; the rest keep serving the stale entry
+        if await async_redis_client.set(lock_key(short_url), 1, nx=True, px=LOAD_LOCK_TTL_MS):
+            try:
+                await _load_from_db(short_url)
+            finally:
+                await async_redis_client.delete(lock_key(short_url))
+    except Exception as e:
+        logger.error(f"Error refreshing cache entry for {short_url}: {e}")
+    finally:
+        _refreshing.discard(short_url)
+
+
+def _refresh_in_background(short_url: str) -> None:
+    if short_url in _refreshing:
+        return
+    _refreshing.add(short_url)
+    asyncio.create_task(_refresh(short_url))
+
+
+async def lookup_url(short_url: str) -> Optional[Dict[str, Any]]:
+    """Resolve a short code through the in-process cache, Redis and the database.
+
+    Returns the cache entry, or None if the code does not exist. Concurrent
+    misses for one code share a single database load.
+    """
+    entry = url_cache.get(short_url)
+    if entry is not None:
+        return entry
+
+    entry = await get_url_entry(short_url)
+    if entry:
+        if entry.get("soft_expires", float("inf")) <= time.time():
+            _refresh_in_background(short_url)
+        url_cache.set(short_url, entry)
+        return entry
+
+    # Known-missing codes are answered without touching the database
+    if await url_filter.is_missing(short_url):
+        return None
+
+    return await loads.do(short_url, lambda: _load(short_url))
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import functools
+from typing import Callable, Dict, Any, Iterable
+
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+# Buckets for the sub-millisecond Redis and cache paths up to slow requests
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+REDIS_LATENCY = Histogram(
+    "redis_operation_duration_seconds", "Latency of cache-layer Redis operations",
+    ["operation"], buckets=LATENCY_BUCKETS
+)
+DB_LATENCY = Histogram(
+    "db_query_duration_seconds", "Database statement latency by statement type",
+    ["engine", "statement"], buckets=LATENCY_BUCKETS
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_seconds", "Time spent waiting for a pooled database connection",
+    ["engine"], buckets=LATENCY_BUCKETS
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups", "URL cache lookups by layer and result", ["layer", "result"]
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, not the path, keeps /{short_url} to one series
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"], route.path if route else "unmatched", str(status)
+            ).observe(time.perf_counter() - started)
+
+
+def timed_redis(operation: str) -> Callable:
+    """Decorator recording the latency of a sync or async Redis helper."""
+    histogram = REDIS_LATENCY.labels(operation)
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+
+    return decorator
+
+
+def record_lookup(layer: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(layer, "hit" if hit else "miss").inc()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits."""
+
+    engine_name = "sync"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(self.engine_name).observe(time.perf_counter() - started)
+
+
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that records how long each checkout waits."""
+
+    engine_name = "async"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(self.engine_name).observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine, name: str) -> None:
+    """Record the latency of every statement run through a (sync) engine."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_LATENCY.labels(name, verb).observe(time.perf_counter() - started)
+
+
+class StatsCollector:
+    """Exposes the counters a component already keeps in stats() at scrape time.
+
+    Nothing is added to the hot path: the values are read only when /metrics is scraped.
+    """
+
+    def __init__(self, name: str, stats: Callable[[], Dict[str, Any]], counters: Iterable[str] = ()):
+        self.name = name
+        self.stats = stats
+        self.counters = set(counters)
+
+    def collect(self):
+        for key, value in self.stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            metric = f"{self.name}_{key}"
+            if key in self.counters:
+                yield CounterMetricFamily(metric, f"{self.name} {key}", value=value)
+            else:
+                yield GaugeMetricFamily(metric, f"{self.name} {key}", value=value)
+
+
+def register_stats(name: str, stats: Callable[[], Dict[str, Any]], counters: Iterable[str] = ()) -> None:
+    REGISTRY.register(StatsCollector(name, stats, counters))
@@ -1,10 +1,207 @@
+"""Versioned schema migrations for the urls database.
+
+Run once per deploy, before the API starts:
+
+    python migrations.py
+
+Applied versions are recorded in schema_version, and a Postgres advisory lock
+keeps concurrent runs from applying the same migration twice. API processes
+only compare the recorded version with the latest one on startup.
+"""
+import time
+import logging
+from typing import Callable, List
+
+from sqlalchemy import text, inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError, OperationalError
+
 from database import Base, engine
+from allocator import (
+    CodePermutation, next_free_id, ID_SEQUENCE, CODE_PERMUTATION_KEY, CODE_MIN_LENGTH
+)
+
+logger = logging.getLogger("url-shortener-api")
+
+# Arbitrary key for the advisory lock held while migrating
+MIGRATION_LOCK_ID = 712003
+
+
+class Migration:
+    """One schema change. Non-transactional ones run in autocommit mode, e.g. for
+    CREATE INDEX CONCURRENTLY, and must be safe to repeat."""
+
+    def __init__(self, version: int, description: str, upgrade: Callable[[Connection], None],
+                 transactional: bool = True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.transactional = transactional
+
+
+def create_base_tables(conn: Connection) -> None:
+    Base.metadata.create_all(bind=conn)
+
+
+def add_expired_column(conn: Connection) -> None:
+    # Tables created before the column existed
+    columns = [column["name"] for column in inspect(conn).get_columns("urls")]
+    if "expired" not in columns:
+        conn.execute(text("ALTER TABLE urls ADD COLUMN expired BOOLEAN DEFAULT FALSE"))
+
+
+def add_redirect_columns(conn: Connection) -> None:
+    columns = [column["name"] for column in inspect(conn).get_columns("urls")]
+    if "redirect_status" not in columns:
+        conn.execute(text("ALTER TABLE urls ADD COLUMN redirect_status INTEGER"))
+    if "cache_max_age" not in columns:
+        conn.execute(text("ALTER TABLE urls ADD COLUMN cache_max_age INTEGER"))
+
+
+def create_code_sequence(conn: Connection) -> None:
+    if conn.dialect.name != "postgresql":
+        # SQLite installs allocate from the Redis counter
+        return
+    conn.execute(text(f"CREATE SEQUENCE IF NOT EXISTS {ID_SEQUENCE} MINVALUE 0 START 0"))
+    # Codes already handed out from the Redis counter must not be issued again
+    start = next_free_id(conn, CodePermutation(CODE_PERMUTATION_KEY, CODE_MIN_LENGTH))
+    if start:
+        conn.execute(
+            text(f"""
+                SELECT setval('{ID_SEQUENCE}',
+                              greatest(:start, (SELECT last_value + 1 FROM {ID_SEQUENCE})), false)
+            """),
+            {"start": start}
+        )
+
+
+def add_performance_indexes(conn: Connection) -> None:
+    if conn.dialect.name != "postgresql":
+        # SQLite gets the model's indexes from create_all
+        return
+    # Lets the expiry sweep page through unexpired rows by age; create_all
+    # does not add it to tables that already existed
+    conn.execute(text("""
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_urls_unexpired_created_at
+        ON urls (created_at, id) WHERE NOT expired
+    """))
+    # Duplicates the primary key index
+    conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_urls_id"))
+    # Nothing looks URLs up by target, but every insert paid for this index
+    conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_urls_target_url"))
+
+
+def add_clicks_index(conn: Connection) -> None:
+    # Superseded by migration 7, which drops the index again; kept so the
+    # recorded versions stay the same
+    pass
+
+
+def drop_clicks_index(conn: Connection) -> None:
+    # Every click sync updates urls.clicks, and an index on it makes each of
+    # those updates non-HOT. The warm-up fallback does a top-N sort instead
+    concurrently = "CONCURRENTLY" if conn.dialect.name == "postgresql" else ""
+    conn.execute(text(f"DROP INDEX {concurrently} IF EXISTS ix_urls_clicks"))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "create base tables", create_base_tables),
+    Migration(2, "add urls.expired", add_expired_column),
+    Migration(3, "add expiry index, drop redundant urls indexes", add_performance_indexes,
+              transactional=False),
+    Migration(4, "add per-link redirect settings", add_redirect_columns),
+    Migration(5, "create the short code sequence", create_code_sequence),
+    Migration(6, "add urls.clicks index for the cache warm-up", add_clicks_index,
+              transactional=False),
+    Migration(7, "drop urls.clicks index", drop_clicks_index, transactional=False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def ensure_version_table(conn: Connection) -> None:
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def current_version() -> int:
+    """Highest applied migration; 0 if none, or if schema_version does not exist yet."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+    except DBAPIError:
+        return 0
+
+
+def schema_is_current() -> bool:
+    """Cheap startup check: a single query when migrations have already run."""
+    return current_version() >= LATEST_VERSION
+
+
+def record_version(conn: Connection, migration: Migration) -> None:
+    conn.execute(
+        text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+        {"version": migration.version, "description": migration.description}
+    )
+
+
+def run_migrations() -> int:
+    """Apply pending migrations in order. Returns the number applied."""
+    applied = 0
+    with engine.connect() as lock_conn:
+        if engine.dialect.name == "postgresql":
+            # Session-level lock: a concurrent run waits, then finds nothing left to do
+            lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            lock_conn.commit()
+        try:
+            with engine.begin() as conn:
+                ensure_version_table(conn)
+            version = current_version()
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.description}")
+                if migration.transactional:
+                    with engine.begin() as conn:
+                        migration.upgrade(conn)
+                        record_version(conn, migration)
+                else:
+                    with engine.connect() as conn:
+                        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                        migration.upgrade(conn)
+                    with engine.begin() as conn:
+                        record_version(conn, migration)
+                applied += 1
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                lock_conn.commit()
+    return applied
+
+
+def wait_for_database(timeout: float = 120) -> None:
+    """Block until the database accepts connections; it may still be starting."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return
+        except OperationalError as e:
+            if time.monotonic() > deadline:
+                raise
+            logger.error(f"Error connecting to database: {e}")
+            time.sleep(2)
 
-def run_migrations():
-    """Create all tables defined in models."""
-    Base.metadata.create_all(bind=engine)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     print("Running database migrations...")
-    run_migrations()
-    print("Migrations completed successfully!") 
\ No newline at end of file
+    wait_for_database()
+    applied = run_migrations()
+    print(f"Migrations completed successfully! Applied {applied}, schema at version {LATEST_VERSION}.")
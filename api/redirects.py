@@ -0,0 +1,83 @@
+import os
+import random
+import hashlib
+from typing import Optional, Dict, Any
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, RedirectResponse
+
+# "redirect" answers with a 3xx and a Location header unless the client asks for
+# JSON; "json" always answers with {"target_url": ...} as before
+REDIRECT_MODE = os.getenv("REDIRECT_MODE", "redirect")
+# Status and Cache-Control max-age (seconds) for links without their own settings.
+# With 0 every click reaches the API; above 0 browsers and edge caches may answer
+# repeat clicks, which are only counted if the edge reports them (POST /clicks/edge)
+REDIRECT_STATUS = int(os.getenv("REDIRECT_STATUS", "302"))
+REDIRECT_CACHE_MAX_AGE = int(os.getenv("REDIRECT_CACHE_MAX_AGE", "0"))
+
+REDIRECT_STATUSES = (301, 302, 307, 308)
+
+# Bounds on one edge report: raw hits, how sparse its log sample may be, and the
+# clicks it can add after scaling
+EDGE_MAX_HITS = int(os.getenv("EDGE_MAX_HITS", "10000000"))
+EDGE_MIN_SAMPLE_RATE = float(os.getenv("EDGE_MIN_SAMPLE_RATE", "0.001"))
+EDGE_MAX_CLICKS = int(os.getenv("EDGE_MAX_CLICKS", "100000000"))
+
+
+def wants_json(request: Request, format: Optional[str] = None) -> bool:
+    """Whether to answer a short link with JSON instead of a redirect."""
+    if format:
+        return format == "json"
+    if REDIRECT_MODE == "json":
+        return True
+    # Only an explicit JSON Accept opts out; browsers, curl and crawlers get the redirect
+    return "application/json" in request.headers.get("accept", "")
+
+
+def cache_control(max_age: int) -> str:
+    if max_age <= 0:
+        # Also stops browsers from caching a 301 indefinitely
+        return "no-store"
+    return f"public, max-age={max_age}"
+
+
+def redirect_response(entry: Dict[str, Any]) -> RedirectResponse:
+    status = entry.get("redirect_status") or REDIRECT_STATUS
+    max_age = entry.get("cache_max_age")
+    if max_age is None:
+        max_age = REDIRECT_CACHE_MAX_AGE
+    return RedirectResponse(
+        entry["target_url"],
+        status_code=status,
+        headers={"Cache-Control": cache_control(max_age)}
+    )
+
+
+def json_response(entry: Dict[str, Any]) -> JSONResponse:
+    # Never stored, so a shared cache only ever holds the redirect and needs no Vary: Accept
+    return JSONResponse({"target_url": entry["target_url"]}, headers={"Cache-Control": "no-store"})
+
+
+def estimate_clicks(hits: int, sample_rate: float) -> int:
+    """Scale hits counted from a sample of edge logs back up to a click count.
+
+    The fractional part is rounded randomly, so estimates stay unbiased when
+    summed over many reports. Capped at EDGE_MAX_CLICKS.
+    """
+    estimate = hits / sample_rate
+    whole = int(estimate)
+    return min(whole + (random.random() < estimate - whole), EDGE_MAX_CLICKS)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
@@ -0,0 +1,34 @@
+"""Tests for the api service, run from the repository root with
+
+    python -m pytest api/tests
+
+Services are flat modules imported by bare name, as in the container, so each
+service's tests run in their own pytest invocation.
+"""
+import os
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """A fresh fakeredis server behind the Redis clients of every imported api module.
+
+    Returns the async client; use it within a single asyncio.run().
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    clients = {
+        "redis_client": fakeredis.FakeRedis(server=server),
+        "async_redis_client": fakeredis.FakeAsyncRedis(server=server),
+    }
+    for module in list(sys.modules.values()):
+        if getattr(module, "__file__", None) and os.path.dirname(module.__file__) == SERVICE_DIR:
+            for name, client in clients.items():
+                if hasattr(module, name):
+                    monkeypatch.setattr(module, name, client)
+    return clients["async_redis_client"]
@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from allocator import CodePermutation, ALPHABET, BASE
+
+
+def test_round_trip_across_lengths():
+    permutation = CodePermutation("test-key", 2)
+    first_3 = BASE ** 2
+    first_4 = first_3 + BASE ** 3
+    rng = random.Random(1)
+    ids = [0, 1, first_3 - 1, first_3, first_4 - 1, first_4, 10 ** 12]
+    ids += [rng.randrange(10 ** 9) for _ in range(1000)]
+    for id_ in ids:
+        assert permutation.decode(permutation.encode(id_)) == id_
+
+
+def test_code_length_grows_after_each_length_is_used_up():
+    permutation = CodePermutation("test-key", 2)
+    assert len(permutation.encode(0)) == 2
+    assert len(permutation.encode(BASE ** 2 - 1)) == 2
+    assert len(permutation.encode(BASE ** 2)) == 3
+    assert len(permutation.encode(BASE ** 2 + BASE ** 3 - 1)) == 3
+    assert len(permutation.encode(BASE ** 2 + BASE ** 3)) == 4
+
+
+def test_every_code_of_a_length_is_used_once():
+    permutation = CodePermutation("test-key", 2)
+    codes = {permutation.encode(id_) for id_ in range(BASE ** 2)}
+    assert len(codes) == BASE ** 2
+    assert all(len(code) == 2 and set(code) <= set(ALPHABET) for code in codes)
+
+
+def test_consecutive_ids_do_not_give_consecutive_codes():
+    permutation = CodePermutation("test-key", 7)
+    codes = [permutation.encode(id_) for id_ in range(100)]
+    assert codes != sorted(codes)
+    assert len({code[:4] for code in codes}) > 50
+
+
+def test_key_changes_the_mapping():
+    assert CodePermutation("one", 7).encode(12345) != CodePermutation("two", 7).encode(12345)
+
+
+def test_decode_rejects_codes_below_the_minimum_length():
+    with pytest.raises(ValueError):
+        CodePermutation("test-key", 7).decode("abc123")
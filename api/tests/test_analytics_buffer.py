@@ -0,0 +1,41 @@
+import asyncio
+
+import httpx
+
+from analytics import ClickEventBuffer
+
+
+def make_buffer(responses):
+    buffer = ClickEventBuffer("http://analytics/batch", max_size=100, batch_size=10, flush_interval=1.0,
+                              max_backoff=5.0)
+    buffer._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: responses.pop(0)))
+    return buffer
+
+
+def pauses(buffer, responses):
+    """Flush after each response and report how long flushing was paused for."""
+    async def scenario():
+        seen = []
+        for _ in range(len(responses)):
+            buffer.add({"short_url": "abc"})
+            await buffer.flush()
+            seen.append(round(buffer._resume_at - asyncio.get_running_loop().time()))
+        return seen
+    return asyncio.run(scenario())
+
+
+def test_retry_after_sets_the_pause_and_keeps_the_batch():
+    responses = [httpx.Response(503, headers={"Retry-After": "2"})]
+    buffer = make_buffer(responses)
+    assert pauses(buffer, responses) == [2]
+    assert buffer.stats()["queued"] == 1
+    assert buffer.backoffs == 1
+
+
+def test_backoff_doubles_up_to_the_cap_and_resets_on_success():
+    responses = [httpx.Response(429)] * 4 + [httpx.Response(200), httpx.Response(429)]
+    buffer = make_buffer(responses)
+    seen = pauses(buffer, responses)
+    assert seen[:4] == [1, 2, 4, 5]
+    assert buffer.sent == 5
+    assert seen[-1] == 1
@@ -0,0 +1,41 @@
+import asyncio
+
+from bloom import UrlFilter, BLOOM_KEY, BLOOM_READY_KEY
+
+
+def make_filter(monkeypatch):
+    url_filter = UrlFilter(BLOOM_KEY, 1000, 0.01)
+    rebuilds = []
+
+    async def rebuild():
+        rebuilds.append(True)
+        return True
+
+    monkeypatch.setattr(url_filter, "rebuild", rebuild)
+    return url_filter, rebuilds
+
+
+def test_unknown_code_is_missing_once_ready(fake_redis, monkeypatch):
+    url_filter, rebuilds = make_filter(monkeypatch)
+
+    async def scenario():
+        await url_filter.add_many(["abc"])
+        await fake_redis.set(BLOOM_READY_KEY, 1)
+        await url_filter.ensure_ready()
+        return await url_filter.is_missing("abc"), await url_filter.is_missing("zzz")
+
+    assert asyncio.run(scenario()) == (False, True)
+    assert rebuilds == []
+
+
+def test_lost_bitmap_is_not_ready_and_gets_rebuilt(fake_redis, monkeypatch):
+    url_filter, rebuilds = make_filter(monkeypatch)
+
+    async def scenario():
+        await fake_redis.set(BLOOM_READY_KEY, 1)
+        missing = await url_filter.is_missing("abc")
+        await url_filter.ensure_ready()
+        return missing
+
+    assert asyncio.run(scenario()) is False
+    assert rebuilds == [True]
@@ -0,0 +1,114 @@
+"""The api and the worker each keep a copy of the click counter drain; every
+scenario here runs against both."""
+import importlib.util
+import os
+
+import pytest
+
+import cache
+from cache import DIRTY_CLICKS_KEY, SHARDED_CLICKS_KEY, CLICK_COUNTER_MAX_SHARDS
+
+WORKER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "worker")
+
+
+def load_worker(monkeypatch):
+    monkeypatch.syspath_prepend(WORKER_DIR)
+    spec = importlib.util.spec_from_file_location("worker_app", os.path.join(WORKER_DIR, "app.py"))
+    worker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker)
+    return worker
+
+
+@pytest.fixture(params=["api", "worker"])
+def drain(request, fake_redis, monkeypatch):
+    """The cache module or the worker, with its Redis client on the fake server."""
+    if request.param == "api":
+        return cache
+    worker = load_worker(monkeypatch)
+    monkeypatch.setattr(worker, "redis_client", cache.redis_client)
+    return worker
+
+
+def click(code, amount, shard=None):
+    """Count clicks the way the api does, on the base key or one shard."""
+    pipe = cache.redis_client.pipeline(transaction=False)
+    if shard is None:
+        pipe.incrby(f"clicks:{code}", amount)
+    else:
+        pipe.incrby(f"clicks:{code}:{shard}", amount)
+        pipe.sadd(SHARDED_CLICKS_KEY, code)
+    pipe.sadd(DIRTY_CLICKS_KEY, code)
+    pipe.execute()
+
+
+def drain_all(drain):
+    totals = {}
+    while True:
+        counts = drain.pop_dirty_clicks(100)
+        if counts is None:
+            return totals
+        for code, clicks in counts.items():
+            totals[code] = totals.get(code, 0) + clicks
+
+
+def leftover_keys():
+    return sorted(key.decode() for key in cache.redis_client.scan_iter(match="clicks:*"))
+
+
+def test_unsharded_and_sharded_codes_drain_completely(drain):
+    click("plain", 3)
+    click("hot", 1)
+    click("hot", 2, shard=0)
+    click("hot", 4, shard=CLICK_COUNTER_MAX_SHARDS - 1)
+    assert drain.pop_dirty_clicks(100) == {"plain": 3, "hot": 7}
+    assert drain.pop_dirty_clicks(100) is None
+    assert leftover_keys() == []
+
+
+def test_shards_of_unmarked_codes_are_left_alone(drain):
+    cache.redis_client.set("clicks:plain:5", 9)
+    click("plain", 3)
+    assert drain.pop_dirty_clicks(100) == {"plain": 3}
+    assert leftover_keys() == ["clicks:plain:5"]
+
+
+def test_clicks_between_spop_and_getdel_are_counted_once(drain, monkeypatch):
+    click("plain", 1)
+    click("hot", 1, shard=2)
+    spop = cache.redis_client.spop
+
+    def spop_then_click(*args):
+        codes = spop(*args)
+        if codes:
+            click("plain", 10)
+            click("hot", 20, shard=7)
+            click("hot", 40)
+        return codes
+
+    monkeypatch.setattr(cache.redis_client, "spop", spop_then_click)
+    first = drain.pop_dirty_clicks(100)
+    monkeypatch.setattr(cache.redis_client, "spop", spop)
+    totals = drain_all(drain)
+    for code, clicks in first.items():
+        totals[code] = totals.get(code, 0) + clicks
+    assert totals == {"plain": 11, "hot": 61}
+    assert leftover_keys() == []
+
+
+def test_restored_clicks_drain_again(drain):
+    click("plain", 3)
+    click("hot", 5, shard=1)
+    counts = drain.pop_dirty_clicks(100)
+    # As after a failed database write
+    drain.restore_clicks(counts)
+    assert drain.pop_dirty_clicks(100) == {"plain": 3, "hot": 5}
+    assert leftover_keys() == []
+
+
+def test_mark_all_recovers_leftover_shard_keys(fake_redis):
+    cache.redis_client.set("clicks:plain", 3)
+    cache.redis_client.set("clicks:hot:4", 5)
+    cache.redis_client.set("clicks:hot:9", 6)
+    assert cache.mark_all_clicks_dirty() == 2
+    assert drain_all(cache) == {"plain": 3, "hot": 11}
+    assert leftover_keys() == []
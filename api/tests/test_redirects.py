@@ -0,0 +1,33 @@
+from redirects import make_etag, etag_matches
+
+
+def test_make_etag_is_quoted_and_stable():
+    etag = make_etag(b'{"clicks": 1}')
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == make_etag(b'{"clicks": 1}')
+    assert etag != make_etag(b'{"clicks": 2}')
+
+
+def test_missing_header_never_matches():
+    assert not etag_matches(None, '"abc"')
+    assert not etag_matches("", '"abc"')
+
+
+def test_exact_and_weak_tags_match():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+
+
+def test_any_tag_in_a_list_matches():
+    assert etag_matches('"x", W/"abc" ,"y"', '"abc"')
+    assert not etag_matches('"x", "y"', '"abc"')
+
+
+def test_wildcard_matches():
+    assert etag_matches("*", '"abc"')
+    assert etag_matches(" * ", '"abc"')
+
+
+def test_tags_compare_with_their_quotes():
+    assert not etag_matches("abc", '"abc"')
+    assert not etag_matches('"ab"', '"abc"')
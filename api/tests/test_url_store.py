@@ -0,0 +1,32 @@
+import asyncio
+
+import url_store
+from url_store import encode_entry, decode_entry
+
+
+def test_packed_entries_keep_their_soft_expiry():
+    entry = {"target_url": "https://example.com/a b", "short_url": "abc", "expired": True,
+             "soft_expires": 1700000000.5}
+    assert decode_entry("abc", encode_entry(entry).encode()) == dict(entry, soft_expires=1700000000)
+
+
+def test_entries_packed_without_a_soft_expiry_read_as_stale():
+    assert decode_entry("abc", b"0https://example.com/") == {
+        "target_url": "https://example.com/", "short_url": "abc", "expired": False, "soft_expires": 0
+    }
+
+
+def test_every_write_pushes_the_bucket_ttl_out(fake_redis, monkeypatch):
+    monkeypatch.setattr(url_store, "URL_CACHE_LAYOUT", "compact")
+    first = {"target_url": "https://example.com/", "short_url": "abc", "soft_expires": 1}
+    second = dict(first, short_url="abd")
+    monkeypatch.setattr(url_store, "bucket_key", lambda code: "urls:0")
+
+    async def scenario():
+        await url_store.set_url_entry(first, 100)
+        await url_store.set_url_entry(second, 1000)
+        return await fake_redis.ttl(url_store.bucket_key("abc")), await url_store.get_url_entry("abc")
+
+    ttl, entry = asyncio.run(scenario())
+    assert ttl > 100
+    assert entry["soft_expires"] == 1
@@ -0,0 +1,164 @@
+import os
+import json
+import zlib
+import logging
+from typing import Optional, Dict, Any, List
+
+from cache import async_redis_client
+from metrics import timed_redis, record_lookup
+
+logger = logging.getLogger("url-shortener-api")
+
+# "json" keeps one url:{code} string key per link; "compact" packs links into
+# small hashes (urls:{bucket}) that Redis stores in its listpack encoding
+URL_CACHE_LAYOUT = os.getenv("URL_CACHE_LAYOUT", "json")
+URL_CACHE_BUCKETS = int(os.getenv("URL_CACHE_BUCKETS", "65536"))
+# A longer value would convert its whole bucket to a hashtable, so keep this
+# at or below the server's hash-max-listpack-value; longer links use url:{code}.
+# A packed value is the link plus 12 bytes of flags and soft expiry
+URL_CACHE_MAX_FIELD_SIZE = int(os.getenv("URL_CACHE_MAX_FIELD_SIZE", "64"))
+
+MIGRATION_BATCH_SIZE = 1000
+
+
+def cache_key(short_url: str) -> str:
+    return f"url:{short_url}"
+
+
+def bucket_key(short_url: str) -> str:
+    return f"urls:{zlib.crc32(short_url.encode()) % URL_CACHE_BUCKETS}"
+
+
+def encode_entry(entry: Dict[str, Any]) -> str:
+    """Pack an entry as its expired flag, its soft expiry in epoch seconds, a
+    space and the target URL."""
+    flag = "1" if entry.get("expired") else "0"
+    return f"{flag}{int(entry.get('soft_expires', 0))} {entry['target_url']}"
+
+
+def decode_entry(short_url: str, packed: bytes) -> Dict[str, Any]:
+    packed = packed.decode()
+    soft_expires, separator, target_url = packed[1:].partition(" ")
+    if not (separator and soft_expires.isdigit()):
+        # Packed before entries had a soft expiry; read as stale so it gets refreshed
+        soft_expires, target_url = "0", packed[1:]
+    return {
+        "target_url": target_url,
+        "short_url": short_url,
+        "expired": packed[0] == "1",
+        "soft_expires": int(soft_expires),
+    }
+
+
+def fits_bucket(entry: Dict[str, Any]) -> bool:
+    # The packed form has no room for per-link redirect settings
+    if "redirect_status" in entry or "cache_max_age" in entry:
+        return False
+    return len(encode_entry(entry).encode()) <= URL_CACHE_MAX_FIELD_SIZE
+
+
+def add_to_bucket(pipe, entry: Dict[str, Any], expiration: int) -> None:
+    key = bucket_key(entry["short_url"])
+    pipe.hset(key, entry["short_url"], encode_entry(entry))
+    pipe.expire(key, expiration)
+
+
+@timed_redis("get_url")
+async def get_url_entry(short_url: str) -> Optional[Dict[str, Any]]:
+    """Read a cached URL entry in whichever layout it was stored."""
+    if URL_CACHE_LAYOUT != "compact":
+        data = await async_redis_client.get(cache_key(short_url))
+        record_lookup("redis", bool(data))
+        return json.loads(data) if data else None
+    # Long links and not yet migrated entries still live in url:{code}
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        pipe.hget(bucket_key(short_url), short_url)
+        pipe.get(cache_key(short_url))
+        packed, data = await pipe.execute()
+    record_lookup("redis", packed is not None or bool(data))
+    if packed is not None:
+        return decode_entry(short_url, packed)
+    return json.loads(data) if data else None
+
+
+@timed_redis("get_urls")
+async def get_url_entries(codes: List[str]) -> List[Dict[str, Any]]:
+    """Read several cached URL entries in one pipelined round trip; misses are left out."""
+    compact = URL_CACHE_LAYOUT == "compact"
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for code in codes:
+            if compact:
+                pipe.hget(bucket_key(code), code)
+            pipe.get(cache_key(code))
+        values = await pipe.execute()
+    width = 2 if compact else 1
+    entries = []
+    for i, code in enumerate(codes):
+        packed = values[i * width] if compact else None
+        data = values[i * width + width - 1]
+        if packed is not None:
+            entries.append(decode_entry(code, packed))
+        elif data:
+            entries.append(json.loads(data))
+    return entries
+
+
+@timed_redis("set_urls")
+async def set_url_entries(entries: List[Dict[str, Any]], expiration: int) -> None:
+    """Cache several URL entries in one pipelined round trip.
+
+    JSON entries expire after `expiration` seconds. Hash fields cannot expire
+    on their own, so every write pushes its bucket's TTL out again, and a
+    bucket is only dropped once none of its links was written for that long.
+    Each compact entry still carries its own soft expiry, so a stale one is
+    refreshed on read like a JSON entry.
+    """
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for entry in entries:
+            if URL_CACHE_LAYOUT == "compact" and fits_bucket(entry):
+                add_to_bucket(pipe, entry, expiration)
+            else:
+                pipe.setex(cache_key(entry["short_url"]), expiration, json.dumps(entry))
+        await pipe.execute()
+
+
+async def set_url_entry(entry: Dict[str, Any], expiration: int) -> None:
+    await set_url_entries([entry], expiration)
+
+
+async def migrate_to_compact(expiration: int) -> Dict[str, int]:
+    """Move url:{code} entries that fit a bucket into the compact layout.
+
+    Safe to run while serving: reads check both layouts, and each entry is
+    written to its bucket before its old key is removed.
+    """
+    migrated = 0
+    skipped = 0
+    keys = []
+
+    async def migrate_batch(batch: List[bytes]) -> None:
+        nonlocal migrated, skipped
+        values = await async_redis_client.mget(batch)
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            for key, data in zip(batch, values):
+                if not data:
+                    continue
+                entry = json.loads(data)
+                if not fits_bucket(entry):
+                    skipped += 1
+                    continue
+                add_to_bucket(pipe, entry, expiration)
+                pipe.unlink(key)
+                migrated += 1
+            await pipe.execute()
+
+    async for key in async_redis_client.scan_iter(match="url:*", count=MIGRATION_BATCH_SIZE):
+        keys.append(key)
+        if len(keys) >= MIGRATION_BATCH_SIZE:
+            await migrate_batch(keys)
+            keys = []
+    if keys:
+        await migrate_batch(keys)
+
+    logger.info(f"Migrated {migrated} cached URLs to the compact layout, {skipped} too long")
+    return {"migrated": migrated, "skipped": skipped}
@@ -0,0 +1,219 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List
+
+import httpx
+from sqlalchemy import select
+
+from cache import async_redis_client
+from database import AsyncSessionLocal, URL
+from local_cache import url_cache, L1_CACHE_SIZE
+from lookup import make_entry, URL_CACHE_HARD_TTL
+from url_store import set_url_entries, get_url_entries
+
+logger = logging.getLogger("url-shortener-api")
+
+# How many of the most clicked links to preload, and how many per pipelined batch
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "10000"))
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", "500"))
+# Where popularity comes from: "clicks" (urls.clicks) or "analytics" (recent rollups)
+WARMUP_SOURCE = os.getenv("WARMUP_SOURCE", "clicks")
+WARMUP_POPULAR_URL = os.getenv("WARMUP_POPULAR_URL", "http://analytics:8001/popular")
+WARMUP_POPULAR_HOURS = int(os.getenv("WARMUP_POPULAR_HOURS", "24"))
+# The health check reports ready once this fraction is loaded, or after the timeout
+WARMUP_READY_FRACTION = float(os.getenv("WARMUP_READY_FRACTION", "0.9"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "60"))
+# How often to check whether Redis lost the warmed entries (restart or failover)
+WARMUP_CHECK_INTERVAL = float(os.getenv("WARMUP_CHECK_INTERVAL", "30"))
+
+# How long one process may hold the warm-up before another takes over
+WARMUP_LOCK_TTL = int(os.getenv("WARMUP_LOCK_TTL", "300"))
+WARMUP_POLL_INTERVAL = 1.0
+
+# Set once Redis holds a warm-up; it vanishes when Redis comes back empty
+WARMUP_MARKER_KEY = "warmup:done"
+# Only one process loads Redis from the database at a time
+WARMUP_LOCK_KEY = "warmup:lock"
+# The most popular codes, which the other processes copy into their in-process cache
+WARMUP_CODES_KEY = "warmup:codes"
+
+
+class CacheWarmer:
+    """Preloads the most clicked links into Redis and the in-process cache.
+
+    Runs in the background while the API serves. One process at a time loads
+    Redis from the database; the others wait for it and fill only their
+    in-process cache from Redis. The first warm-up gates readiness; later
+    ones, after Redis comes back empty, only refill the cache.
+    """
+
+    def __init__(self):
+        self.target = 0
+        self.loaded = 0
+        self.runs = 0
+        self.local_fills = 0
+        self.failures = 0
+        self.started_at: Optional[float] = None
+        self.finished = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        if self.finished:
+            return True
+        if self.target and self.loaded >= self.target * WARMUP_READY_FRACTION:
+            return True
+        # A slow or broken warm-up must not keep the replica out of rotation
+        return self.started_at is not None and time.monotonic() - self.started_at > WARMUP_TIMEOUT
+
+    async def _popular_from_analytics(self) -> List[str]:
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.get(
+                WARMUP_POPULAR_URL, params={"hours": WARMUP_POPULAR_HOURS, "limit": WARMUP_TOP_N}
+            )
+            response.raise_for_status()
+        return [row["short_url"] for row in response.json()]
+
+    async def _popular_from_clicks(self) -> List[str]:
+        # urls.clicks is deliberately unindexed, so click syncs stay HOT updates;
+        # this fallback costs one scan with a bounded top-N sort
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(URL.short_url)
+                .where(URL.expired.isnot(True))
+                .order_by(URL.clicks.desc())
+                .limit(WARMUP_TOP_N)
+            )
+            return list(result.scalars())
+
+    async def popular_codes(self) -> List[str]:
+        """Short codes to preload, most clicked first."""
+        if WARMUP_SOURCE == "analytics":
+            try:
+                codes = await self._popular_from_analytics()
+                if codes:
+                    return codes
+            except Exception as e:
+                logger.error(f"Error fetching popular URLs from analytics: {e}")
+        return await self._popular_from_clicks()
+
+    async def _load_batch(self, codes: List[str], fill_l1: bool) -> int:
+        """Load a batch from the database into Redis. Returns the number of links found."""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(
+                    URL.target_url, URL.short_url, URL.expired, URL.redirect_status, URL.cache_max_age
+                ).where(URL.short_url.in_(codes))
+            )
+            entries = [make_entry(*row) for row in result]
+        await set_url_entries(entries, URL_CACHE_HARD_TTL)
+        if fill_l1:
+            for entry in entries:
+                url_cache.set(entry["short_url"], entry)
+        return len(entries)
+
+    async def warm(self) -> None:
+        """Load the popular links in pipelined batches, reporting progress as it goes."""
+        started = time.monotonic()
+        self.runs += 1
+        self.loaded = 0
+        codes = await self.popular_codes()
+        self.target = len(codes)
+        for start in range(0, len(codes), WARMUP_BATCH_SIZE):
+            batch = codes[start:start + WARMUP_BATCH_SIZE]
+            # Only the most popular links fit the in-process cache
+            self.loaded += await self._load_batch(batch, fill_l1=start < L1_CACHE_SIZE)
+        async with async_redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(WARMUP_CODES_KEY)
+            if codes:
+                pipe.rpush(WARMUP_CODES_KEY, *codes[:L1_CACHE_SIZE])
+            pipe.set(WARMUP_MARKER_KEY, int(time.time()))
+            await pipe.execute()
+        logger.info(
+            f"Warmed the cache with {self.loaded} of {self.target} URLs "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+
+    async def fill_local(self) -> None:
+        """Copy the most popular links from an already warmed Redis into the in-process cache."""
+        self.local_fills += 1
+        self.loaded = 0
+        codes = [code.decode() for code in await async_redis_client.lrange(WARMUP_CODES_KEY, 0, -1)]
+        self.target = len(codes)
+        for start in range(0, len(codes), WARMUP_BATCH_SIZE):
+            entries = await get_url_entries(codes[start:start + WARMUP_BATCH_SIZE])
+            for entry in entries:
+                url_cache.set(entry["short_url"], entry)
+            self.loaded += len(entries)
+
+    async def warm_once(self) -> None:
+        """Warm Redis if no other process is doing so, otherwise wait and fill locally."""
+        if await async_redis_client.exists(WARMUP_MARKER_KEY):
+            await self.fill_local()
+            return
+        if await async_redis_client.set(WARMUP_LOCK_KEY, 1, nx=True, ex=WARMUP_LOCK_TTL):
+            try:
+                await self.warm()
+            finally:
+                await async_redis_client.delete(WARMUP_LOCK_KEY)
+            return
+        # Another process is loading Redis; if it dies, the next check takes over
+        deadline = time.monotonic() + WARMUP_LOCK_TTL
+        while not await async_redis_client.exists(WARMUP_MARKER_KEY):
+            if time.monotonic() > deadline:
+                return
+            await asyncio.sleep(WARMUP_POLL_INTERVAL)
+        await self.fill_local()
+
+    async def _run(self) -> None:
+        self.started_at = time.monotonic()
+        try:
+            await self.warm_once()
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error warming the cache: {e}")
+        self.finished = True
+
+        while True:
+            await asyncio.sleep(WARMUP_CHECK_INTERVAL)
+            try:
+                if not await async_redis_client.exists(WARMUP_MARKER_KEY):
+                    logger.info("Redis lost the warmed cache, warming it again")
+                    await self.warm_once()
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Error re-warming the cache: {e}")
+
+    def start(self) -> None:
+        """Start warming in the background; a no-op when disabled with WARMUP_TOP_N=0."""
+        if WARMUP_TOP_N <= 0:
+            self.finished = True
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "source": WARMUP_SOURCE,
+            "target": self.target,
+            "loaded": self.loaded,
+            "progress": self.loaded / self.target if self.target else 0.0,
+            "runs": self.runs,
+            "local_fills": self.local_fills,
+            "failures": self.failures,
+        }
+
+
+cache_warmer = CacheWarmer()
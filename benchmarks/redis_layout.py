@@ -0,0 +1,160 @@
+"""Compare Redis memory use and lookup latency of the json and compact URL cache layouts.
+
+    python benchmarks/redis_layout.py --redis-url redis://localhost:6379/15 --urls 100000
+
+Only keys under the bench: prefix are written, and they are removed afterwards.
+Memory figures need a real Redis server; with --fake they are reported as null.
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+import redis
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+PREFIX = "bench:"
+CODE_ALPHABET = string.ascii_letters + string.digits
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def used_memory(client):
+    try:
+        return client.info("memory")["used_memory"]
+    except redis.ResponseError:
+        return None
+
+
+def make_entries(count, target_length, seed):
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        code = "".join(rng.choice(CODE_ALPHABET) for _ in range(7))
+        target = f"https://example.com/{i}/"
+        target += "x" * max(0, target_length - len(target))
+        entries.append({
+            "target_url": target, "short_url": code, "expired": False, "soft_expires": time.time() + 3600
+        })
+    return entries
+
+
+def load_json(client, entries):
+    pipe = client.pipeline(transaction=False)
+    for entry in entries:
+        pipe.set(f"{PREFIX}url:{entry['short_url']}", json.dumps(entry))
+    pipe.execute()
+
+
+def load_compact(client, entries):
+    pipe = client.pipeline(transaction=False)
+    for entry in entries:
+        pipe.hset(PREFIX + bucket_key(entry["short_url"]), entry["short_url"], encode_entry(entry))
+    pipe.execute()
+
+
+def lookup_json(client, code):
+    return client.get(f"{PREFIX}url:{code}")
+
+
+def lookup_compact(client, code):
+    return client.hget(PREFIX + bucket_key(code), code)
+
+
+def clear(client):
+    keys = list(client.scan_iter(match=f"{PREFIX}*", count=1000))
+    for start in range(0, len(keys), 1000):
+        client.unlink(*keys[start:start + 1000])
+
+
+def run_layout(client, name, load, lookup, entries, lookups, seed):
+    clear(client)
+    before = used_memory(client)
+    started = time.perf_counter()
+    load(client, entries)
+    load_seconds = time.perf_counter() - started
+    after = used_memory(client)
+
+    rng = random.Random(seed)
+    latencies = []
+    for _ in range(lookups):
+        code = rng.choice(entries)["short_url"]
+        started = time.perf_counter()
+        lookup(client, code)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    encoding = None
+    if name == "compact":
+        try:
+            encoding = client.object("encoding", PREFIX + bucket_key(entries[0]["short_url"]))
+            encoding = encoding.decode() if isinstance(encoding, bytes) else encoding
+        except redis.ResponseError:
+            pass
+
+    memory = after - before if before is not None and after is not None else None
+    result = {
+        "keys": sum(1 for _ in client.scan_iter(match=f"{PREFIX}*", count=1000)),
+        "memory_bytes": memory,
+        "bytes_per_url": round(memory / len(entries), 1) if memory is not None else None,
+        "load_seconds": round(load_seconds, 3),
+        "lookup_ms": {
+            "p50": round(percentile(latencies, 0.50), 4),
+            "p95": round(percentile(latencies, 0.95), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+        },
+        "encoding": encoding,
+    }
+    clear(client)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--fake", action="store_true", help="use fakeredis instead of a server")
+    parser.add_argument("--urls", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--target-length", type=int, default=48)
+    parser.add_argument("--per-bucket", type=int, default=100, help="average URLs per compact bucket")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # Size the buckets for the data set before url_store reads its settings
+    os.environ["URL_CACHE_BUCKETS"] = str(max(1, args.urls // args.per_bucket))
+    sys.path.insert(0, API_DIR)
+    global bucket_key, encode_entry
+    from url_store import bucket_key, encode_entry
+
+    if args.fake:
+        import fakeredis
+        client = fakeredis.FakeRedis()
+    else:
+        client = redis.from_url(args.redis_url)
+
+    entries = make_entries(args.urls, args.target_length, args.seed)
+    report = {
+        "urls": args.urls,
+        "target_length": args.target_length,
+        "buckets": int(os.environ["URL_CACHE_BUCKETS"]),
+        "layouts": {
+            "json": run_layout(client, "json", load_json, lookup_json, entries, args.lookups, args.seed),
+            "compact": run_layout(
+                client, "compact", load_compact, lookup_compact, entries, args.lookups, args.seed
+            ),
+        },
+    }
+    json_memory = report["layouts"]["json"]["memory_bytes"]
+    compact_memory = report["layouts"]["compact"]["memory_bytes"]
+    if json_memory and compact_memory:
+        report["memory_saving"] = round(1 - compact_memory / json_memory, 3)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Load-test and micro-benchmark suite for the api, analytics and worker services.
+
+    python benchmarks/run.py                      # fakeredis + SQLite, JSON report on stdout
+    python benchmarks/run.py --save-baseline      # also store the report as the baseline
+    python benchmarks/run.py --compare            # exit 1 if a scenario regressed
+
+Each service runs in its own process, since both are flat modules named app
+and database, and is driven in-process through an ASGI transport, so no
+servers or containers are needed. Pass --redis-url and --database-url to run
+against a local redis-server or an ephemeral Postgres instead; the suite
+writes into them, so point them at scratch databases. The worker expiry sweep
+uses Postgres-only SQL and is skipped on SQLite.
+
+benchmarks/baseline.json is generated with the default parameters on
+fakeredis and SQLite; the parameters, machine and revision it came from are
+recorded in it. --compare refuses a baseline whose parameters differ from the
+current run. Absolute numbers depend on the machine, so regenerate the
+baseline with --save-baseline on the machine that runs --compare.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+SERVICES = ["api", "analytics"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the api, analytics and worker services.")
+    parser.add_argument("--services", default=",".join(SERVICES), help="comma-separated services to run")
+    parser.add_argument("--redis-url", help="real Redis to use instead of fakeredis")
+    parser.add_argument("--database-url", help="database to use instead of a temporary SQLite file")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight per scenario")
+    parser.add_argument("--urls", type=int, default=10000, help="short URLs created before the api scenarios")
+    parser.add_argument("--events", type=int, default=50000, help="click events ingested before the analytics scenarios")
+    parser.add_argument("--links", type=int, default=100, help="distinct short URLs the click events are spread over")
+    parser.add_argument("--sync-rounds", type=int, default=20, help="timed /sync-cache calls")
+    parser.add_argument("--dirty", type=int, default=1000, help="dirty click counters per /sync-cache call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store this report as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with the baseline and fail on regressions")
+    parser.add_argument(
+        "--max-regression", type=float, default=0.2,
+        help="allowed relative throughput drop or p95 latency increase"
+    )
+    parser.add_argument("--child", choices=SERVICES, help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies, errors, elapsed, concurrency):
+    """Throughput and latency percentiles (milliseconds) of one scenario."""
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(max(latencies), 3),
+        },
+    }
+
+
+async def drive(call, total, concurrency):
+    """Run `call(i)` for i in range(total) with `concurrency` calls in flight."""
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < total:
+            i = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await call(i)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started, concurrency)
+
+
+def prepare_service(service, args, workdir):
+    """Point a service at its stand-ins and make its flat modules importable."""
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{workdir}/{service}.db"
+    # The api's click sender has no analytics service to talk to
+    os.environ.setdefault("ANALYTICS_BATCH_URL", "http://127.0.0.1:9/events/click/batch")
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        import fakeredis
+        import redis
+        import redis.asyncio
+        server = fakeredis.FakeServer()
+        redis.from_url = lambda *a, **k: fakeredis.FakeRedis(server=server)
+        redis.asyncio.from_url = lambda *a, **k: fakeredis.FakeAsyncRedis(server=server)
+        # fakeredis copies the whole bitmap on every BITFIELD, which would make
+        # the production-sized Bloom filter the bottleneck; size it to the suite
+        os.environ.setdefault("BLOOM_EXPECTED_ITEMS", str(args.urls + 2 * args.requests))
+    # Services log to logs/ under their working directory
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(ROOT, service))
+
+
+def asgi_client(app):
+    import httpx
+    transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 40000))
+    return httpx.AsyncClient(transport=transport, base_url="http://bench")
+
+
+async def bench_api(args):
+    import app as api
+    from cache import redis_client, DIRTY_CLICKS_KEY
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {}
+    rng = random.Random(args.seed)
+    await api.app.router.startup()
+    try:
+        async with asgi_client(api.app) as client:
+            codes = []
+            for start in range(0, args.urls, 1000):
+                response = await client.post("/urls/batch", json=[
+                    {"target_url": f"https://example.com/{i}"}
+                    for i in range(start, min(args.urls, start + 1000))
+                ])
+                response.raise_for_status()
+                codes += [row["short_url"] for row in response.json()]
+
+            results["create_url"] = await drive(
+                lambda i: client.post("/url", json={"target_url": f"https://example.com/new/{i}"}),
+                args.requests, args.concurrency
+            )
+            results["redirect"] = await drive(
+                lambda i: client.get("/" + rng.choice(codes)), args.requests, args.concurrency
+            )
+
+            latencies = []
+            errors = 0
+            elapsed = 0.0
+            # The first round pays one-off costs and is not timed
+            for round_index in range(args.sync_rounds + 1):
+                pipe = redis_client.pipeline(transaction=False)
+                for code in rng.sample(codes, min(args.dirty, len(codes))):
+                    pipe.incrby(f"clicks:{code}", rng.randint(1, 50))
+                    pipe.sadd(DIRTY_CLICKS_KEY, code)
+                pipe.execute()
+                started = time.perf_counter()
+                response = await client.post("/sync-cache")
+                took = time.perf_counter() - started
+                if round_index == 0:
+                    continue
+                elapsed += took
+                latencies.append(took * 1000)
+                errors += response.status_code >= 400
+            results["sync_cache"] = summarize(latencies, errors, elapsed, 1)
+    finally:
+        await api.app.router.shutdown()
+
+    if os.environ["DATABASE_URL"].startswith("postgresql"):
+        results["worker_expiry"] = bench_worker_expiry(args)
+    return results
+
+
+def bench_worker_expiry(args):
+    """Time one expiry sweep over half of the created URLs."""
+    import psycopg2
+
+    spec = importlib.util.spec_from_file_location("worker_app", os.path.join(ROOT, "worker", "app.py"))
+    worker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    count = args.urls // 2
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE urls SET created_at = now() - make_interval(days => %s)
+            WHERE id IN (SELECT id FROM urls WHERE NOT expired ORDER BY id LIMIT %s)
+            """,
+            (worker.URL_EXPIRY_DAYS + 1, count)
+        )
+    conn.close()
+    started = time.perf_counter()
+    worker.check_expired_urls()
+    elapsed = time.perf_counter() - started
+    return {
+        "urls": count,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(count / elapsed, 1) if elapsed else None,
+    }
+
+
+async def bench_analytics(args):
+    import app as analytics
+    from ingest import pipeline
+    from rollups import run_rollup
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {}
+    rng = random.Random(args.seed)
+    links = [f"bench{i}" for i in range(args.links)]
+
+    def click(i):
+        event = {
+            "short_url": rng.choice(links),
+            "referrer": rng.choice(["https://news.example", "https://social.example", None]),
+            "user_agent": "bench",
+            "ip_address": f"10.0.{i % 256}.{rng.randint(1, 254)}",
+            "country": rng.choice(["US", "DE", "IN", None]),
+        }
+        # Missing fields are sent the way the api sends them: left out
+        return {key: value for key, value in event.items() if value is not None}
+
+    # Startup handlers include the sync table setup, run here as the server would
+    await analytics.app.router.startup()
+    try:
+        async with asgi_client(analytics.app) as client:
+            for start in range(0, args.events, 1000):
+                response = await client.post("/events/click/batch", json={
+                    "events": [click(i) for i in range(start, min(args.events, start + 1000))]
+                })
+                response.raise_for_status()
+            deadline = time.monotonic() + 120
+            while pipeline.stats()["inserted"] + pipeline.stats()["failed"] < args.events:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Ingestion stalled: {pipeline.stats()}")
+                await asyncio.sleep(0.1)
+            # The first run only records the high-water mark the second run folds up to
+            await asyncio.to_thread(run_rollup)
+            await asyncio.to_thread(run_rollup)
+
+            results["events_click"] = await drive(
+                lambda i: client.post("/events/click", json=click(i)), args.requests, args.concurrency
+            )
+            results["analytics_summary"] = await drive(
+                lambda i: client.get(f"/analytics/{rng.choice(links)}/summary"),
+                args.requests, args.concurrency
+            )
+    finally:
+        await analytics.app.router.shutdown()
+    return results
+
+
+def run_child(args):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{args.child}-")
+    prepare_service(args.child, args, workdir)
+    bench = bench_api if args.child == "api" else bench_analytics
+    results = asyncio.run(bench(args))
+    with open(args.child_output, "w") as f:
+        json.dump(results, f)
+
+
+def run_service(service, argv):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        output = f.name
+    try:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *argv, "--child", service, "--child-output", output],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.unlink(output)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline, max_regression):
+    """Relative change of each scenario against the baseline, flagging regressions.
+
+    A scenario regresses when its throughput drops or its p95 latency grows by
+    more than max_regression, or when its error rate rises at all.
+    """
+    comparison = {}
+    for service, scenarios in report["results"].items():
+        for name, result in scenarios.items():
+            base = baseline.get("results", {}).get(service, {}).get(name)
+            if not base or not base.get("throughput_rps") or not result.get("throughput_rps"):
+                continue
+            throughput_change = result["throughput_rps"] / base["throughput_rps"] - 1
+            entry = {"throughput_change": round(throughput_change, 3)}
+            regressed = throughput_change < -max_regression
+            if "errors" in result and "errors" in base:
+                # Any rise in the share of failed requests counts, however small
+                error_rate = result["errors"] / result["requests"] if result["requests"] else 0.0
+                base_error_rate = base["errors"] / base["requests"] if base["requests"] else 0.0
+                entry["errors"] = result["errors"]
+                entry["error_rate_change"] = round(error_rate - base_error_rate, 4)
+                regressed = regressed or error_rate > base_error_rate
+            if "latency_ms" in result and "latency_ms" in base:
+                p95_change = result["latency_ms"]["p95"] / base["latency_ms"]["p95"] - 1
+                entry["p95_change"] = round(p95_change, 3)
+                regressed = regressed or p95_change > max_regression
+            entry["regressed"] = regressed
+            comparison[f"{service}.{name}"] = entry
+    return comparison
+
+
+def baseline_mismatch(report, baseline):
+    """Settings that differ between this run and the baseline, as a printable dict."""
+    mismatched = {}
+    for key in ("redis", "database"):
+        if baseline.get(key) != report[key]:
+            mismatched[key] = baseline.get(key)
+    for key, value in report["parameters"].items():
+        # Scenarios a partial run skips are simply not compared
+        if key != "services" and baseline.get("parameters", {}).get(key) != value:
+            mismatched[key] = baseline.get("parameters", {}).get(key)
+    return mismatched
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.child:
+        run_child(args)
+        return 0
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "redis": "server" if args.redis_url else "fakeredis",
+        "database": (args.database_url or "sqlite").split(":", 1)[0],
+        "parameters": {
+            "services": args.services,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "urls": args.urls,
+            "events": args.events,
+            "links": args.links,
+            "sync_rounds": args.sync_rounds,
+            "dirty": args.dirty,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    for service in args.services.split(","):
+        report["results"][service] = run_service(service, argv)
+
+    status = 0
+    if args.compare:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            mismatched = baseline_mismatch(report, baseline)
+            if mismatched:
+                # Numbers from a differently sized run say nothing about regressions
+                print(f"Baseline {args.baseline} was generated with different {mismatched}", file=sys.stderr)
+                status = 2
+            else:
+                report["comparison"] = compare(report, baseline, args.max_regression)
+                if any(entry["regressed"] for entry in report["comparison"].values()):
+                    status = 1
+        else:
+            print(f"No baseline at {args.baseline}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""Compare API cold-start schema work before and after the versioned migration runner.
+
+    python benchmarks/startup.py --database-url postgresql://postgres@localhost/scratch
+
+"legacy" repeats what every API process used to do on startup: create_all
+plus a raw psycopg2 connection querying information_schema for the expired
+column. "versioned" is the current startup check, a single schema_version
+query. Each sample is a fresh process, timed from before its first database
+connection; --workers processes start at once, like uvicorn workers booting
+together. The database is migrated first, so both modes see an up-to-date
+schema. Without --database-url a temporary SQLite file is used, where the
+psycopg2 step is skipped.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(ROOT, "api")
+MODES = ["legacy", "versioned"]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def legacy_startup(database_url):
+    from database import create_tables
+    create_tables()
+    if not database_url.startswith("postgresql"):
+        return
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name='urls' AND column_name='expired';
+    """)
+    cursor.fetchone()
+    cursor.close()
+    conn.close()
+
+
+def versioned_startup(database_url):
+    from migrations import schema_is_current
+    if not schema_is_current():
+        raise SystemExit("schema is not current")
+
+
+def run_child(mode):
+    sys.path.insert(0, API_DIR)
+    database_url = os.environ["DATABASE_URL"]
+    # Imports are the same in both modes and not part of the comparison
+    import database  # noqa: F401
+    import migrations  # noqa: F401
+    started = time.perf_counter()
+    if mode == "legacy":
+        legacy_startup(database_url)
+    else:
+        versioned_startup(database_url)
+    print(json.dumps({"seconds": time.perf_counter() - started}))
+
+
+def run_round(mode, workers, env):
+    """Start `workers` processes at once and return each one's startup time."""
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--child", mode],
+            env=env, cwd=API_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        for _ in range(workers)
+    ]
+    samples = []
+    for process in processes:
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise SystemExit(f"{mode} child failed:\n{err}")
+        samples.append(json.loads(out.strip().splitlines()[-1])["seconds"])
+    return samples
+
+
+def summarize(samples):
+    return {
+        "samples": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 2),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", help="scratch database; a temporary SQLite file by default")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=8, help="processes started at once per round")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    env = dict(os.environ)
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+    else:
+        env["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "startup.db")
+
+    subprocess.run(
+        [sys.executable, "migrations.py"], env=env, cwd=API_DIR, check=True, capture_output=True
+    )
+
+    report = {"database": env["DATABASE_URL"].split(":", 1)[0], "workers": args.workers, "modes": {}}
+    for mode in MODES:
+        samples = []
+        for _ in range(args.rounds):
+            samples.extend(run_round(mode, args.workers, env))
+        report["modes"][mode] = summarize(samples)
+    legacy = report["modes"]["legacy"]["mean_ms"]
+    versioned = report["modes"]["versioned"]["mean_ms"]
+    report["speedup"] = round(legacy / versioned, 2) if versioned else None
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
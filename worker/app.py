@@ -1,13 +1,20 @@
 import os
+import math
 import time
-import schedule
-import requests
+import signal
+import string
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
 import redis
 import json
+import zlib
 import logging
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+from runner import Job, JobRunner
+
 # Create logs directory if it doesn't exist
 os.makedirs("logs", exist_ok=True)
 
@@ -23,116 +30,292 @@ logging.basicConfig(
 logger = logging.getLogger("url-shortener-worker")
 
 # Environment variables
-API_URL = os.getenv("API_URL", "http://api:8000")
 DB_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/urlshortener")
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 URL_EXPIRY_DAYS = int(os.getenv("URL_EXPIRY_DAYS", "30"))
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "cache:invalidate")
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "1000"))
+# Must match the API: the most shard keys a hot click counter can be spread over
+CLICK_COUNTER_MAX_SHARDS = 32
+# Must match the API: compact URL entries live in this many hash buckets
+URL_CACHE_BUCKETS = int(os.getenv("URL_CACHE_BUCKETS", "65536"))
+
+# Job schedule; each job runs at most once per interval across all replicas
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "3600"))
+EXPIRY_INTERVAL = float(os.getenv("EXPIRY_INTERVAL", "86400"))
+# The expiry sweep is split into this many short-code ranges that replicas claim independently
+EXPIRY_SHARDS = int(os.getenv("EXPIRY_SHARDS", "1"))
+# Number of short URLs written per UPDATE when syncing click counts
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", "1000"))
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+
+# Must match the API: set of short codes whose click counter changed since the last sync
+DIRTY_CLICKS_KEY = "clicks:dirty"
+# Must match the API: set of short codes that may have shard counters
+SHARDED_CLICKS_KEY = "clicks:sharded"
+
+# Last (created_at, id) handled by an unfinished expiry sweep of one shard
+EXPIRY_CHECKPOINT_KEY = "worker:expiry:checkpoint"
+
+# Code characters in byte order, which is the order of COLLATE "C" comparisons
+CODE_CHARS = sorted(string.digits + string.ascii_letters)
 
-# Redis client
-redis_client = redis.from_url(REDIS_URL)
+# Expire one keyset-paginated chunk of one short-code range; served by the
+# partial index on unexpired rows, which the API migrations create
+EXPIRE_CHUNK_SQL = """
+    WITH batch AS (
+        SELECT id FROM urls
+        WHERE NOT expired
+          AND created_at < %(expiry_date)s
+          AND (created_at, id) > (%(last_created_at)s, %(last_id)s)
+          AND (%(low)s IS NULL OR short_url COLLATE "C" >= %(low)s)
+          AND (%(high)s IS NULL OR short_url COLLATE "C" < %(high)s)
+        ORDER BY created_at, id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE urls SET expired = TRUE
+    FROM batch
+    WHERE urls.id = batch.id
+    RETURNING urls.id, urls.short_url, urls.created_at
+"""
 
-def connect_to_db():
-    """Connect to the PostgreSQL database."""
+# Largest value of the INTEGER urls.clicks column; totals saturate there instead
+# of failing the chunk with an overflow
+MAX_CLICKS = 2 ** 31 - 1
+
+APPLY_CLICKS_SQL = f"""
+    WITH deltas(short_url, delta) AS (VALUES %s)
+    UPDATE urls SET clicks = CASE
+        WHEN urls.clicks > {MAX_CLICKS} - deltas.delta THEN {MAX_CLICKS}
+        ELSE urls.clicks + deltas.delta
+    END
+    FROM deltas
+    WHERE urls.short_url = deltas.short_url
+"""
+
+# Redis client; its connection pool is shared by every job
+redis_client = redis.from_url(REDIS_URL, health_check_interval=30)
+
+_db_pool = None
+
+def get_db_pool():
+    """Create the PostgreSQL connection pool on first use."""
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_URL)
+    return _db_pool
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; broken connections are discarded instead of returned."""
+    pool = get_db_pool()
+    conn = pool.getconn()
     try:
-        conn = psycopg2.connect(DB_URL)
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to database: {e}")
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+def wait_for_database(timeout=300):
+    """Block until the database accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return
+        except psycopg2.Error as e:
+            if time.monotonic() > deadline:
+                raise
+            logger.error(f"Error connecting to database: {e}")
+            time.sleep(5)
+
+def shard_bounds(shard, shards):
+    """[low, high) short-code range of a shard; the outer shards are open-ended."""
+    low = CODE_CHARS[len(CODE_CHARS) * shard // shards] if shard > 0 else None
+    high = CODE_CHARS[len(CODE_CHARS) * (shard + 1) // shards] if shard < shards - 1 else None
+    return low, high
+
+def checkpoint_key(shard):
+    return f"{EXPIRY_CHECKPOINT_KEY}:{shard}"
+
+def load_expiry_checkpoint(shard):
+    """Return the (created_at, id) an interrupted sweep of a shard stopped at, if any."""
+    data = redis_client.get(checkpoint_key(shard))
+    if not data:
         return None
+    checkpoint = json.loads(data)
+    return datetime.fromisoformat(checkpoint["created_at"]), checkpoint["id"]
+
+def save_expiry_checkpoint(shard, created_at, url_id):
+    redis_client.set(
+        checkpoint_key(shard),
+        json.dumps({"created_at": created_at.isoformat(), "id": url_id})
+    )
+
+def click_counter_keys(short_url):
+    """The base click counter key of a short URL followed by its shard keys."""
+    return [f"clicks:{short_url}"] + [
+        f"clicks:{short_url}:{shard}" for shard in range(CLICK_COUNTER_MAX_SHARDS)
+    ]
+
+def drop_cached_urls(short_urls):
+    """Remove expired URLs from Redis and every API replica's in-process cache."""
+    pipe = redis_client.pipeline(transaction=False)
+    for short_url in short_urls:
+        pipe.unlink(f"url:{short_url}", *click_counter_keys(short_url))
+        pipe.srem(SHARDED_CLICKS_KEY, short_url)
+        pipe.hdel(f"urls:{zlib.crc32(short_url.encode()) % URL_CACHE_BUCKETS}", short_url)
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, short_url)
+    pipe.execute()
+
+def expire_urls(shard, lease=None):
+    """Mark URLs older than the expiry window as expired in one short-code range."""
+    expiry_date = datetime.now() - timedelta(days=URL_EXPIRY_DAYS)
+    low, high = shard_bounds(shard, EXPIRY_SHARDS)
+
+    # Resume where an interrupted sweep stopped
+    checkpoint = load_expiry_checkpoint(shard)
+    if checkpoint:
+        logger.info(f"Resuming expiry sweep of shard {shard} after {checkpoint}")
+        last_created_at, last_id = checkpoint
+    else:
+        last_created_at, last_id = datetime.min, 0
+
+    total = 0
+    with db_connection() as conn:
+        while True:
+            # Each chunk is its own short transaction
+            with conn.cursor() as cur:
+                cur.execute(EXPIRE_CHUNK_SQL, {
+                    "expiry_date": expiry_date,
+                    "last_created_at": last_created_at,
+                    "last_id": last_id,
+                    "low": low,
+                    "high": high,
+                    "limit": EXPIRY_BATCH_SIZE
+                })
+                expired_urls = cur.fetchall()
+            conn.commit()
+
+            if not expired_urls:
+                break
+
+            drop_cached_urls([short_url for _, short_url, _ in expired_urls])
+
+            last_id, _, last_created_at = max(expired_urls, key=lambda row: (row[2], row[0]))
+            save_expiry_checkpoint(shard, last_created_at, last_id)
+            total += len(expired_urls)
+            if lease:
+                lease.renew()
+
+    redis_client.delete(checkpoint_key(shard))
+    if total:
+        logger.info(f"Processed {total} expired URLs in shard {shard}.")
+    else:
+        logger.info(f"No expired URLs found in shard {shard}.")
 
 def check_expired_urls():
-    """Check for and handle expired URLs."""
-    logger.info("Checking for expired URLs...")
-    
-    conn = connect_to_db()
-    if not conn:
-        return
-    
-    try:
-        with conn.cursor() as cur:
-            # Calculate expiration date
-            expiry_date = datetime.now() - timedelta(days=URL_EXPIRY_DAYS)
-            
-            # Find expired URLs
-            cur.execute(
-                "SELECT id, short_url FROM urls WHERE created_at < %s",
-                (expiry_date,)
+    """Sweep every shard in this process, e.g. for a one-off run."""
+    for shard in range(EXPIRY_SHARDS):
+        expire_urls(shard)
+
+def pop_dirty_clicks(count):
+    """Atomically take up to `count` dirty short URLs and their pending clicks, summed over shards.
+
+    Returns None once the dirty set is empty. SPOP hands every code to exactly
+    one caller, so replicas can drain the set concurrently. Shards are only
+    drained for codes the API marked as sharded.
+    """
+    codes = [code.decode() for code in redis_client.spop(DIRTY_CLICKS_KEY, count) or []]
+    if not codes:
+        return None
+    pipe = redis_client.pipeline(transaction=False)
+    for code in codes:
+        pipe.srem(SHARDED_CLICKS_KEY, code)
+        pipe.getdel(f"clicks:{code}")
+    values = pipe.execute()
+    counts = {code: int(value or 0) for code, value in zip(codes, values[1::2])}
+    # Shards written after the mark was removed re-mark the code for the next drain
+    sharded = [code for code, removed in zip(codes, values[0::2]) if removed]
+    if sharded:
+        pipe = redis_client.pipeline(transaction=False)
+        for code in sharded:
+            for key in click_counter_keys(code)[1:]:
+                pipe.getdel(key)
+        values = pipe.execute()
+        for i, code in enumerate(sharded):
+            counts[code] += sum(
+                int(value) for value in values[i * CLICK_COUNTER_MAX_SHARDS:(i + 1) * CLICK_COUNTER_MAX_SHARDS]
+                if value
             )
-            
-            expired_urls = cur.fetchall()
-            
-            if not expired_urls:
-                logger.info("No expired URLs found.")
-                return
-            
-            logger.info(f"Found {len(expired_urls)} expired URLs.")
-            
-            # Process expired URLs
-            for url_id, short_url in expired_urls:
-                # Delete from Redis cache
-                redis_client.delete(f"url:{short_url}")
-                redis_client.delete(f"clicks:{short_url}")
-                
-                # Mark as expired in database (or delete)
-                # Here we're just adding an 'expired' column, but you could delete instead
-                cur.execute(
-                    "UPDATE urls SET expired = TRUE WHERE id = %s",
-                    (url_id,)
-                )
-            
-            conn.commit()
-            logger.info(f"Processed {len(expired_urls)} expired URLs.")
-    
-    except Exception as e:
-        logger.error(f"Error checking expired URLs: {e}")
-    finally:
-        conn.close()
-
-def sync_cache_with_db():
-    """Synchronize Redis cache click counts with the database."""
-    logger.info("Synchronizing cache with database...")
-    
-    max_retries = 5
-    retry_delay = 10  # seconds
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(f"{API_URL}/sync-cache", timeout=5)
-            if response.status_code == 200:
-                logger.info("Cache synchronized successfully.")
-                return
-            else:
-                logger.error(f"Error synchronizing cache: {response.status_code} - {response.text}")
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error calling sync-cache endpoint (attempt {attempt+1}/{max_retries}): {e}")
-            
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                logger.error("Max retries exceeded. Giving up.")
-
-def run_scheduled_tasks():
-    """Run all scheduled tasks."""
-    schedule.run_pending()
+    return {code: clicks for code, clicks in counts.items() if clicks}
+
+def restore_clicks(counts):
+    """Put drained clicks back, e.g. when writing them to the database failed."""
+    pipe = redis_client.pipeline(transaction=False)
+    for short_url, clicks in counts.items():
+        pipe.incrby(f"clicks:{short_url}", clicks)
+        pipe.sadd(DIRTY_CLICKS_KEY, short_url)
+    pipe.execute()
+
+def sync_click_counts(shard=0, lease=None):
+    """Write pending Redis click counters to the database."""
+    # Only drain what is dirty now; clicks arriving meanwhile wait for the next sync
+    chunks = math.ceil(redis_client.scard(DIRTY_CLICKS_KEY) / SYNC_CHUNK_SIZE)
+    synced_urls = 0
+    synced_clicks = 0
+    with db_connection() as conn:
+        for _ in range(chunks):
+            counts = pop_dirty_clicks(SYNC_CHUNK_SIZE)
+            if counts is None:
+                break
+            if not counts:
+                continue
+            try:
+                with conn.cursor() as cur:
+                    psycopg2.extras.execute_values(
+                        cur, APPLY_CLICKS_SQL,
+                        [(code, min(clicks, MAX_CLICKS)) for code, clicks in counts.items()],
+                        page_size=len(counts)
+                    )
+                conn.commit()
+            except Exception:
+                restore_clicks(counts)
+                raise
+            synced_urls += len(counts)
+            synced_clicks += sum(counts.values())
+            if lease:
+                lease.renew()
+    logger.info(f"Synced {synced_clicks} clicks for {synced_urls} URLs")
 
 def main():
     """Main function to set up and run the worker."""
     logger.info("Starting URL Shortener Worker...")
-    
-    # Schedule tasks
-    schedule.every(1).hour.do(sync_cache_with_db)
-    schedule.every(1).day.at("00:00").do(check_expired_urls)
-    
-    # Run tasks immediately on startup
-    sync_cache_with_db()
-    check_expired_urls()
-    
-    # Main loop
-    while True:
-        run_scheduled_tasks()
-        time.sleep(60)  # Check every minute
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        logger.info("Stopping after the current job...")
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    wait_for_database()
+
+    runner = JobRunner(redis_client, [
+        Job("sync_clicks", sync_click_counts, SYNC_INTERVAL),
+        Job("expire_urls", expire_urls, EXPIRY_INTERVAL, shards=EXPIRY_SHARDS),
+    ])
+    runner.run_forever(stop=lambda: stopping)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,118 @@
+import os
+import time
+import random
+import socket
+import logging
+import uuid
+from typing import Callable, List, Optional
+
+import redis
+from redis.exceptions import LockError
+
+logger = logging.getLogger("url-shortener-worker")
+
+# Identifies this replica in lease values and logs
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+# A lease expires this long after its last renewal, so a crashed replica's
+# shards are picked up by another replica after at most this delay
+LEASE_TTL = float(os.getenv("WORKER_LEASE_TTL", "60"))
+# How often an idle runner looks for due work
+JOB_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "5"))
+
+
+class Lease:
+    """A renewable Redis lease on one unit of work, held by this replica only."""
+
+    def __init__(self, redis_client: redis.Redis, name: str):
+        self.name = name
+        self._lock = redis_client.lock(f"worker:lease:{name}", timeout=LEASE_TTL, blocking=False)
+
+    def acquire(self) -> bool:
+        return self._lock.acquire(token=f"{WORKER_ID}:{uuid.uuid4().hex}")
+
+    def renew(self) -> None:
+        """Push the expiry out again. Raises LockError if the lease was lost."""
+        self._lock.reacquire()
+
+    def release(self) -> None:
+        try:
+            self._lock.release()
+        except LockError:
+            # Already expired, possibly taken over by another replica
+            pass
+
+
+class Job:
+    """A job split into shards; each shard runs at most once per interval across all replicas."""
+
+    def __init__(self, name: str, fn: Callable[[int, Lease], None], interval: float, shards: int = 1):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.shards = shards
+
+    def unit(self, shard: int) -> str:
+        return f"{self.name}:{shard}"
+
+
+class JobRunner:
+    """Runs due job shards on this replica, claiming each through a lease."""
+
+    def __init__(self, redis_client: redis.Redis, jobs: List[Job]):
+        self.redis = redis_client
+        self.jobs = jobs
+
+    def _last_run_key(self, unit: str) -> str:
+        return f"worker:last_run:{unit}"
+
+    def _is_due(self, job: Job, unit: str) -> bool:
+        last_run = self.redis.get(self._last_run_key(unit))
+        return last_run is None or time.time() - float(last_run) >= job.interval
+
+    def run_shard(self, job: Job, shard: int) -> bool:
+        """Run one shard if it is due and no other replica holds it. Returns True if it ran."""
+        unit = job.unit(shard)
+        if not self._is_due(job, unit):
+            return False
+        lease = Lease(self.redis, unit)
+        if not lease.acquire():
+            return False
+        try:
+            # Another replica may have finished this shard between the check and the claim
+            if not self._is_due(job, unit):
+                return False
+            started = time.monotonic()
+            job.fn(shard, lease)
+            self.redis.set(self._last_run_key(unit), time.time())
+            logger.info(f"{WORKER_ID} ran {unit} in {time.monotonic() - started:.2f}s")
+            return True
+        except LockError:
+            logger.warning(f"Lost the lease on {unit}; another replica will resume it")
+            return False
+        except Exception as e:
+            logger.error(f"Error running {unit}: {e}")
+            return False
+        finally:
+            lease.release()
+
+    def run_pending(self) -> int:
+        """Run every due shard this replica can claim. Returns the number that ran."""
+        ran = 0
+        for job in self.jobs:
+            # Replicas walk shards in different orders so they spread out quickly
+            shards = list(range(job.shards))
+            random.shuffle(shards)
+            for shard in shards:
+                ran += self.run_shard(job, shard)
+        return ran
+
+    def run_forever(self, stop: Optional[Callable[[], bool]] = None) -> None:
+        logger.info(f"Worker {WORKER_ID} running {', '.join(job.name for job in self.jobs)}")
+        while not (stop and stop()):
+            try:
+                ran = self.run_pending()
+            except redis.RedisError as e:
+                logger.error(f"Error talking to Redis: {e}")
+                ran = 0
+            if not ran:
+                time.sleep(JOB_POLL_INTERVAL)